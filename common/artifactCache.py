@@ -0,0 +1,156 @@
+# encoding: utf-8
+
+# Description:
+#   Local, content-addressed cache of the packages the fabfiles install.
+#   Artifacts are downloaded once on the control machine, stored by their
+#   SHA-256 checksum and pushed to the hosts over SSH. A remote copy only
+#   counts as present when its checksum matches, so truncated downloads are
+#   replaced instead of failing later on.
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+from fabric.api import run, settings, put
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+# Shared by every fabfile in this repository
+ARTIFACT_CACHE_DIR = os.path.expanduser("~/.cache/fabric-scripts/artifacts")
+# Least recently used artifacts are evicted when the cache grows past this
+ARTIFACT_CACHE_MAX_SIZE = 4 * 1024 * 1024 * 1024
+
+
+def sha256File(filePath):
+    digest = hashlib.sha256()
+
+    with open(filePath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def fetchArtifact(url, checksum=None, cacheDir=ARTIFACT_CACHE_DIR,
+                  maxSize=ARTIFACT_CACHE_MAX_SIZE):
+    """Return the local path and SHA-256 checksum of the artifact at url,
+    downloading it into the cache only if it isn't there yet. If checksum is
+    given, the artifact must match it.
+    """
+    objectsDir = os.path.join(cacheDir, "objects")
+    if not os.path.isdir(objectsDir):
+        os.makedirs(objectsDir)
+
+    # Parallel fabric tasks run in separate processes, make sure only one of
+    # them downloads a given artifact.
+    with open(os.path.join(cacheDir, ".lock"), "w") as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+
+        index = readIndex(cacheDir)
+        cachedChecksum = checksum or index.get(url)
+
+        if cachedChecksum:
+            objectPath = os.path.join(objectsDir, cachedChecksum)
+
+            if os.path.isfile(objectPath):
+                # Mark as recently used
+                os.utime(objectPath, None)
+                return objectPath, cachedChecksum
+
+        print("Downloading %s" % url)
+        partPath = os.path.join(objectsDir, ".download")
+        with open(partPath, "wb") as f:
+            shutil.copyfileobj(urlopen(url), f)
+
+        downloadedChecksum = sha256File(partPath)
+        if checksum and downloadedChecksum != checksum:
+            os.remove(partPath)
+            raise Exception("Checksum mismatch for %s: expected %s, got %s" %
+                            (url, checksum, downloadedChecksum))
+
+        objectPath = os.path.join(objectsDir, downloadedChecksum)
+        os.rename(partPath, objectPath)
+
+        index[url] = downloadedChecksum
+        writeIndex(cacheDir, index)
+        evictArtifacts(cacheDir, maxSize, keep=downloadedChecksum)
+
+        return objectPath, downloadedChecksum
+
+
+def evictArtifacts(cacheDir, maxSize, keep=None):
+    objectsDir = os.path.join(cacheDir, "objects")
+    objects = []
+
+    for name in os.listdir(objectsDir):
+        if not name.startswith("."):
+            stat = os.stat(os.path.join(objectsDir, name))
+            objects.append((stat.st_mtime, stat.st_size, name))
+
+    totalSize = sum(size for _, size, _ in objects)
+    index = readIndex(cacheDir)
+
+    # Oldest (least recently used) first
+    for _, size, name in sorted(objects):
+        if totalSize <= maxSize:
+            break
+
+        if name == keep:
+            continue
+
+        print("Evicting cached artifact %s" % name)
+        os.remove(os.path.join(objectsDir, name))
+        totalSize -= size
+        index = dict((url, checksum) for url, checksum in index.items()
+                     if checksum != name)
+
+    writeIndex(cacheDir, index)
+
+
+def readIndex(cacheDir):
+    try:
+        with open(os.path.join(cacheDir, "index.json")) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def writeIndex(cacheDir, index):
+    indexPath = os.path.join(cacheDir, "index.json")
+
+    with open(indexPath + ".tmp", "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.rename(indexPath + ".tmp", indexPath)
+
+
+def remoteArtifactMatches(remotePath, checksum):
+    with settings(warn_only=True):
+        return run("sha256sum %s | cut -d ' ' -f 1" % remotePath) == checksum
+
+
+def verifyArtifactCommand(partPath, remotePath, checksum):
+    # Only move the new copy into place if it is complete
+    return "echo '%(sum)s  %(part)s' | sha256sum -c --quiet - && mv %(part)s %(file)s" % \
+        {"sum": checksum, "part": partPath, "file": remotePath}
+
+
+def pushArtifact(localPath, remotePath, checksum):
+    put(localPath, remotePath + ".part")
+    run(verifyArtifactCommand(remotePath + ".part", remotePath, checksum))
+
+
+def ensureRemoteArtifact(url, remotePath, checksum=None):
+    """Make sure remotePath on the current host holds the artifact at url,
+    pushing it from the local cache unless an identical copy is there.
+    Returns the artifact checksum.
+    """
+    localPath, checksum = fetchArtifact(url, checksum)
+
+    if not remoteArtifactMatches(remotePath, checksum):
+        pushArtifact(localPath, remotePath, checksum)
+
+    return checksum
@@ -0,0 +1,146 @@
+# encoding: utf-8
+
+# Description:
+#   Alternative to fabric's @parallel for running a command on a large
+#   number of hosts. fabric forks one process (with its own SSH connection)
+#   per host, this runs every host from a single asyncio event loop with a
+#   bounded number of concurrent connections, a timeout per host and the
+#   output streamed as it arrives, in the usual "[host] out: ..." format.
+#
+#   Requires Python 3 and asyncssh (pip install asyncssh). Only import it
+#   from the code paths that use it, the fabfiles themselves must keep
+#   working without it.
+
+import time
+import shlex
+import asyncio
+from fabric.api import env, abort
+from fabric.network import normalize
+from fabric.state import output
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+import remoteTiming
+
+# Maximum number of hosts being worked on at the same time
+ASYNC_CONCURRENCY = 500
+# Seconds a host gets to connect and run the command
+ASYNC_TIMEOUT = 120
+
+
+class HostResult(str):
+    pass
+
+
+def runOnHosts(hosts, command, useSudo=False, stdin=None,
+               concurrency=ASYNC_CONCURRENCY, timeout=ASYNC_TIMEOUT):
+    """Run command on every host and return a {host: result} dict. Each
+    result is the command output, with return_code, stderr, failed and
+    succeeded attributes like fabric's. Hosts that couldn't be reached or
+    timed out are failed results with a negative return_code.
+
+    command and stdin can also be functions of the host, to run a
+    different command or send different input to each one.
+    """
+    if asyncssh is None:
+        abort("The async engine requires asyncssh (pip install asyncssh)")
+
+    return asyncio.run(runAll(hosts, command, useSudo, stdin, concurrency, timeout))
+
+
+async def runAll(hosts, command, useSudo, stdin, concurrency, timeout):
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*[
+        runOnHost(host, command(host) if callable(command) else command, useSudo,
+                  stdin(host) if callable(stdin) else stdin, semaphore, timeout)
+        for host in hosts])
+    return dict(zip(hosts, results))
+
+
+async def runOnHost(host, command, useSudo, stdin, semaphore, timeout):
+    async with semaphore:
+        start = time.time()
+        try:
+            result = await asyncio.wait_for(
+                executeOnHost(host, command, useSudo, stdin), timeout)
+        except asyncio.TimeoutError:
+            result = failedResult("timed out after %ss" % timeout, -2)
+        except (OSError, asyncssh.Error) as e:
+            result = failedResult(str(e) or e.__class__.__name__, -1)
+
+        if result.failed and output.warnings:
+            print("[%s] Warning: %s" % (host, result.stderr.strip() or
+                                        "exit status %d" % result.return_code))
+        remoteTiming.record("sudo" if useSudo else "run", command, start,
+                            len(result) + len(result.stderr), result.return_code, host)
+        return result
+
+
+async def executeOnHost(host, command, useSudo, stdin):
+    async with asyncssh.connect(**connectOptions(host)) as connection:
+        process = await connection.create_process(remoteCommand(command, useSudo))
+
+        if stdin is not None:
+            process.stdin.write(stdin)
+        process.stdin.write_eof()
+
+        stdout, stderr = await asyncio.gather(
+            readStream(host, process.stdout, "out"),
+            readStream(host, process.stderr, "err"))
+        completed = await process.wait()
+
+    result = HostResult(stdout.rstrip("\n"))
+    result.return_code = completed.exit_status
+    result.stderr = stderr
+    result.failed = result.return_code != 0
+    result.succeeded = not result.failed
+    return result
+
+
+async def readStream(host, stream, label):
+    lines = []
+
+    async for line in stream:
+        lines.append(line)
+        if output.stdout:
+            print("[%s] %s: %s" % (host, label, line.rstrip("\n")))
+
+    return "".join(lines)
+
+
+def failedResult(message, returnCode):
+    result = HostResult("")
+    result.return_code = returnCode
+    result.stderr = message
+    result.failed = True
+    result.succeeded = False
+    return result
+
+
+def connectOptions(hostString):
+    # Same user, port, keys and password fabric would use for the host
+    user, host, port = normalize(hostString)
+    options = {"host": host, "port": int(port), "username": user}
+
+    if env.key_filename:
+        keys = env.key_filename
+        options["client_keys"] = [keys] if isinstance(keys, str) else list(keys)
+    if env.password:
+        options["password"] = env.password
+    if not env.reject_unknown_hosts:
+        # fabric accepts unknown host keys by default as well
+        options["known_hosts"] = None
+
+    return options
+
+
+def remoteCommand(command, useSudo):
+    # Like fabric, run through env.shell. Sudo must not ask for a password.
+    command = "%s %s" % (env.shell, shlex.quote(command))
+    if useSudo:
+        command = "sudo -n -H " + command
+    return command
+
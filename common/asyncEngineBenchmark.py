@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Description:
+#   Measures wall time, memory and file descriptors of probing the host facts
+#   of many hosts with the async engine (asyncEngine.py), and of a smaller
+#   number of hosts with fabric's @parallel for comparison. The hosts are
+#   simulated by a local SSH stand-in (asyncssh, in a separate process) that
+#   runs every command on this machine after a simulated round trip time;
+#   each host is a different user on the same port.
+#
+#   ./asyncEngineBenchmark.py [asyncHosts] [fabricHosts] [rttMs]
+
+import os
+import sys
+import time
+import asyncio
+import resource
+import threading
+import multiprocessing
+import asyncssh
+from fabric.api import env, settings, hide
+
+import hostFacts
+
+
+class StandInServer(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        # Every user is let in without authentication
+        return False
+
+
+def serveStandIn(port, rttSeconds, ready):
+    async def handleProcess(process):
+        await asyncio.sleep(rttSeconds)
+        command = await asyncio.create_subprocess_shell(process.command,
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await command.communicate()
+        process.stdout.write(stdout.decode("utf-8", "replace"))
+        process.stderr.write(stderr.decode("utf-8", "replace"))
+        process.exit(command.returncode)
+
+    async def serve():
+        await asyncssh.create_server(StandInServer, "127.0.0.1", port,
+            server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")],
+            process_factory=handleProcess, backlog=4096)
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def watchFileDescriptors(peak, stop):
+    while not stop.is_set():
+        peak[0] = max(peak[0], len(os.listdir("/proc/self/fd")))
+        time.sleep(0.05)
+
+
+def measure(probe, hosts):
+    peak = [0]
+    stop = threading.Event()
+    watcher = threading.Thread(target=watchFileDescriptors, args=(peak, stop))
+    watcher.start()
+
+    start = time.time()
+    facts = probe(hosts)
+    duration = time.time() - start
+
+    stop.set()
+    watcher.join()
+
+    probed = sum(1 for host in hosts if facts.get(host, {}).get("cpuCount"))
+    return duration, probed, peak[0]
+
+
+def main(asyncHosts=1000, fabricHosts=100, rttMs=50):
+    port = 20000 + os.getpid() % 10000
+    ready = multiprocessing.Event()
+    standIn = multiprocessing.Process(target=serveStandIn,
+                                      args=(port, rttMs / 1000.0, ready))
+    standIn.daemon = True
+    standIn.start()
+    ready.wait()
+
+    env.disable_known_hosts = True
+    env.abort_on_prompts = True
+    env.password = "stand-in"
+    env.shell = "/bin/sh -c"
+    # Only the stand-in's keys, not the ones in ~/.ssh or the agent
+    env.no_agent = env.no_keys = True
+
+    hostList = ["host%05d@127.0.0.1:%d" % (i, port) for i in range(max(asyncHosts, fabricHosts))]
+
+    print("%-8s %6s %8s %10s %12s %10s" % ("engine", "hosts", "probed", "wall time",
+                                            "peak memory", "peak fds"))
+
+    rssBefore = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    hostFacts.ENGINE = "async"
+    with settings(hide("everything")):
+        duration, probed, fds = measure(hostFacts.probeHosts, hostList[:asyncHosts])
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("%-8s %6d %8d %9.1fs %10dMB %10d" % ("async", asyncHosts, probed, duration,
+                                              rss / 1024, fds))
+    print("         (%dMB before running the engine)" % (rssBefore / 1024))
+
+    # One process per host: the peak memory is roughly the number of hosts
+    # times the memory of one of them.
+    hostFacts.ENGINE = "fabric"
+    with settings(hide("everything"), parallel=True, pool_size=fabricHosts):
+        duration, probed, fds = measure(hostFacts.probeHosts, hostList[:fabricHosts])
+    childRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print("%-8s %6d %8d %9.1fs %8dMB x %d %7d" % ("fabric", fabricHosts, probed, duration,
+                                                 childRss / 1024, fabricHosts, fds))
+
+    standIn.terminate()
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
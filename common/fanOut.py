@@ -0,0 +1,268 @@
+# encoding: utf-8
+
+# Description:
+#   Failure-tolerant fan-out of a task or command to many hosts. Instead of
+#   the first unreachable host aborting everything, the hosts that fail with
+#   a transient error (SSH connection problems) are retried with backoff,
+#   the ones that still fail are quarantined (left out of the next runs
+#   until QUARANTINE_TTL expires) and the run only aborts when more hosts
+#   failed than the failure budget allows. The results of the healthy hosts
+#   are returned, the failed ones are dropped from env.hosts and the roles
+#   so that the rest of the run carries on without them, and every fan-out
+#   prints a table of each host's outcome and adds it to the JSON report of
+#   the fab run.
+
+import os
+import re
+import json
+import math
+import time
+from functools import wraps
+from fabric.api import env, settings, abort, warn
+from fabric.exceptions import NetworkError
+from fabric.tasks import execute
+
+QUARANTINE_DIR = os.path.expanduser("~/.cache/fabric-scripts/quarantine")
+REPORT_DIR = os.path.expanduser("~/.cache/fabric-scripts/reports")
+# Only the most recent reports are kept
+REPORT_KEEP = 20
+
+# Set by the fabfiles. The budget is a number of hosts ("3") or a
+# percentage of them ("5%"). Each fabfile has its own quarantine.
+QUARANTINE_NAME = "default"
+FAILURE_BUDGET = "0"
+RETRIES = 2
+# Seconds before the first retry, doubled for each of the next ones
+RETRY_BACKOFF = 2.0
+QUARANTINE_TTL = 3600
+
+# Failures that are worth trying again: connection problems, and exit
+# status 255, which is what ssh exits with when it loses the connection
+TRANSIENT_ERRORS = re.compile(r"return code 255|timed out|connection|socket|"
+                              r"banner|reset by peer|broken pipe|EOF", re.IGNORECASE)
+
+_reportPath = None
+_reportEntries = []
+
+
+class FanOutAbort(Exception):
+    pass
+
+
+def runTask(task, hosts, *args, **kwargs):
+    """execute() task on every host that isn't quarantined, as failure
+    tolerant as the policy allows. Returns the {host: result} dict of the
+    hosts where it succeeded, aborts if too many failed.
+    """
+    what = kwargs.pop("what", task.__name__)
+
+    @wraps(task)
+    def attempt(*args, **kwargs):
+        # Any failure becomes part of the result, so that one host doesn't
+        # abort the others (or, with @parallel, the whole execute)
+        with settings(abort_exception=FanOutAbort):
+            try:
+                return {"result": task(*args, **kwargs)}
+            except (FanOutAbort, NetworkError, EnvironmentError, EOFError) as e:
+                return {"error": str(e) or e.__class__.__name__}
+
+    def runAttempt(pendingHosts):
+        return dict((host, (outcome.get("error"), outcome.get("result")))
+                    for host, outcome in execute(attempt, *args, hosts=pendingHosts,
+                                                 **kwargs).items())
+
+    return fanOut(what, hosts, runAttempt)
+
+
+def runCommand(hosts, command, what="command", failed=None, **options):
+    """Run command on every host that isn't quarantined with the async
+    engine (same options as asyncEngine.runOnHosts), as failure tolerant as
+    the policy allows. Returns the {host: result} dict of the hosts where
+    it succeeded, aborts if too many failed. failed(result) tells whether
+    a result is a failure, by default any non-zero exit status.
+    """
+    import asyncEngine
+    failed = failed or (lambda result: result.failed)
+
+    def runAttempt(pendingHosts):
+        results = asyncEngine.runOnHosts(pendingHosts, command, **options)
+        return dict((host, (commandError(result) if failed(result) else None, result))
+                    for host, result in results.items())
+
+    return fanOut(what, hosts, runAttempt)
+
+
+def commandError(result):
+    if result.return_code < 0:
+        # Unreachable or timed out (asyncEngine)
+        return "connection: %s" % result.stderr.strip()
+    return "return code %d: %s" % (result.return_code, result.stderr.strip()[:200])
+
+
+def fanOut(what, hosts, runAttempt):
+    # runAttempt(hosts) returns {host: (error or None, result)}
+    quarantine = readQuarantine()
+    entries = dict((host, {"host": host, "task": what, "status": "quarantined",
+                           "attempts": 0, "seconds": 0.0,
+                           "error": quarantine[host]["error"]})
+                   for host in hosts if host in quarantine)
+    pending = [host for host in hosts if host not in quarantine]
+    results = {}
+
+    for attempt in range(RETRIES + 1):
+        if not pending:
+            break
+        if attempt:
+            delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+            print("Retrying %s on %d hosts in %.1fs" % (what, len(pending), delay))
+            time.sleep(delay)
+
+        start = time.time()
+        outcomes = runAttempt(pending)
+        duration = time.time() - start
+        retry = []
+
+        for host in pending:
+            error, result = outcomes.get(host, ("no result", None))
+            entry = entries.setdefault(host, {"host": host, "task": what, "attempts": 0,
+                                              "seconds": 0.0})
+            entry["attempts"] += 1
+            entry["seconds"] += duration
+
+            if error is None:
+                entry.update(status="ok", error=None)
+                results[host] = result
+            else:
+                entry.update(status="failed", error=error)
+                if TRANSIENT_ERRORS.search(error):
+                    retry.append(host)
+
+        pending = retry
+
+    orderedEntries = [entries[host] for host in hosts]
+    printReport(what, orderedEntries)
+    writeReport(orderedEntries)
+
+    failedHosts = sorted(host for host, entry in entries.items() if entry["status"] != "ok")
+    budget = failureBudget(len(hosts))
+    if len(failedHosts) > budget:
+        abort("%s failed on %d hosts, more than the failure budget (%d): %s" %
+              (what, len(failedHosts), budget, ", ".join(failedHosts[:10])))
+
+    # Only the failures the budget tolerates are quarantined, an aborted run
+    # is retried in full
+    if failedHosts:
+        for host in failedHosts:
+            if host not in quarantine:
+                quarantine[host] = {"since": time.time(), "task": what,
+                                    "error": entries[host]["error"]}
+        writeQuarantine(quarantine)
+        excludeHosts(failedHosts)
+        warn("%s failed on %d hosts, carrying on without them: %s" %
+             (what, len(failedHosts), ", ".join(failedHosts[:10])))
+
+    return results
+
+
+def excludeHosts(hosts):
+    """Drop hosts from env.hosts and every role, in place, so that the
+    tasks that come next (and the lists they were given) skip them.
+    """
+    hosts = set(hosts)
+    env.hosts[:] = [host for host in env.hosts if host not in hosts]
+    for roleHosts in env.roledefs.values():
+        roleHosts[:] = [host for host in roleHosts if host not in hosts]
+
+
+def excludeQuarantined():
+    # For the fabfiles to call once the hosts are known
+    quarantined = sorted(host for host in readQuarantine() if host in env.hosts)
+    if quarantined:
+        excludeHosts(quarantined)
+        warn("Leaving out %d quarantined hosts (fab clearQuarantine releases "
+             "them): %s" % (len(quarantined), ", ".join(quarantined[:10])))
+
+
+def failureBudget(hostCount, budget=None):
+    # Number of hosts allowed to fail, e.g. "3" or "5%"
+    budget = str(FAILURE_BUDGET if budget is None else budget).strip()
+    if budget.endswith("%"):
+        return int(math.floor(hostCount * float(budget[:-1]) / 100.0))
+    return int(budget)
+
+
+def quarantinePath():
+    return os.path.join(QUARANTINE_DIR, "%s.json" % QUARANTINE_NAME)
+
+
+def readQuarantine(quarantineFile=None):
+    # Quarantined hosts whose quarantine hasn't expired yet
+    try:
+        with open(quarantineFile or quarantinePath()) as f:
+            quarantine = json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+    now = time.time()
+    return dict((host, entry) for host, entry in quarantine.items()
+                if now - entry["since"] < QUARANTINE_TTL)
+
+
+def writeQuarantine(quarantine, quarantineFile=None):
+    quarantineFile = quarantineFile or quarantinePath()
+    quarantineDir = os.path.dirname(quarantineFile)
+    if not os.path.isdir(quarantineDir):
+        os.makedirs(quarantineDir)
+
+    with open(quarantineFile + ".tmp", "w") as f:
+        json.dump(quarantine, f, indent=1, sort_keys=True)
+    os.rename(quarantineFile + ".tmp", quarantineFile)
+
+
+def clearQuarantine(hosts=None, quarantineFile=None):
+    # Release the given hosts (or every host) from quarantine
+    quarantine = {}
+
+    if hosts is not None:
+        quarantine = readQuarantine(quarantineFile)
+        for host in hosts:
+            quarantine.pop(host, None)
+
+    writeQuarantine(quarantine, quarantineFile)
+
+
+def printReport(what, entries):
+    counts = {}
+    for entry in entries:
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    print("%s: %s" % (what, ", ".join("%d %s" % (count, status)
+                                      for status, count in sorted(counts.items()))))
+
+    # Healthy hosts that needed no retries aren't interesting
+    notable = [entry for entry in entries
+               if entry["status"] != "ok" or entry["attempts"] > 1]
+    if notable:
+        print("  %-40s %-12s %8s  %s" % ("host", "status", "attempts", "error"))
+    for entry in notable:
+        print("  %-40s %-12s %8d  %s" % (entry["host"], entry["status"],
+                                         entry["attempts"], (entry["error"] or "")[:80]))
+
+
+def writeReport(entries):
+    # One JSON report per fab run with the outcome of every fan-out
+    global _reportPath
+
+    if _reportPath is None:
+        _reportPath = os.path.join(REPORT_DIR, "%s-%d.json" %
+                                   (time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+    _reportEntries.extend(entries)
+
+    if not os.path.isdir(REPORT_DIR):
+        os.makedirs(REPORT_DIR)
+    with open(_reportPath, "w") as f:
+        json.dump({"budget": FAILURE_BUDGET, "retries": RETRIES,
+                   "hosts": _reportEntries}, f, indent=1)
+
+    reports = sorted(name for name in os.listdir(REPORT_DIR) if name.endswith(".json"))
+    for name in reports[:-REPORT_KEEP]:
+        os.remove(os.path.join(REPORT_DIR, name))
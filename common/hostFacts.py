@@ -0,0 +1,241 @@
+# encoding: utf-8
+
+# Description:
+#   Collects hardware and network facts (CPUs, memory, network addresses,
+#   block devices and mount points) from the cluster hosts. Every host is
+#   probed with a single combined command, all hosts in parallel, and the
+#   results are cached locally. Each fact expires on its own, so that static
+#   facts (CPUs, memory) aren't probed again just because the mount points
+#   may have changed.
+
+import os
+import re
+import json
+import time
+import tempfile
+from fabric.api import run, settings, hide, abort
+from fabric.decorators import parallel
+
+import fanOut
+
+# Shared by every fabfile in this repository
+FACTS_FILE = os.path.expanduser("~/.cache/fabric-scripts/host-facts.json")
+
+# How long (in seconds) each fact stays valid in the cache
+FACT_EXPIRY = {
+    "cpuCount": 7 * 24 * 3600,
+    "memoryMb": 7 * 24 * 3600,
+    "interfaces": 24 * 3600,
+    "blockDevices": 3600,
+    "mounts": 600,
+}
+ALL_FACTS = sorted(FACT_EXPIRY)
+
+# "fabric" probes the hosts with @parallel, "async" with asyncEngine.py
+# (which needs Python 3 and asyncssh). Set by the fabfiles.
+ENGINE = "fabric"
+
+PROBE_COMMAND = " ; ".join([
+    "echo '### cpuCount'", "nproc",
+    "echo '### memoryMb'", "grep MemTotal /proc/meminfo",
+    "echo '### interfaces'", "ip -o -4 addr show",
+    "echo '### blockDevices'", "lsblk -b -n -P -o NAME,TYPE,SIZE,MOUNTPOINT,FSTYPE,ROTA,PKNAME",
+    "echo '### mounts'", "df -P -k",
+])
+
+
+def gatherFacts(hosts, names=ALL_FACTS, factsFile=FACTS_FILE):
+    """Return a {host: {fact: value}} dict with the requested facts of every
+    host. Only hosts with missing or expired facts are probed. Hosts that
+    couldn't be probed (within the failure budget of fanOut.py) are left
+    out.
+    """
+    cache = readFactsCache(factsFile)
+    now = time.time()
+    staleHosts = []
+
+    for host in hosts:
+        hostCache = cache.get(host, {})
+        for name in names:
+            if name not in hostCache or \
+                    now - hostCache[name]["time"] > FACT_EXPIRY[name]:
+                staleHosts.append(host)
+                break
+
+    unprobedHosts = set()
+    if staleHosts:
+        probedFacts = probeHosts(staleHosts)
+        unprobedHosts = set(staleHosts) - set(probedFacts)
+        for host, facts in probedFacts.items():
+            cache[host] = dict((name, {"time": now, "value": value})
+                               for name, value in facts.items())
+        writeFactsCache(factsFile, cache)
+
+    return dict((host, dict((name, cache[host][name]["value"]) for name in names))
+                for host in hosts if host not in unprobedHosts)
+
+
+def clearFacts(hosts=None, factsFile=FACTS_FILE):
+    # Forget the facts of the given hosts (or of every host)
+    cache = {}
+
+    if hosts is not None:
+        cache = readFactsCache(factsFile)
+        for host in hosts:
+            cache.pop(host, None)
+
+    writeFactsCache(factsFile, cache)
+
+
+def privateIp(hostFacts, interface):
+    return hostFacts["interfaces"].get(interface)
+
+
+def privateIps(facts, interface):
+    """Return a {host: IP of interface} dict of the hosts in facts (from
+    gatherFacts with "interfaces"). Hosts without an address on interface
+    count as failed against the failure budget of fanOut.py, like the
+    unreachable ones, and are left out.
+    """
+    def runAttempt(hosts):
+        outcomes = {}
+        for host in hosts:
+            address = privateIp(facts[host], interface)
+            if address:
+                outcomes[host] = (None, address)
+            else:
+                outcomes[host] = ("no address on %s (interfaces: %s)" % (
+                    interface, ", ".join(sorted(facts[host]["interfaces"])) or "none"), None)
+        return outcomes
+
+    return fanOut.fanOut("Finding the %s addresses" % interface, sorted(facts), runAttempt)
+
+
+def dataDisks(hostFacts, reformat=False, exclude=()):
+    # Whole, non-empty disks that are neither partitioned nor mounted and
+    # don't hold a filesystem (or LVM, RAID...) unless reformat is set.
+    # exclude has device names (e.g. "xvdb") that are never data disks.
+    devices = hostFacts["blockDevices"]
+    partitioned = set(device["parent"] for device in devices if device["parent"])
+
+    return [device for device in devices
+            if device["type"] == "disk" and device["sizeBytes"] > 0 and
+            not device["mountpoint"] and device["name"] not in partitioned and
+            (reformat or not device["fstype"]) and device["name"] not in exclude]
+
+
+def printFacts(facts):
+    print("%-30s %5s %9s %6s  %s" % ("host", "cpus", "memory", "disks", "addresses"))
+
+    for host in sorted(facts):
+        hostFacts = facts[host]
+        print("%-30s %5s %7sMB %6d  %s" % (host, hostFacts["cpuCount"],
+            hostFacts["memoryMb"], len(dataDisks(hostFacts)),
+            ", ".join("%s=%s" % item for item in sorted(hostFacts["interfaces"].items()))))
+
+
+def probeHosts(hosts):
+    if ENGINE != "async":
+        return fanOut.runTask(probeHostFacts, hosts, what="Probing the host facts")
+
+    # As with fabric, only unreachable hosts (and ssh's own exit status)
+    # count as failures
+    with settings(hide("stdout")):
+        results = fanOut.runCommand(hosts, PROBE_COMMAND, "Probing the host facts",
+                                    lambda result: result.return_code in (-2, -1, 255))
+
+    return dict((host, parseProbeOutput(result)) for host, result in results.items())
+
+
+@parallel
+def probeHostFacts():
+    with settings(hide("stdout"), warn_only=True):
+        output = run(PROBE_COMMAND, pty=False)
+
+    # 255 is ssh's own exit status, not one of the probes'
+    if output.return_code == 255:
+        abort("Probing the host facts failed with return code 255")
+
+    return parseProbeOutput(output)
+
+
+def parseProbeOutput(output):
+    sections = {}
+    currentSection = None
+
+    for line in output.splitlines():
+        if line.startswith("### "):
+            currentSection = line[4:].strip()
+            sections[currentSection] = []
+        elif currentSection and line.strip():
+            sections[currentSection].append(line.strip())
+
+    facts = {}
+
+    cpuLines = sections.get("cpuCount", [])
+    facts["cpuCount"] = int(cpuLines[0]) if cpuLines else None
+
+    memoryLines = sections.get("memoryMb", [])
+    facts["memoryMb"] = int(memoryLines[0].split()[1]) // 1024 if memoryLines else None
+
+    # e.g. 2: eth0    inet 10.0.0.12/24 brd 10.0.0.255 scope global eth0
+    facts["interfaces"] = {}
+    for line in sections.get("interfaces", []):
+        fields = line.split()
+        if len(fields) > 3 and fields[2] == "inet":
+            facts["interfaces"][fields[1]] = fields[3].split("/")[0]
+
+    # e.g. NAME="xvdb1" TYPE="part" SIZE="42949672960" MOUNTPOINT="" FSTYPE=""
+    #      ROTA="0" PKNAME="xvdb"
+    facts["blockDevices"] = []
+    for line in sections.get("blockDevices", []):
+        fields = dict(re.findall(r'(\w+)="([^"]*)"', line))
+        if "NAME" not in fields:
+            continue
+        facts["blockDevices"].append({
+            "name": fields["NAME"],
+            "type": fields["TYPE"],
+            "sizeBytes": int(fields["SIZE"] or 0),
+            "mountpoint": fields["MOUNTPOINT"],
+            "fstype": fields["FSTYPE"],
+            "rotational": fields["ROTA"] == "1",
+            "parent": fields.get("PKNAME") or None,
+        })
+
+    # e.g. /dev/xvda1  8115168 1650644 6028660 22% /
+    facts["mounts"] = {}
+    for line in sections.get("mounts", [])[1:]:
+        fields = line.split()
+        if len(fields) >= 6:
+            facts["mounts"][fields[5]] = {
+                "device": fields[0],
+                "sizeKb": int(fields[1]),
+                "availableKb": int(fields[3]),
+            }
+
+    return facts
+
+
+def readFactsCache(factsFile):
+    try:
+        with open(factsFile) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def writeFactsCache(factsFile, cache):
+    factsDir = os.path.dirname(factsFile)
+    if not os.path.isdir(factsDir):
+        os.makedirs(factsDir)
+
+    # A temporary file of its own, so that concurrent fab runs don't mix
+    # their writes
+    fd, tmpPath = tempfile.mkstemp(dir=factsDir, prefix=".host-facts-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.rename(tmpPath, factsFile)
+    except BaseException:
+        os.remove(tmpPath)
+        raise
@@ -0,0 +1,44 @@
+# encoding: utf-8
+
+# Description:
+#   Roles of the hosts of a cluster (namenode, slave, nagios-master, ...).
+#   Each fabfile defines which hosts have which roles and its tasks declare
+#   the roles they have work on, so that fab and execute() only connect to
+#   those hosts instead of to every host in env.hosts, with the task
+#   returning early on most of them.
+
+from functools import wraps
+from fabric.api import env
+from fabric.decorators import roles
+
+
+def define(roleHosts):
+    """Set env.roledefs from a {role: [hosts]} dict, without empty hosts."""
+    env.roledefs = dict((role, [host for host in hosts if host])
+                        for role, hosts in roleHosts.items())
+
+
+def hostsWithRole(role):
+    return env.roledefs.get(role, [])
+
+
+def hasRole(host, roleNames):
+    return any(host in hostsWithRole(role) for role in roleNames)
+
+
+def targets(*roleNames):
+    """Only run the decorated task on the hosts with any of the given roles.
+    fab and execute() don't connect to the other hosts at all (fabric's
+    @roles, unless given explicit hosts), and calling it from another task
+    on a host without those roles does nothing.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not hasRole(env.host, roleNames):
+                return None
+            return function(*args, **kwargs)
+
+        return roles(*roleNames)(wrapper)
+
+    return decorator
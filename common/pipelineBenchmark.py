@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Description:
+#   Measures the per-command latency of running commands one by one versus
+#   pipelining them (see remotePipeline.py), without needing a cluster. The
+#   commands run on this machine through a minimal SSH server (paramiko)
+#   sitting behind a proxy that delays the traffic to simulate the round
+#   trip time of a remote link.
+#
+#   ./pipelineBenchmark.py [rttMs ...]
+
+import sys
+import time
+import socket
+import subprocess
+import threading
+import paramiko
+from fabric.api import env, hide
+from fabric.network import disconnect_all
+
+import remotePipeline
+
+COMMAND_COUNT = 20
+DEFAULT_RTTS_MS = [0, 20, 80, 150]
+
+
+class StandInServer(paramiko.ServerInterface):
+    # Accepts any password and runs every command locally
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=executeCommand, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+def executeCommand(channel, command):
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    channel.sendall(stdout)
+    channel.sendall_stderr(stderr)
+    channel.send_exit_status(process.returncode)
+    channel.close()
+
+
+def listen():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+    return listener
+
+
+def startInBackground(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+def serveSSH(listener, hostKey):
+    while True:
+        connection, _ = listener.accept()
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(hostKey)
+        transport.start_server(server=StandInServer())
+
+
+def serveDelayProxy(listener, targetPort, rttSeconds):
+    while True:
+        client, _ = listener.accept()
+        server = socket.create_connection(("127.0.0.1", targetPort))
+        for source, destination in [(client, server), (server, client)]:
+            startInBackground(delayedPump, source, destination, rttSeconds / 2)
+
+
+def delayedPump(source, destination, delay):
+    # Forward every chunk once it has been "in flight" for delay seconds
+    pending = []
+    condition = threading.Condition()
+
+    def send():
+        while True:
+            with condition:
+                while not pending:
+                    condition.wait()
+                due, data = pending.pop(0)
+            time.sleep(max(0, due - time.time()))
+            if not data:
+                destination.shutdown(socket.SHUT_WR)
+                return
+            destination.sendall(data)
+
+    startInBackground(send)
+
+    while True:
+        try:
+            data = source.recv(65536)
+        except socket.error:
+            data = b""
+        with condition:
+            pending.append((time.time() + delay, data))
+            condition.notify()
+        if not data:
+            return
+
+
+def main(rttsMs):
+    sshListener = listen()
+    startInBackground(serveSSH, sshListener, paramiko.RSAKey.generate(2048))
+
+    env.password = "stand-in"
+    env.disable_known_hosts = True
+    env.abort_on_prompts = True
+    # The login profile of this machine has nothing to do with the latency
+    env.shell = "/bin/sh -c"
+
+    print("%8s %14s %14s %8s" % ("rtt", "sequential", "pipelined", "speedup"))
+    for rttMs in rttsMs:
+        proxyListener = listen()
+        startInBackground(serveDelayProxy, proxyListener,
+                          sshListener.getsockname()[1], rttMs / 1000.0)
+
+        env.host_string = "stand-in@127.0.0.1:%d" % proxyListener.getsockname()[1]
+        sequential, pipelined = remotePipeline.measurePipelining(COMMAND_COUNT)
+        with hide("status"):
+            disconnect_all()
+
+        print("%6dms %11.1fms/cmd %11.1fms/cmd %7.1fx" % (rttMs,
+            sequential * 1000, pipelined * 1000, sequential / pipelined))
+
+
+if __name__ == "__main__":
+    main([int(rtt) for rtt in sys.argv[1:]] or DEFAULT_RTTS_MS)
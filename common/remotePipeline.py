@@ -0,0 +1,110 @@
+# encoding: utf-8
+
+# Description:
+#   Runs several independent commands on a host in a single remote shell
+#   invocation instead of paying one round trip (and, with sudo, one new
+#   shell) per command. Fabric already keeps one SSH connection per host and
+#   opens a channel on it for every command; on high latency links it is
+#   those per-command round trips that add up.
+
+import re
+import time
+from fabric.api import run, sudo, env, settings, hide, abort
+
+# Set to False to run the commands one by one (e.g. when debugging)
+PIPELINING_ENABLED = True
+
+MARKER = "__fab_pipeline__"
+# The end marker of a command follows its output on the same line when the
+# output doesn't end with a newline
+END_MARKER = re.compile(r"%s(\d+):(\d+)$" % MARKER)
+
+
+class PipelineResult(str):
+    pass
+
+
+def pipelineScript(commands):
+    # Every command runs in its own subshell, so that directory changes,
+    # variables and exits don't leak into the following ones, just as if
+    # they were run separately.
+    return "; ".join("echo %(marker)s%(i)d; (%(command)s) 2>&1; echo %(marker)s%(i)d:$?" %
+                     {"marker": MARKER, "i": i, "command": command}
+                     for i, command in enumerate(commands))
+
+
+def parsePipelineOutput(output, commands):
+    outputs = [[] for _ in commands]
+    statuses = [None] * len(commands)
+    current = None
+
+    for line in output.splitlines():
+        endMarker = END_MARKER.search(line)
+        if endMarker:
+            if current is not None and endMarker.start():
+                outputs[current].append(line[:endMarker.start()])
+            statuses[int(endMarker.group(1))] = int(endMarker.group(2))
+            current = None
+        elif line.startswith(MARKER) and line[len(MARKER):].isdigit():
+            current = int(line[len(MARKER):])
+        elif current is not None:
+            outputs[current].append(line)
+
+    results = []
+    for command, lines, status in zip(commands, outputs, statuses):
+        result = PipelineResult("\n".join(lines))
+        result.command = command
+        # A missing status means the remote shell died before getting there
+        result.return_code = status if status is not None else -1
+        result.failed = result.return_code != 0
+        result.succeeded = not result.failed
+        results.append(result)
+
+    return results
+
+
+def runPipelined(commands, useSudo=False):
+    """Run the commands, in order, in a single remote shell and return one
+    result (output, return_code, failed, succeeded) per command. As with
+    run, a failed command aborts unless warn_only is set, but only once all
+    of them have run.
+    """
+    operation = sudo if useSudo else run
+
+    if not commands:
+        return []
+
+    if PIPELINING_ENABLED:
+        with settings(hide("stdout"), warn_only=True):
+            output = operation(pipelineScript(commands), pty=False)
+        results = parsePipelineOutput(output, commands)
+    else:
+        with settings(warn_only=True):
+            results = [operation(command) for command in commands]
+
+    for result, command in zip(results, commands):
+        if result.failed and not env.warn_only:
+            abort("Pipelined command failed with status %s: %s\n%s" %
+                  (result.return_code, command, result))
+
+    return results
+
+
+def measurePipelining(commandCount=20, command="true"):
+    """Return the average seconds per command when running commandCount
+    commands one by one and when pipelining them on the current host.
+    """
+    with settings(hide("everything")):
+        # Make sure the connection is already open
+        run(command)
+
+        start = time.time()
+        for _ in range(commandCount):
+            run(command)
+        sequential = (time.time() - start) / commandCount
+
+        start = time.time()
+        runPipelined([command] * commandCount)
+        pipelined = (time.time() - start) / commandCount
+
+    return sequential, pipelined
@@ -0,0 +1,230 @@
+# encoding: utf-8
+
+# Description:
+#   Times every remote operation (run, sudo, put and get) of a fab run and
+#   records its host, task, command, duration, bytes transferred and exit
+#   status. Each operation appends one line to a records file (parallel
+#   tasks run in separate processes), which is turned into a Chrome trace
+#   (chrome://tracing or ui.perfetto.dev) when fab exits.
+
+import os
+import json
+import time
+import atexit
+from fabric import operations, sftp
+from fabric.api import env
+
+# Shared by every fabfile in this repository
+TRACE_DIR = os.path.expanduser("~/.cache/fabric-scripts/traces")
+# Only the most recent traces are kept
+TRACE_KEEP = 20
+TRACE_ENABLED = True
+
+_recordsPath = None
+_recordsFd = None
+_mainPid = None
+
+
+def install(traceDir=TRACE_DIR):
+    """Start timing the remote operations of this fab run. Safe to call from
+    several modules, only the first call has any effect.
+    """
+    global _recordsPath, _mainPid
+
+    if not TRACE_ENABLED or _recordsPath is not None:
+        return
+
+    _mainPid = os.getpid()
+    _recordsPath = os.path.join(traceDir, "%s-%d.jsonl" %
+                                (time.strftime("%Y%m%d-%H%M%S"), _mainPid))
+
+    operations._run_command = timedCommand(operations._run_command)
+    sftp.SFTP.put = timedTransfer("put", sftp.SFTP.put)
+    sftp.SFTP.get = timedTransfer("get", sftp.SFTP.get)
+    atexit.register(finishTrace)
+
+
+def timedCommand(runCommand):
+    def wrapper(command, *args, **kwargs):
+        start = time.time()
+        status = "aborted"
+        outputBytes = 0
+
+        try:
+            result = runCommand(command, *args, **kwargs)
+            status = result.return_code
+            outputBytes = len(result) + len(result.stderr or "")
+            return result
+        finally:
+            record("sudo" if kwargs.get("sudo") else "run", command, start,
+                   outputBytes, status)
+
+    return wrapper
+
+
+def timedTransfer(operation, transfer):
+    def wrapper(self, *args, **kwargs):
+        # put(local_path, remote_path, ...) and get(remote_path, local_path, ...)
+        localPath, remotePath = args[:2] if operation == "put" else args[1::-1]
+        start = time.time()
+        status = "aborted"
+
+        try:
+            result = transfer(self, *args, **kwargs)
+            status = 0
+            return result
+        finally:
+            record(operation, remotePath, start, localSize(localPath), status)
+
+    return wrapper
+
+
+def localSize(localPath):
+    try:
+        if hasattr(localPath, "getvalue"):
+            return len(localPath.getvalue())
+        if hasattr(localPath, "tell"):
+            return localPath.tell()
+        return os.path.getsize(localPath)
+    except (OSError, TypeError):
+        return 0
+
+
+def record(operation, command, start, transferredBytes, status, host=None):
+    global _recordsFd
+
+    if _recordsPath is None:
+        return
+
+    line = json.dumps({
+        "host": host or env.host_string,
+        "task": env.command,
+        "operation": operation,
+        "command": command,
+        "start": start,
+        "duration": time.time() - start,
+        "bytes": transferredBytes,
+        "status": status,
+        "pid": os.getpid(),
+    }) + "\n"
+
+    # A single unbuffered append per record, so that the records of the
+    # parallel processes don't get interleaved or duplicated when forking
+    if _recordsFd is None:
+        if not os.path.isdir(os.path.dirname(_recordsPath)):
+            os.makedirs(os.path.dirname(_recordsPath))
+        _recordsFd = os.open(_recordsPath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    os.write(_recordsFd, line.encode("utf-8"))
+
+
+def finishTrace():
+    # Forked fabric processes exit without running this, but be safe anyway
+    if os.getpid() != _mainPid or not os.path.isfile(_recordsPath):
+        return
+
+    records = readRecords(_recordsPath)
+    tracePath = _recordsPath[:-len(".jsonl")] + ".json"
+    writeChromeTrace(tracePath, records)
+    os.remove(_recordsPath)
+    pruneTraces(os.path.dirname(tracePath))
+
+    print("Timed %d remote operations (%.1fs in total), trace written to %s" %
+          (len(records), sum(r["duration"] for r in records), tracePath))
+
+
+def currentRecords():
+    # The records of this fab run so far
+    if _recordsPath is None or not os.path.isfile(_recordsPath):
+        return []
+    return readRecords(_recordsPath)
+
+
+def readRecords(recordsPath):
+    with open(recordsPath) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def writeChromeTrace(tracePath, records):
+    # One trace process per host, one thread per fabric process
+    hosts = sorted(set(r["host"] for r in records if r["host"]))
+    hostIds = dict((host, i + 1) for i, host in enumerate(hosts))
+    origin = min(r["start"] for r in records) if records else 0
+
+    events = [{"name": "process_name", "ph": "M", "pid": hostIds[host],
+               "args": {"name": host}} for host in hosts]
+
+    for r in records:
+        events.append({
+            "name": "%s: %s" % (r["operation"], r["command"][:80]),
+            "cat": r["task"] or "fab",
+            "ph": "X",
+            "ts": int((r["start"] - origin) * 1e6),
+            "dur": int(r["duration"] * 1e6),
+            "pid": hostIds.get(r["host"], 0),
+            "tid": r["pid"],
+            "args": r,
+        })
+
+    with open(tracePath, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def readChromeTrace(tracePath):
+    with open(tracePath) as f:
+        return [event["args"] for event in json.load(f)["traceEvents"]
+                if event["ph"] == "X"]
+
+
+def loadTrace(tracePath=None):
+    # The records of the given trace, or of the latest one
+    tracePath = tracePath or latestTrace()
+    return readChromeTrace(tracePath) if tracePath else []
+
+
+def latestTrace(traceDir=TRACE_DIR):
+    traces = sorted(name for name in os.listdir(traceDir) if name.endswith(".json")) \
+        if os.path.isdir(traceDir) else []
+    return os.path.join(traceDir, traces[-1]) if traces else None
+
+
+def pruneTraces(traceDir, keep=TRACE_KEEP):
+    traces = sorted(name for name in os.listdir(traceDir) if name.endswith(".json"))
+    for name in traces[:-keep]:
+        os.remove(os.path.join(traceDir, name))
+
+
+def summarize(records, key):
+    # {key: [count, total seconds, slowest seconds, bytes, failures]}
+    groups = {}
+
+    for r in records:
+        group = groups.setdefault(key(r), [0, 0.0, 0.0, 0, 0])
+        group[0] += 1
+        group[1] += r["duration"]
+        group[2] = max(group[2], r["duration"])
+        group[3] += r["bytes"]
+        group[4] += 1 if r["status"] != 0 else 0
+
+    return sorted(groups.items(), key=lambda item: item[1][1], reverse=True)
+
+
+def printSummary(records, top=10):
+    if not records:
+        print("No remote operations recorded")
+        return
+
+    wallTime = max(r["start"] + r["duration"] for r in records) - \
+        min(r["start"] for r in records)
+    print("%d remote operations on %d hosts, %.1fs wall time" %
+          (len(records), len(set(r["host"] for r in records)), wallTime))
+
+    for title, key in [("host", lambda r: r["host"]),
+                       ("task", lambda r: r["task"]),
+                       ("command", lambda r: "%s: %s" % (r["operation"], r["command"][:60]))]:
+        print("")
+        print("%-68s %6s %9s %8s %10s %6s" % ("slowest " + title + "s", "count",
+                                            "total", "max", "bytes", "failed"))
+        for name, (count, total, slowest, transferred, failed) in \
+                summarize(records, key)[:top]:
+            print("%-68s %6d %8.1fs %7.1fs %10d %6d" % (str(name)[:68], count,
+                                                      total, slowest, transferred, failed))
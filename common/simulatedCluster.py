@@ -0,0 +1,606 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Description:
+#   Runs fabfile tasks end to end against a simulated cluster of 10, 100 or
+#   1000 hosts on this machine, to benchmark deployments (and catch changes
+#   that make them issue more remote commands) without any real hosts.
+#
+#   Every simulated host is a user of a local SSH stand-in (asyncssh, in a
+#   separate process) and owns a sandbox directory. Its commands run in their
+#   own user and mount namespaces, with overlays on /etc, /home, /mnt, /opt,
+#   /usr/local and /var (and its own /tmp) writing into the sandbox, the rest
+#   of the system read-only, and stubs for the commands that would change the
+#   system or need real hardware (sudo, package managers, mkfs, jps...). The
+#   packages the fabfiles install are replaced by small fake ones. Each
+#   command and file transfer can be given an extra latency and a
+#   probability of failing.
+#
+#   Needs Linux with unprivileged user namespaces and overlayfs (5.11+),
+#   unshare (util-linux) and asyncssh (pip install asyncssh).
+#
+#   ./simulatedCluster.py ../hadoop-yarn/fabfile.py bootstrap,config,setupHosts,install \
+#       --nodes 10,100,1000 --latency-ms 20 --failure-rate 0.001 \
+#       --baseline ../hadoop-yarn/simulatedClusterBaseline.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import asyncio
+import tarfile
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+import multiprocessing
+from io import BytesIO
+
+# The fabfiles and the common modules keep their caches (artifacts, host
+# facts, traces...) under ~/.cache, keep the simulated runs away from them
+WORK_DIR = tempfile.mkdtemp(prefix="simulatedCluster-")
+os.environ["HOME"] = os.path.join(WORK_DIR, "home")
+
+import asyncssh
+import fabric.network
+from fabric.api import env, settings, hide
+from fabric.network import disconnect_all
+from fabric.tasks import execute
+from fabric.main import parse_arguments
+
+import artifactCache
+import asyncEngine
+import hostFacts
+import remoteTiming
+
+remoteTiming.install()
+
+DEFAULT_NODES = [10, 100, 1000]
+# Hosts worked on at the same time by the tasks that aren't @runs_once
+# (like fab -P -z)
+DEFAULT_POOL_SIZE = 20
+
+# Directories each simulated host gets its own (copy on write) version of
+OVERLAY_DIRS = ["/etc", "/home", "/mnt", "/opt", "/root", "/usr/local", "/var"]
+
+# Commands that only succeed (and do nothing) on the simulated hosts
+NOOP_COMMANDS = ["apt-get", "yum", "pacman", "add-apt-repository", "debconf-set-selections",
+                 "mkfs", "mkfs.ext4", "mkfs.xfs", "mount", "umount", "chown", "service",
+                 "update-rc.d", "a2enmod", "useradd", "groupadd", "usermod", "htpasswd",
+                 "make", "jps", "java", "cpanm"]
+
+NOOP_SCRIPT = "#!/bin/sh\nexit 0\n"
+
+STUBS = {
+    # Simulated commands already run as (namespace) root
+    "sudo": """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case $1 in
+        -p|-u|-g|-C) shift 2;;
+        --) shift; break;;
+        -*) shift;;
+        *) break;;
+    esac
+done
+exec "$@"
+""",
+    "ip": """#!/bin/sh
+echo "1: lo    inet 127.0.0.1/8 scope host lo"
+echo "2: eth0    inet $SIMULATED_IP/16 brd 10.0.255.255 scope global eth0"
+""",
+    "ifconfig": """#!/bin/sh
+echo "eth0      Link encap:Ethernet"
+echo "          inet addr:$SIMULATED_IP  Bcast:10.0.255.255  Mask:255.255.0.0"
+""",
+    "wget": """#!/bin/sh
+echo "wget: no network on simulated hosts" >&2
+exit 4
+""",
+}
+
+# Runs in new user and mount namespaces: <hostDir> <workDir> <user> <command>
+ENTER_SCRIPT = """
+hostDir=$1 workDir=$2
+for dir in $OVERLAY_DIRS; do
+    mkdir -p "$hostDir$dir" "$workDir$dir"
+    # The stubs are an extra layer below /usr/local/sbin
+    lower=$dir
+    if [ -d "$STUBS_DIR$dir" ]; then lower=$STUBS_DIR$dir:$dir; fi
+    # Directories with mounts below them can't be overlaid, they start empty
+    mount -t overlay overlay -o "lowerdir=$lower,upperdir=$hostDir$dir,workdir=$workDir$dir" "$dir" \
+        2> /dev/null || mount --bind "$hostDir$dir" "$dir" || exit 255
+done
+mkdir -p "$hostDir/tmp"
+mount --bind "$hostDir/tmp" /tmp || exit 255
+mount -o remount,bind,ro / || exit 255
+
+export HOME=/home/$3 USER=$3 LOGNAME=$3 PATH="/usr/local/sbin:$PATH"
+mkdir -p "$HOME" && cd "$HOME" || exit 255
+exec /bin/sh -c "$4"
+"""
+
+# Simulated hosts start with Ubuntu's ~/.profile (which loads ~/.bashrc) and
+# without this machine's /etc/profile
+HOME_PROFILE = """if [ -n "$BASH_VERSION" ] && [ -f "$HOME/.bashrc" ]; then
+    . "$HOME/.bashrc"
+fi
+"""
+SYSTEM_PROFILE = "export PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin\n"
+
+# What the fabfiles expect to find in the packages they install
+EMPTY_SITE_FILE = '<?xml version="1.0"?>\n<configuration>\n</configuration>\n'
+FAKE_PACKAGE_FILES = dict([
+    ("configure", NOOP_SCRIPT),
+    ("bin/hadoop", NOOP_SCRIPT),
+    ("bin/hdfs", NOOP_SCRIPT),
+    ("bin/yarn", NOOP_SCRIPT),
+    ("bin/mapred", NOOP_SCRIPT),
+    ("sbin/hadoop-daemon.sh", NOOP_SCRIPT),
+    ("sbin/yarn-daemon.sh", NOOP_SCRIPT),
+    ("sbin/mr-jobhistory-daemon.sh", NOOP_SCRIPT),
+] + [("etc/hadoop/%s" % name, EMPTY_SITE_FILE) for name in
+     ["core-site.xml", "hdfs-site.xml", "yarn-site.xml", "mapred-site.xml"]])
+
+_standInPort = None
+
+
+# CLUSTER LAYOUTS
+# Point the (freshly loaded) fabfile module at nodeCount simulated hosts
+def layoutHadoopYarn(fabfile, nodeCount):
+    fabfile.EC2 = False
+    fabfile.NAMENODE_HOST = fabfile.RESOURCEMANAGER_HOST = "master.sim"
+    fabfile.SLAVE_HOSTS = ["slave%04d.sim" % i for i in range(1, nodeCount)]
+    fabfile.JOBTRACKER_HOST = fabfile.JOBHISTORY_HOST = fabfile.SLAVE_HOSTS[0]
+    fabfile.NET_INTERFACE = "eth0"
+    # Every simulated host would serve the package on the same local port
+    fabfile.HADOOP_PACKAGE_FANOUT = False
+    fabfile.bootstrapFabric()
+
+
+def layoutNagios(fabfile, nodeCount):
+    fabfile.CLUSTER_MASTER = "master.sim"
+    fabfile.CLUSTER_WORKERS = ["master.sim"] + ["worker%04d.sim" % i for i in range(1, nodeCount)]
+    fabfile.NET_INTERFACE = "eth0"
+    fabfile.bootstrapFabric()
+
+
+def layoutJenkins(fabfile, nodeCount):
+    fabfile.JENKINS_MASTER_HOST = "master.sim"
+    fabfile.JENKINS_SLAVE_HOSTS = ["slave%04d.sim" % i for i in range(1, nodeCount)]
+    env.hosts = []
+    fabfile.bootstrapFabric()
+
+
+CLUSTER_LAYOUTS = {
+    "hadoop-yarn": layoutHadoopYarn,
+    "jenkins": layoutJenkins,
+    "nagios": layoutNagios,
+}
+
+
+# SIMULATED HOSTS (stand-in process)
+class StandInServer(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        # Every simulated host is let in without authentication
+        return False
+
+
+class SandboxSFTPServer(asyncssh.SFTPServer):
+    # Files of the overlaid directories and /tmp are read from the host's
+    # sandbox (falling back to the real file for the overlays) and always
+    # written there. Everything else is read-only.
+
+    WRITE_FLAGS = asyncssh.FXF_WRITE | asyncssh.FXF_CREAT | asyncssh.FXF_TRUNC | \
+        asyncssh.FXF_APPEND
+
+    def __init__(self, chan, sandboxDir, latency):
+        super().__init__(chan)
+        user, _, host = chan.get_extra_info("username").partition("/")
+        self._home = ("/home/%s" % user).encode()
+        self._hostDir = os.path.join(sandboxDir, host).encode()
+        self._latency = latency
+        self._writing = False
+
+    def map_path(self, path):
+        path = os.path.normpath(os.path.join(self._home, path))
+        sandboxed = path == b"/tmp" or path.startswith(b"/tmp/") or \
+            any(path == d or path.startswith(d + b"/")
+                for d in [d.encode() for d in OVERLAY_DIRS])
+
+        if not sandboxed:
+            if self._writing:
+                raise asyncssh.SFTPPermissionDenied("Read-only file system")
+            return path
+
+        localPath = self._hostDir + path
+        if self._writing:
+            parent = os.path.dirname(path)
+            if os.path.isdir(parent) and not os.path.isdir(os.path.dirname(localPath)):
+                os.makedirs(os.path.dirname(localPath))
+            return localPath
+
+        if path.startswith(b"/tmp") or os.path.lexists(localPath):
+            return localPath
+        return path
+
+    def reverse_map_path(self, path):
+        if path.startswith(self._hostDir + b"/"):
+            return path[len(self._hostDir):]
+        return path
+
+    def writing(self, method, *args):
+        self._writing = True
+        try:
+            return method(*args)
+        finally:
+            self._writing = False
+
+    async def open(self, path, pflags, attrs):
+        await asyncio.sleep(self._latency)
+        if pflags & self.WRITE_FLAGS:
+            return self.writing(super().open, path, pflags, attrs)
+        return super().open(path, pflags, attrs)
+
+    def mkdir(self, path, attrs):
+        return self.writing(super().mkdir, path, attrs)
+
+    def setstat(self, path, attrs):
+        return self.writing(super().setstat, path, attrs)
+
+    def remove(self, path):
+        return self.writing(super().remove, path)
+
+    def rmdir(self, path):
+        return self.writing(super().rmdir, path)
+
+    def rename(self, oldPath, newPath):
+        return self.writing(super().rename, oldPath, newPath)
+
+    def posix_rename(self, oldPath, newPath):
+        return self.writing(super().posix_rename, oldPath, newPath)
+
+
+def serveCluster(port, hostIps, sandboxDir, latency, failureRate, seed, ready):
+    failures = random.Random(seed)
+    enterScript = os.path.join(sandboxDir, ".enter.sh")
+    stubsDir = os.path.join(sandboxDir, ".stubs")
+    commandEnv = dict(os.environ, OVERLAY_DIRS=" ".join(
+        d for d in OVERLAY_DIRS if os.path.isdir(d)), STUBS_DIR=stubsDir)
+
+    async def handleProcess(process):
+        user, _, host = process.get_extra_info("username").partition("/")
+        await asyncio.sleep(latency)
+
+        if failures.random() < failureRate:
+            process.stderr.write("simulated failure on %s\n" % host)
+            process.exit(255)
+            return
+
+        workDir = tempfile.mkdtemp(dir=os.path.join(sandboxDir, ".work"))
+        command = await asyncio.create_subprocess_exec(
+            "unshare", "-rm", "/bin/sh", enterScript, os.path.join(sandboxDir, host),
+            workDir, user, process.command or "true",
+            env=dict(commandEnv, SIMULATED_HOST=host, SIMULATED_IP=hostIps[host]),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        feed = asyncio.ensure_future(copyInput(process.stdin, command.stdin))
+
+        stdout, stderr = await asyncio.gather(command.stdout.read(), command.stderr.read())
+        await command.wait()
+        feed.cancel()
+        shutil.rmtree(workDir, ignore_errors=True)
+
+        process.stdout.write(stdout.decode("utf-8", "replace"))
+        process.stderr.write(stderr.decode("utf-8", "replace"))
+        process.exit(command.returncode)
+
+    async def serve():
+        await asyncssh.create_server(StandInServer, "127.0.0.1", port,
+            server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")],
+            process_factory=handleProcess, line_editor=False, backlog=4096,
+            sftp_factory=lambda chan: SandboxSFTPServer(chan, sandboxDir, latency))
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def copyInput(source, destination):
+    # fabric never closes the input of commands run with a pty, so this
+    # simply stops when the command is done
+    try:
+        while True:
+            data = await source.read(65536)
+            if not data:
+                break
+            destination.write(data.encode("utf-8"))
+            await destination.drain()
+        destination.close()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+
+
+def prepareSandbox(sandboxDir, hosts, user):
+    os.makedirs(os.path.join(sandboxDir, ".work"))
+    stubsDir = os.path.join(sandboxDir, ".stubs", "usr", "local", "sbin")
+    os.makedirs(stubsDir)
+
+    for name, contents in list(STUBS.items()) + [(name, NOOP_SCRIPT) for name in NOOP_COMMANDS]:
+        writeFile(os.path.join(stubsDir, name), contents, 0o755)
+    writeFile(os.path.join(sandboxDir, ".enter.sh"), ENTER_SCRIPT)
+
+    for host in hosts:
+        hostDir = os.path.join(sandboxDir, host)
+        writeFile(os.path.join(hostDir, "home", user, ".profile"), HOME_PROFILE)
+        writeFile(os.path.join(hostDir, "etc", "profile"), SYSTEM_PROFILE)
+
+
+def writeFile(filePath, contents, mode=0o644):
+    if not os.path.isdir(os.path.dirname(filePath)):
+        os.makedirs(os.path.dirname(filePath))
+    with open(filePath, "w") as f:
+        f.write(contents)
+    os.chmod(filePath, mode)
+
+
+def simulatedIps(hosts):
+    return dict((host, "10.0.%d.%d" % (i // 250, i % 250 + 1))
+                for i, host in enumerate(hosts))
+
+
+# FABRIC SIDE
+def connectToStandIn(connect):
+    def wrapper(user, host, port, cache, seek_gateway=True):
+        return connect("%s/%s" % (user, host), "127.0.0.1", _standInPort, cache, seek_gateway)
+    return wrapper
+
+
+def asyncOptionsForStandIn(connectOptions):
+    def wrapper(hostString):
+        options = connectOptions(hostString)
+        options["username"] = "%s/%s" % (options["username"], options["host"])
+        options["host"] = "127.0.0.1"
+        options["port"] = _standInPort
+        return options
+    return wrapper
+
+
+def seedFakePackages(fabfile):
+    # Put a fake package for every *_URL tarball of the fabfile in the
+    # (isolated) artifact cache, so that nothing is ever downloaded
+    cacheDir = artifactCache.ARTIFACT_CACHE_DIR
+    objectsDir = os.path.join(cacheDir, "objects")
+    if not os.path.isdir(objectsDir):
+        os.makedirs(objectsDir)
+    index = artifactCache.readIndex(cacheDir)
+
+    for name in dir(fabfile):
+        url = getattr(fabfile, name)
+        if not name.endswith("_URL") or not isinstance(url, str) or \
+                not url.endswith(".tar.gz") or url in index:
+            continue
+
+        packageName = os.path.basename(url)[:-len(".tar.gz")]
+        packagePath = os.path.join(objectsDir, ".fake")
+        with tarfile.open(packagePath, "w:gz") as package:
+            for fileName, contents in sorted(FAKE_PACKAGE_FILES.items()):
+                data = contents.encode("utf-8")
+                fileInfo = tarfile.TarInfo("%s/%s" % (packageName, fileName))
+                fileInfo.size = len(data)
+                fileInfo.mode = 0o755 if data.startswith(b"#!") else 0o644
+                fileInfo.mtime = time.time()
+                package.addfile(fileInfo, BytesIO(data))
+
+        checksum = artifactCache.sha256File(packagePath)
+        os.rename(packagePath, os.path.join(objectsDir, checksum))
+        index[url] = checksum
+
+    artifactCache.writeIndex(cacheDir, index)
+
+
+def loadFabfile(fabfilePath, nodeCount, engine):
+    # A fresh module for every task, like a new fab run (@runs_once
+    # remembers its results otherwise)
+    fabfileDir = os.path.dirname(os.path.abspath(fabfilePath))
+    if fabfileDir not in sys.path:
+        sys.path.insert(0, fabfileDir)
+    os.chdir(fabfileDir)
+
+    spec = importlib.util.spec_from_file_location("simulatedFabfile", fabfilePath)
+    fabfile = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(fabfile)
+
+    if hasattr(fabfile, "EXECUTION_ENGINE"):
+        fabfile.EXECUTION_ENGINE = engine
+    CLUSTER_LAYOUTS[os.path.basename(fabfileDir)](fabfile, nodeCount)
+    return fabfile
+
+
+def runTask(fabfile, taskName, poolSize, logFile):
+    start = time.time()
+    firstRecord = len(remoteTiming.currentRecords())
+    status = "ok"
+
+    stdout = sys.stdout
+    sys.stdout = logFile
+    try:
+        with settings(hide("everything"), parallel=True, pool_size=poolSize):
+            # Same task:argument=value syntax as fab, one argument per task
+            name, args, kwargs = parse_arguments([taskName])[0][:3]
+            execute(getattr(fabfile, name), *args, **kwargs)
+    except SystemExit:
+        status = "aborted"
+    finally:
+        sys.stdout = stdout
+
+    records = remoteTiming.currentRecords()[firstRecord:]
+    return {
+        "status": status,
+        "seconds": time.time() - start,
+        "commands": sum(1 for r in records if r["operation"] in ("run", "sudo")),
+        "transfers": sum(1 for r in records if r["operation"] in ("put", "get")),
+        "failed": sum(1 for r in records if r["status"] != 0),
+    }
+
+
+def runScenario(fabfilePath, tasks, nodeCount, options):
+    global _standInPort
+
+    fabfile = loadFabfile(fabfilePath, nodeCount, options.engine)
+    hosts = list(env.hosts)
+    seedFakePackages(fabfile)
+
+    sandboxDir = os.path.join(WORK_DIR, "cluster-%d" % nodeCount)
+    prepareSandbox(sandboxDir, hosts, env.user)
+
+    _standInPort = 20000 + (os.getpid() + nodeCount) % 10000
+    ready = multiprocessing.Event()
+    standIn = multiprocessing.Process(target=serveCluster, args=(_standInPort,
+        simulatedIps(hosts), sandboxDir, options.latency_ms / 1000.0,
+        options.failure_rate, options.seed, ready))
+    standIn.daemon = True
+    standIn.start()
+    ready.wait()
+
+    hostFacts.clearFacts()
+    results = {}
+
+    with open(os.path.join(WORK_DIR, "cluster-%d.log" % nodeCount), "a", 1) as logFile:
+        for taskName in tasks:
+            if taskName != tasks[0]:
+                fabfile = loadFabfile(fabfilePath, nodeCount, options.engine)
+            results[taskName] = runTask(fabfile, taskName, options.pool_size, logFile)
+            printResult(nodeCount, taskName, results[taskName])
+
+            with hide("everything", "status"):
+                disconnect_all()
+
+    standIn.terminate()
+    standIn.join()
+    if not options.keep:
+        shutil.rmtree(sandboxDir, ignore_errors=True)
+
+    return results
+
+
+def printResult(nodeCount, taskName, result):
+    print("%6d %-20s %-8s %9.1fs %9d %9.1f %10d %7d" % (nodeCount, taskName,
+        result["status"], result["seconds"], result["commands"],
+        result["commands"] / float(nodeCount), result["transfers"], result["failed"]))
+
+
+def compareWithBaseline(baseline, fabfileName, results):
+    # Fewer remote commands or transfers than the baseline is fine, more is a
+    # regression. Only complete runs without injected failures compare.
+    regressions = 0
+
+    for nodeCount, taskResults in sorted(results.items()):
+        for taskName, result in sorted(taskResults.items()):
+            previous = baseline.get(fabfileName, {}).get(str(nodeCount), {}).get(taskName)
+            if not previous or result["status"] != "ok":
+                continue
+
+            for count in ["commands", "transfers"]:
+                if result[count] > previous[count]:
+                    regressions += 1
+                    print("REGRESSION %s with %d nodes: %d %s, %d in the baseline" %
+                          (taskName, nodeCount, result[count], count, previous[count]))
+
+    return regressions
+
+
+def updateBaseline(baseline, fabfileName, results):
+    for nodeCount, taskResults in results.items():
+        for taskName, result in taskResults.items():
+            if result["status"] == "ok":
+                baseline.setdefault(fabfileName, {}).setdefault(str(nodeCount), {})[taskName] = \
+                    {"commands": result["commands"], "transfers": result["transfers"]}
+
+
+def readBaseline(baselinePath):
+    try:
+        with open(baselinePath) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def writeBaseline(baselinePath, baseline):
+    with open(baselinePath + ".tmp", "w") as f:
+        json.dump(baseline, f, indent=1, sort_keys=True)
+        f.write("\n")
+    os.rename(baselinePath + ".tmp", baselinePath)
+
+
+def checkNamespaces():
+    if subprocess.call(["unshare", "-rm", "true"], stderr=subprocess.DEVNULL) != 0:
+        sys.exit("Simulated hosts need unshare (util-linux) and unprivileged user namespaces")
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Run fabfile tasks on a simulated cluster")
+    parser.add_argument("fabfile")
+    parser.add_argument("tasks", help="comma separated, e.g. bootstrap,config,setupHosts,install "
+                        "or bootstrap,bootstrap:resume=true")
+    parser.add_argument("--nodes", default=",".join(str(n) for n in DEFAULT_NODES),
+                        help="comma separated cluster sizes (at least 2 nodes)")
+    parser.add_argument("--latency-ms", type=float, default=0,
+                        help="added to every remote command and file transfer")
+    parser.add_argument("--failure-rate", type=float, default=0,
+                        help="probability of a remote command failing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_SIZE)
+    parser.add_argument("--engine", choices=["fabric", "async"], default="fabric")
+    parser.add_argument("--baseline", help="JSON file with the remote command counts to compare with")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="store the counts of this run in the baseline file")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the sandboxes, logs and trace (%s)" % WORK_DIR)
+    return parser.parse_args()
+
+
+def main():
+    options = parseArguments()
+    fabfilePath = os.path.abspath(options.fabfile)
+    # Each task runs from the directory of the fabfile
+    baselinePath = options.baseline and os.path.abspath(options.baseline)
+    fabfileName = os.path.basename(os.path.dirname(fabfilePath))
+    if fabfileName not in CLUSTER_LAYOUTS:
+        sys.exit("No simulated cluster layout for %s (known: %s)" %
+                 (fabfileName, ", ".join(sorted(CLUSTER_LAYOUTS))))
+    checkNamespaces()
+
+    env.password = "simulated"
+    env.disable_known_hosts = True
+    env.abort_on_prompts = True
+    env.no_agent = env.no_keys = True
+    fabric.network.connect = connectToStandIn(fabric.network.connect)
+    asyncEngine.connectOptions = asyncOptionsForStandIn(asyncEngine.connectOptions)
+
+    tasks = options.tasks.split(",")
+    results = {}
+    print("%6s %-20s %-8s %10s %9s %9s %10s %7s" % ("nodes", "task", "status",
+        "wall time", "commands", "per host", "transfers", "failed"))
+
+    try:
+        for nodeCount in [int(n) for n in options.nodes.split(",")]:
+            results[nodeCount] = runScenario(fabfilePath, tasks, nodeCount, options)
+    finally:
+        if not options.keep:
+            shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    regressions = 0
+    if baselinePath:
+        baseline = readBaseline(baselinePath)
+        regressions = compareWithBaseline(baseline, fabfileName, results)
+        if options.update_baseline:
+            updateBaseline(baseline, fabfileName, results)
+            writeBaseline(baselinePath, baseline)
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# encoding: utf-8
+
+# Description:
+#   Local journal of the steps each host went through in a multi-step task
+#   (hadoop-yarn bootstrap, nagios install), with a hash of the inputs of
+#   each step (package versions, configuration values). A resumed run only
+#   repeats the steps that failed, never ran or whose inputs changed, on the
+#   hosts that need them. Each step appends one line to the journal
+#   (parallel tasks run in separate processes), the last line of a step of
+#   a host wins.
+
+import os
+import json
+import time
+import hashlib
+from fabric.api import env
+
+# Shared by every fabfile in this repository
+JOURNAL_DIR = os.path.expanduser("~/.cache/fabric-scripts/journals")
+
+
+def isTrue(value):
+    # Task arguments (resume=true) are passed as strings on the command line
+    return str(value).lower() in ("true", "yes", "1")
+
+
+def journalPath(name):
+    return os.path.join(JOURNAL_DIR, "%s.jsonl" % name)
+
+
+def inputHash(inputs):
+    encoded = json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:12]
+
+
+def fileHashes(paths):
+    # For steps that upload local files, so that editing them counts as a
+    # change of inputs
+    hashes = []
+    for path in paths:
+        with open(path, "rb") as f:
+            hashes.append(hashlib.sha256(f.read()).hexdigest())
+    return hashes
+
+
+def readJournal(name):
+    """Return {host: {step: entry}} with the last entry of every step, each
+    one a dict with its input hash, status, finish time and duration.
+    """
+    hosts = {}
+
+    try:
+        with open(journalPath(name)) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    hosts.setdefault(entry["host"], {})[entry["step"]] = entry
+    except (IOError, OSError, ValueError):
+        pass
+
+    return hosts
+
+
+def reset(name):
+    if os.path.isfile(journalPath(name)):
+        os.remove(journalPath(name))
+
+
+def record(name, host, step, hashValue, status, duration):
+    if not os.path.isdir(JOURNAL_DIR):
+        os.makedirs(JOURNAL_DIR)
+
+    line = json.dumps({"host": host, "step": step, "hash": hashValue,
+                       "status": status, "finished": time.time(),
+                       "duration": duration}) + "\n"
+    # A single unbuffered append, like the records of remoteTiming
+    fd = os.open(journalPath(name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode("utf-8"))
+    finally:
+        os.close(fd)
+
+
+def stepState(journal, host, step, hashValue):
+    # "done", "changed" (done with other inputs), "failed" or "pending"
+    entry = journal.get(host, {}).get(step)
+    if entry is None:
+        return "pending"
+    if entry["status"] != "done":
+        return "failed"
+    return "done" if entry["hash"] == hashValue else "changed"
+
+
+def pendingSteps(journal, host, steps):
+    """The (step, inputs) pairs of host that still have to run."""
+    return [(step, inputs) for step, inputs in steps
+            if stepState(journal, host, step, inputHash(inputs)) != "done"]
+
+
+def runStep(name, step, inputs, function, journal=None):
+    """Run function as step of the current host and journal the outcome.
+    When resuming, journal is the readJournal of the run (read once, before
+    the hosts run their steps): steps already done with the same inputs are
+    skipped (and None is returned instead of the duration).
+    """
+    hashValue = inputHash(inputs)
+
+    if journal is not None and stepState(journal, env.host, step, hashValue) == "done":
+        print("Skipping %s, already done with the same inputs" % step)
+        return None
+
+    start = time.time()
+    try:
+        function()
+    except BaseException:
+        # Also aborts (SystemExit) and interruptions
+        record(name, env.host, step, hashValue, "failed", time.time() - start)
+        raise
+
+    duration = time.time() - start
+    record(name, env.host, step, hashValue, "done", duration)
+    return duration
+
+
+def printStatus(name, hostSteps):
+    """Print where each host stands, hostSteps being {host: [(step, inputs)]}
+    with the current inputs of each step.
+    """
+    journal = readJournal(name)
+    steps = []
+    for host in hostSteps:
+        steps += [step for step, inputs in hostSteps[host] if step not in steps]
+
+    widths = [max(len(step), len("changed")) for step in steps]
+    print(("%-40s" % "host") + "".join(" %-*s" % (width, step)
+                                       for width, step in zip(widths, steps)))
+    for host in sorted(hostSteps):
+        states = dict((step, stepState(journal, host, step, inputHash(inputs)))
+                      for step, inputs in hostSteps[host])
+        print(("%-40s" % host) + "".join(" %-*s" % (width, states.get(step, ""))
+                                         for width, step in zip(widths, steps)))
+
+    pendingHosts = [host for host in hostSteps
+                    if pendingSteps(journal, host, hostSteps[host])]
+    print("%d of %d hosts have steps left to run" % (len(pendingHosts), len(hostSteps)))
@@ -0,0 +1,142 @@
+# encoding: utf-8
+
+import pytest
+
+import hostFacts
+
+
+def probeOutput(blockDeviceLines):
+    return "\n".join(["### cpuCount", "4",
+                      "### memoryMb", "MemTotal:        8167848 kB",
+                      "### interfaces",
+                      "1: lo    inet 127.0.0.1/8 scope host lo",
+                      "2: eth0    inet 10.0.0.12/24 brd 10.0.0.255 scope global eth0",
+                      "### blockDevices"] + blockDeviceLines +
+                     ["### mounts",
+                      "Filesystem     1024-blocks    Used Available Capacity Mounted on",
+                      "/dev/xvda1         8115168 1650644   6028660      22% /"])
+
+
+def blockDevice(name, type="disk", size=42949672960, mountpoint="", fstype="", parent=""):
+    return ('NAME="%s" TYPE="%s" SIZE="%d" MOUNTPOINT="%s" FSTYPE="%s" ROTA="0" PKNAME="%s"' %
+            (name, type, size, mountpoint, fstype, parent))
+
+
+def test_parseProbeOutputScalars():
+    facts = hostFacts.parseProbeOutput(probeOutput([]))
+
+    assert facts["cpuCount"] == 4
+    assert facts["memoryMb"] == 7976
+    assert facts["interfaces"] == {"lo": "127.0.0.1", "eth0": "10.0.0.12"}
+    assert facts["mounts"] == {"/": {"device": "/dev/xvda1", "sizeKb": 8115168,
+                                     "availableKb": 6028660}}
+
+
+def test_parseProbeOutputMissingSections():
+    facts = hostFacts.parseProbeOutput("")
+
+    assert facts["cpuCount"] is None
+    assert facts["memoryMb"] is None
+    assert facts["blockDevices"] == []
+
+
+@pytest.mark.parametrize("lines, parents", [
+    # Partitions belong to their disk
+    ([blockDevice("xvda"), blockDevice("xvda1", "part", parent="xvda")],
+     {"xvda": None, "xvda1": "xvda"}),
+    # A rom listed after a disk isn't part of it
+    ([blockDevice("sdb"), blockDevice("sr0", "rom")],
+     {"sdb": None, "sr0": None}),
+    ([blockDevice("sdb"), blockDevice("loop0", "loop")],
+     {"sdb": None, "loop0": None}),
+    # LVM on a partition belongs to the partition
+    ([blockDevice("sda"), blockDevice("sda1", "part", parent="sda"),
+      blockDevice("vg-data", "lvm", parent="sda1")],
+     {"sda": None, "sda1": "sda", "vg-data": "sda1"}),
+])
+def test_parseProbeOutputParents(lines, parents):
+    devices = hostFacts.parseProbeOutput(probeOutput(lines))["blockDevices"]
+
+    assert dict((device["name"], device["parent"]) for device in devices) == parents
+
+
+def test_parseProbeOutputBlockDevice():
+    line = blockDevice("xvdb", size=1024, mountpoint="/mnt", fstype="ext4")
+    devices = hostFacts.parseProbeOutput(probeOutput([line]))["blockDevices"]
+
+    assert devices == [{"name": "xvdb", "type": "disk", "sizeBytes": 1024,
+                        "mountpoint": "/mnt", "fstype": "ext4", "rotational": False,
+                        "parent": None}]
+
+
+@pytest.mark.parametrize("lines, options, expected", [
+    ([blockDevice("xvdb")], {}, ["xvdb"]),
+    # Mounted, empty or partitioned disks are in use
+    ([blockDevice("xvdb", mountpoint="/data")], {}, []),
+    ([blockDevice("xvdb", size=0)], {}, []),
+    ([blockDevice("xvdb"), blockDevice("xvdb1", "part", parent="xvdb")], {}, []),
+    ([blockDevice("xvdb", fstype="LVM2_member"),
+      blockDevice("vg-data", "lvm", parent="xvdb")], {}, []),
+    # Only formatted again when asked to
+    ([blockDevice("xvdb", fstype="ext4")], {}, []),
+    ([blockDevice("xvdb", fstype="ext4")], {"reformat": True}, ["xvdb"]),
+    ([blockDevice("xvdb"), blockDevice("xvdc")], {"exclude": ["xvdb"]}, ["xvdc"]),
+    # A rom after a disk doesn't make it look partitioned
+    ([blockDevice("sdb"), blockDevice("sr0", "rom")], {}, ["sdb"]),
+])
+def test_dataDisks(lines, options, expected):
+    facts = hostFacts.parseProbeOutput(probeOutput(lines))
+
+    assert [device["name"] for device in hostFacts.dataDisks(facts, **options)] == expected
+
+
+@pytest.fixture
+def fanOutState(tmp_path, monkeypatch):
+    # Quarantine and reports out of the way, and a fresh host list
+    import fanOut
+    monkeypatch.setattr(fanOut, "QUARANTINE_DIR", str(tmp_path / "quarantine"))
+    monkeypatch.setattr(fanOut, "REPORT_DIR", str(tmp_path / "reports"))
+    monkeypatch.setattr(fanOut, "_reportPath", None)
+    monkeypatch.setattr(fanOut, "_reportEntries", [])
+    monkeypatch.setattr(fanOut.env, "hosts", ["a", "b", "c"])
+    monkeypatch.setattr(fanOut.env, "roledefs", {"slave": ["b", "c"]})
+    return fanOut
+
+
+def interfaceFacts(interfaces):
+    return {"interfaces": interfaces}
+
+
+@pytest.mark.parametrize("interfaces, interface, expected", [
+    ({"lo": "127.0.0.1", "eth0": "10.0.0.12"}, "eth0", "10.0.0.12"),
+    # e.g. ens5 instead of eth0
+    ({"lo": "127.0.0.1", "ens5": "10.0.0.12"}, "eth0", None),
+    ({}, "eth0", None),
+])
+def test_privateIp(interfaces, interface, expected):
+    assert hostFacts.privateIp(interfaceFacts(interfaces), interface) == expected
+
+
+def test_privateIps(fanOutState):
+    facts = {"a": interfaceFacts({"eth0": "10.0.0.1"}),
+             "b": interfaceFacts({"eth0": "10.0.0.2"})}
+
+    assert hostFacts.privateIps(facts, "eth0") == {"a": "10.0.0.1", "b": "10.0.0.2"}
+    assert fanOutState.readQuarantine() == {}
+
+
+def test_privateIpsMissingInterface(fanOutState, monkeypatch):
+    facts = {"a": interfaceFacts({"eth0": "10.0.0.1"}),
+             "b": interfaceFacts({"lo": "127.0.0.1", "ens5": "10.0.0.2"})}
+
+    # Over the budget: aborts, naming the host
+    monkeypatch.setattr(fanOutState, "FAILURE_BUDGET", "0")
+    with pytest.raises(SystemExit):
+        hostFacts.privateIps(facts, "eth0")
+
+    # Within it: the host is left out of the result and of the rest of the run
+    monkeypatch.setattr(fanOutState, "FAILURE_BUDGET", "1")
+    assert hostFacts.privateIps(facts, "eth0") == {"a": "10.0.0.1"}
+    assert "ens5" in fanOutState.readQuarantine()["b"]["error"]
+    assert fanOutState.env.hosts == ["a", "c"]
+    assert fanOutState.env.roledefs == {"slave": ["c"]}
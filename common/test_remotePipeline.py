@@ -0,0 +1,44 @@
+# encoding: utf-8
+
+import subprocess
+
+import pytest
+
+import remotePipeline
+
+
+def runLocally(commands):
+    # What the remote shell prints for the pipelined commands
+    process = subprocess.Popen(["/bin/sh", "-c", remotePipeline.pipelineScript(commands)],
+                               stdout=subprocess.PIPE)
+    return process.communicate()[0].decode("utf-8")
+
+
+@pytest.mark.parametrize("commands, expected", [
+    (["true"], [("", 0)]),
+    (["echo a", "false", "exit 3"], [("a", 0), ("", 1), ("", 3)]),
+    (["echo a; echo b", "echo c >&2"], [("a\nb", 0), ("c", 0)]),
+    # Output without a trailing newline
+    (["printf a", "printf b; exit 2", "echo c"], [("a", 0), ("b", 2), ("c", 0)]),
+    (["printf 'a\\nb'", "true"], [("a\nb", 0), ("", 0)]),
+    # Directory changes don't leak into the next command
+    (["cd /", "pwd | grep -qx /"], [("", 0), ("", 1)]),
+])
+def test_parsePipelineOutput(commands, expected):
+    results = remotePipeline.parsePipelineOutput(runLocally(commands), commands)
+
+    assert [(str(result), result.return_code) for result in results] == expected
+    assert [result.failed for result in results] == [status != 0 for _, status in expected]
+    assert [result.command for result in results] == commands
+
+
+@pytest.mark.parametrize("output, expected", [
+    # The shell died before the second command finished
+    ("__fab_pipeline__0\na\n__fab_pipeline__0:0\n__fab_pipeline__1\nb\n",
+     [("a", 0), ("b", -1)]),
+    ("", [("", -1), ("", -1)]),
+])
+def test_parsePipelineOutputIncomplete(output, expected):
+    results = remotePipeline.parsePipelineOutput(output, ["first", "second"])
+
+    assert [(str(result), result.return_code) for result in results] == expected
@@ -0,0 +1,274 @@
+# encoding: utf-8
+
+# Description:
+#   Parses the output of the Hadoop benchmarks (TeraSort, TestDFSIO, NNBench,
+#   MRBench) into metrics, keeps a local history of the results keyed by the
+#   hash of the cluster configuration and compares runs with each other.
+
+import os
+import re
+import json
+import hashlib
+
+# Strips the log4j prefix, e.g. "14/05/01 10:00:00 INFO fs.TestDFSIO: "
+LOG_PREFIX = re.compile(r'^\d\d/\d\d/\d\d \d\d:\d\d:\d\d \w+ [\w.$]+: ')
+COUNTERS_HEADER = re.compile(r'Counters: \d+\s*$')
+
+# Metrics named with one of these suffixes are better when lower, the
+# remaining ones (throughputs, TPS, rates) are better when higher.
+LOWER_IS_BETTER = ("Sec", "Ms", "StdDev", "Records", "Exceptions", "Bytes")
+
+
+def stripLogPrefix(line):
+    return LOG_PREFIX.sub("", line.rstrip())
+
+
+def parseCounters(output):
+    """Return the counters of the last job in the output as a
+    {group: {name: value}} dict.
+    """
+    counters = {}
+    group = None
+
+    for line in output.splitlines():
+        if COUNTERS_HEADER.search(line):
+            counters = {}
+            group = None
+            continue
+
+        # Groups are indented by one tab, counters by two
+        if line.startswith("\t\t") and group is not None and "=" in line:
+            name, value = line.strip().rsplit("=", 1)
+            try:
+                counters[group][name] = int(value)
+            except ValueError:
+                pass
+        elif line.startswith("\t") and line.strip() and "=" not in line:
+            group = line.strip()
+            counters[group] = {}
+        elif not line.startswith("\t"):
+            group = None
+
+    return counters
+
+
+def parseKeyValues(output):
+    """Return every "<key>: <number>" line of the output (as printed by
+    TestDFSIO and NNBench) as a {key: float} dict.
+    """
+    values = {}
+
+    for line in output.splitlines():
+        line = stripLogPrefix(line).strip()
+        if ":" not in line:
+            continue
+
+        key, value = line.rsplit(":", 1)
+        try:
+            values[key.strip()] = float(value)
+        except ValueError:
+            pass
+
+    return values
+
+
+def counterValue(counters, group, name, default=0):
+    return counters.get(group, {}).get(name, default)
+
+
+def teraMetrics(output, elapsedSec, dataBytes):
+    counters = parseCounters(output)
+    metrics = {
+        "elapsedSec": round(elapsedSec, 1),
+        "throughputMBps": round(dataBytes / 1e6 / elapsedSec, 2),
+        "cpuTimeSec": counterValue(counters, "Map-Reduce Framework",
+                                   "CPU time spent (ms)") / 1000.0,
+        "gcTimeSec": counterValue(counters, "Map-Reduce Framework",
+                                  "GC time elapsed (ms)") / 1000.0,
+        "spilledRecords": counterValue(counters, "Map-Reduce Framework",
+                                       "Spilled Records"),
+        "shuffleBytes": counterValue(counters, "Map-Reduce Framework",
+                                     "Reduce shuffle bytes"),
+        "outputBytes": counterValue(counters, "File Output Format Counters",
+                                    "Bytes Written"),
+    }
+    return {"metrics": metrics, "counters": counters}
+
+
+def dfsioMetrics(output):
+    values = parseKeyValues(output)
+    metrics = {
+        "throughputMBps": values.get("Throughput mb/sec"),
+        "avgIoRateMBps": values.get("Average IO rate mb/sec"),
+        "ioRateStdDev": values.get("IO rate std deviation"),
+        "execTimeSec": values.get("Test exec time sec"),
+    }
+    return {"metrics": metrics, "counters": parseCounters(output)}
+
+
+def nnbenchMetrics(output, operation):
+    values = parseKeyValues(output)
+    # e.g. "TPS: Create/Write/Close" or "TPS: Open/Read"
+    tps = [value for key, value in values.items() if key.startswith("TPS:")]
+    latencies = [value for key, value in values.items()
+                 if key.startswith("Avg exec time (ms):")]
+    metrics = {
+        "tps": tps[0] if tps else None,
+        "avgExecMs": latencies[0] if latencies else None,
+        "successfulOperations": values.get("Successful file operations"),
+        "mapExceptions": values.get("# exceptions"),
+    }
+    return {"metrics": metrics, "operation": operation}
+
+
+def mrbenchMetrics(output):
+    # DataLines    Maps    Reduces AvgTime (milliseconds)
+    # 1            2       1       15734
+    metrics = {"avgJobMs": None}
+    lines = [stripLogPrefix(line) for line in output.splitlines()]
+
+    for i, line in enumerate(lines):
+        if line.startswith("DataLines") and i + 1 < len(lines):
+            fields = lines[i + 1].split()
+            if fields:
+                metrics["avgJobMs"] = int(fields[-1])
+
+    return {"metrics": metrics}
+
+
+def configHash(configurationFiles):
+    # Hash of the {fileName: contents} actually deployed on the cluster
+    digest = hashlib.sha256()
+
+    for fileName in sorted(configurationFiles):
+        contents = configurationFiles[fileName]
+        if not isinstance(contents, bytes):
+            contents = contents.encode("utf-8")
+        digest.update(fileName.encode("utf-8"))
+        digest.update(contents)
+
+    return digest.hexdigest()[:12]
+
+
+def readHistory(historyFile):
+    try:
+        with open(historyFile) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return []
+
+
+def appendHistory(historyFile, run):
+    history = readHistory(historyFile)
+    history.append(run)
+
+    historyDir = os.path.dirname(historyFile)
+    if not os.path.isdir(historyDir):
+        os.makedirs(historyDir)
+
+    with open(historyFile + ".tmp", "w") as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+    os.rename(historyFile + ".tmp", historyFile)
+
+
+def previousResult(history, benchmark, before):
+    # Most recent earlier run of the given benchmark, whatever its config
+    for run in reversed(history):
+        if run["time"] < before and benchmark in run["results"]:
+            return run
+
+    return None
+
+
+def higherIsBetter(name):
+    return not name.endswith(LOWER_IS_BETTER)
+
+
+def metricChange(name, old, new):
+    """Return the relative change of a metric, positive when it improved."""
+    if old is None or new is None or old == 0:
+        return None
+
+    if not higherIsBetter(name):
+        return (old - new) / float(abs(old))
+
+    return (new - old) / float(abs(old))
+
+
+def printComparison(history, run, threshold):
+    """Print every metric of run next to the previous result of the same
+    benchmark. Returns the number of metrics that got worse by more than
+    threshold.
+    """
+    regressions = 0
+
+    for benchmark in sorted(run["results"]):
+        previous = previousResult(history, benchmark, run["time"])
+        metrics = run["results"][benchmark]["metrics"]
+
+        if previous is None:
+            print("%s (config %s): no previous run" % (benchmark, run["configHash"]))
+        else:
+            print("%s (config %s, previous %s at %s):" % (benchmark,
+                run["configHash"], previous["configHash"], previous["date"]))
+            if previous["parameters"] != run["parameters"]:
+                print("  (benchmark sizes differ from the previous run)")
+
+        for name in sorted(metrics):
+            new = metrics[name]
+            old = None
+            if previous is not None:
+                old = previous["results"][benchmark]["metrics"].get(name)
+
+            change = metricChange(name, old, new)
+            flag = ""
+            if change is not None and change < -threshold:
+                flag = "REGRESSION"
+                regressions += 1
+            elif change is not None and change > threshold:
+                flag = "improved"
+
+            print("  %-22s %12s %12s %8s  %s" % (name, formatValue(old),
+                formatValue(new), formatChange(change), flag))
+
+    return regressions
+
+
+def printVariants(benchmark, labels, variants):
+    """Print the metrics of runs of the same benchmark with different
+    settings side by side, with the change of each one from the first.
+    """
+    print("%s:" % benchmark)
+    print("  %-22s %s %8s" % ("", " ".join("%14s" % label for label in labels), "change"))
+
+    for name in sorted(variants[0]):
+        values = [variant.get(name) for variant in variants]
+        print("  %-22s %s %8s" % (name, " ".join("%14s" % formatValue(value) for value in values),
+                                  formatChange(metricChange(name, values[0], values[-1]))))
+
+
+def printHistory(history, benchmark=None):
+    print("%-20s %-12s %-14s  %s" % ("date", "config", "benchmark", "metrics"))
+
+    for run in history:
+        for name in sorted(run["results"]):
+            if benchmark and name != benchmark:
+                continue
+            metrics = run["results"][name]["metrics"]
+            print("%-20s %-12s %-14s  %s" % (run["date"], run["configHash"], name,
+                ", ".join("%s=%s" % (key, formatValue(metrics[key]))
+                          for key in sorted(metrics))))
+
+
+def formatValue(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return "%.2f" % value
+    return str(value)
+
+
+def formatChange(change):
+    if change is None:
+        return ""
+    return "%+.1f%%" % (change * 100)
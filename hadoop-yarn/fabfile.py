@@ -9,10 +9,34 @@
 #   http://www.alexjf.net/blog/distributed-systems/hadoop-yarn-installation-definitive-guide
 
 import os
-from fabric.api import run, cd, env, settings, put, sudo
+import re
+import sys
+import copy
+import json
+import time
+import base64
+import tarfile
+import uuid
+from io import BytesIO
+from fabric.api import run, cd, env, settings, put, get, sudo, hide, abort, warn
 from fabric.decorators import runs_once, parallel
 from fabric.tasks import execute
 
+import replaceHadoopProperty
+import benchmarkResults
+import parameterSweep
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import artifactCache
+import fanOut
+import hostFacts
+import hostRoles
+import remoteTiming
+import remotePipeline
+import stepJournal
+
+remoteTiming.install()
+
 ###############################################################
 #  START OF YOUR CONFIGURATION (CHANGE FROM HERE, IF NEEDED)  #
 ###############################################################
@@ -21,6 +45,24 @@ from fabric.tasks import execute
 SSH_USER = "ubuntu"
 # If you need to specify a special ssh key, do it here (e.g EC2 key)
 #env.key_filename = "~/.ssh/giraph.pem"
+# Maximum number of hosts worked on concurrently by bootstrap, start and
+# stop (0 = all)
+BOOTSTRAP_POOL_SIZE = 20
+# "fabric" runs the tasks that fan out a single command to every host (host
+# facts, private IPs, /etc/hosts) with @parallel, one process per host. "async"
+# runs them from a single process with asyncio, which scales to thousands
+# of hosts (needs Python 3 and asyncssh, see common/asyncEngine.py).
+EXECUTION_ENGINE = "fabric"
+# Hosts that may fail (unreachable, or still failing after the retries) in
+# the fan-outs to every host (host facts, bootstrap, private IPs,
+# /etc/hosts) before the run aborts: a number of hosts ("3") or a percentage
+# ("5%"). The failed hosts are left out of the rest of the run and
+# quarantined for an hour (fab clearQuarantine releases them).
+FANOUT_FAILURE_BUDGET = "0"
+# Retries of the hosts that failed with a connection error, the first one
+# after FANOUT_RETRY_BACKOFF seconds and each next one after twice as long
+FANOUT_RETRIES = 2
+FANOUT_RETRY_BACKOFF = 2.0
 
 
 #### EC2 ####
@@ -35,10 +77,26 @@ EC2_RM_NONSLAVE = True
 # Read AWS access key details from env if available
 AWS_ACCESSKEY_ID = os.getenv("AWS_ACCESSKEY_ID", "undefined")
 AWS_ACCESSKEY_SECRET = os.getenv("AWS_ACCESSKEY_SECRET", "undefined")
+# Discovered instances are cached locally so that fab doesn't have to query
+# EC2 every time it starts. Use the refreshInventory task to force an update.
+EC2_INVENTORY_FILE = os.path.expanduser("~/.cache/fabric-scripts/ec2-inventory-%s.json" % EC2_CLUSTER_NAME)
+EC2_INVENTORY_TTL = 3600 # seconds
+# Alternative EC2 API endpoint (e.g. a local mock such as moto_server)
+EC2_ENDPOINT = None
+#EC2_ENDPOINT = "http://localhost:5000"
 # In case the instances you use have an extra storage device which is not
 # automatically mounted, specify here the path to that device.
 EC2_INSTANCE_STORAGEDEV = None
 #EC2_INSTANCE_STORAGEDEV = "/dev/xvdb" For Ubuntu r3.xlarge instances
+# Alternatively, format and mount every unused data disk of the hosts (e.g.
+# all EC2 ephemeral disks) under DATA_DISKS_MOUNT_PREFIX<N> and spread the
+# HDFS DataNode and YARN local/log directories over all of them.
+DATA_DISKS = False
+DATA_DISKS_MOUNT_PREFIX = "/mnt/disk"
+DATA_DISKS_MKFS = "mkfs.ext4 -F -q -m 0 -T largefile -E lazy_itable_init=1,lazy_journal_init=1"
+# Disks that already hold a filesystem (or are LVM/RAID members) are left
+# alone. Set to True to format those as well, destroying their data.
+DATA_DISKS_REFORMAT = False
 
 
 #### Package Information ####
@@ -49,6 +107,17 @@ HADOOP_PACKAGE_URL = "http://www.whoishostingthis.com/mirrors/apache/hadoop/comm
 HADOOP_PREFIX = "/home/ubuntu/Programs/%s" % HADOOP_PACKAGE
 HADOOP_CONF = os.path.join(HADOOP_PREFIX, "etc/hadoop")
 
+# Download the Hadoop package only once, on this machine, and spread it
+# inside the cluster (hosts that already have it serve the next ones)
+# instead of having every host download it from the mirror.
+HADOOP_PACKAGE_FANOUT = True
+# If set, the downloaded package must match this SHA-256 checksum
+HADOOP_PACKAGE_SHA256 = None
+# Port the cluster hosts use to serve the package to each other. The servers
+# are plain HTTP, bound to the private IP of each host only (see
+# retrievePrivateIps), and every host verifies the checksum of what it gets.
+HADOOP_PACKAGE_FANOUT_PORT = 8765
+
 
 #### Installation information ####
 # Change this to the command you would use to install packages on the
@@ -134,6 +203,13 @@ JOBTRACKER_PORT = 8021
 JOBHISTORY_HOST = JOBTRACKER_HOST
 JOBHISTORY_PORT = 10020
 
+# start waits this many seconds for each master daemon to open its ports
+# and then for every DataNode and NodeManager to register
+DAEMON_READY_TIMEOUT = 300
+# forceStopEveryJava waits this many seconds for the Hadoop JVMs of a host to
+# exit after SIGTERM before sending SIGKILL to the remaining ones
+STOP_TIMEOUT = 30
+
 
 #### Configuration ####
 # Should the configuration options be applied to a clean (empty) configuration
@@ -148,6 +224,93 @@ HDFS_NAME_DIR = "/mnt/hdfs/namenode"
 
 IMPORTANT_DIRS = [HADOOP_TEMP, HDFS_DATA_DIR, HDFS_NAME_DIR]
 
+# Size the NodeManager resources, containers and JVM heaps from the hardware
+# of each host (probed with hostFacts) instead of using the fixed values
+# below. NodeManager resources are set per host, container sizes are shared
+# by the whole cluster and chosen so that they fit on the smallest slave.
+YARN_AUTO_SIZING = False
+# Fraction of the memory (with a minimum, in MB) kept for the OS and the
+# DataNode/NodeManager daemons
+YARN_RESERVED_MEMORY_RATIO = 0.2
+YARN_RESERVED_MEMORY_MIN_MB = 1024
+# Number of cores kept for the OS and the daemons
+YARN_RESERVED_CORES = 1
+# Maximum JVM heap as a fraction of the container memory
+YARN_HEAP_RATIO = 0.8
+
+#### Compression ####
+# Compress the map output (the data moved by the shuffle) with a native
+# codec. config checks with "hadoop checknative" that each host can load
+# libhadoop and the codec before enabling it there.
+COMPRESSION = False
+# "snappy" or "lz4" (LZ4 is bundled in libhadoop, Snappy needs libsnappy)
+COMPRESSION_CODEC = "snappy"
+# Also compress the final output of the jobs (block compressed)
+COMPRESSION_JOB_OUTPUT = False
+# Installed along with REQUIREMENTS when COMPRESSION is enabled
+COMPRESSION_REQUIREMENTS = ["libsnappy1"] # Debian/Ubuntu
+#COMPRESSION_REQUIREMENTS = ["snappy"] # Arch Linux / CentOS
+# What to do when a host can't load the codec natively: "refuse" aborts,
+# "warn" leaves compression off on every host. Map output compression is a
+# setting of the job, so tasks on a host without the codec would fail
+# whichever host submitted the job.
+COMPRESSION_MISSING_NATIVE = "refuse"
+
+#### Short-circuit reads ####
+# Let HDFS clients read the blocks stored on their own host straight from
+# disk (the DataNode hands them the open files through a Unix domain socket)
+# instead of streaming them through the DataNode's TCP port. Needs libhadoop
+# on every DataNode, the shortCircuitReads task checks it and provisions a
+# running cluster.
+SHORT_CIRCUIT_READS = False
+# The directory must only be writable by the DataNode user (SSH_USER) or root
+SHORT_CIRCUIT_SOCKET_PATH = "/var/lib/hadoop-hdfs/dn_socket"
+
+#### Benchmarks ####
+# Sizes of the benchmark suites run by the benchmark task
+BENCHMARK_HDFS_DIR = "/benchmarks"
+# TeraGen rows are 100 bytes each (10M rows = 1GB)
+BENCHMARK_TERASORT_ROWS = 10000000
+BENCHMARK_DFSIO_FILES = 10
+BENCHMARK_DFSIO_FILE_SIZE_MB = 128
+BENCHMARK_NNBENCH_MAPS = 4
+BENCHMARK_NNBENCH_FILES = 1000
+# NNBench maps wait for a common start time, this many seconds from now
+BENCHMARK_NNBENCH_START_DELAY = 30
+BENCHMARK_MRBENCH_RUNS = 5
+BENCHMARK_MRBENCH_MAPS = 2
+# Results of every run, keyed by the hash of the deployed configuration
+BENCHMARK_HISTORY_FILE = os.path.expanduser("~/.cache/fabric-scripts/hadoop-benchmarks.json")
+# Relative change of a metric reported as a regression (or improvement)
+BENCHMARK_REGRESSION_THRESHOLD = 0.05
+
+#### Parameter sweep ####
+# Values to try for each property, {fileName: {name: [values]}}. Every point
+# is pushed with config (restarting only the daemons that read the changed
+# files) and measured with the SWEEP_BENCHMARK suite.
+SWEEP_PARAMETERS = {
+    "yarn-site.xml": {
+        "yarn.nodemanager.vmem-pmem-ratio": [2.1, 3.1],
+    },
+    "mapred-site.xml": {
+        "mapreduce.task.io.sort.mb": [100, 256],
+        "mapreduce.job.reduces": [len(SLAVE_HOSTS), 2 * len(SLAVE_HOSTS)],
+    },
+}
+# "grid" tries every combination, "random" only SWEEP_SAMPLES of them
+SWEEP_MODE = "grid"
+SWEEP_SAMPLES = 10
+SWEEP_SEED = 0
+SWEEP_BENCHMARK = "terasort"
+# Metric that ranks the points, "<benchmark>.<metric>" (see benchmark)
+SWEEP_METRIC = "terasort.elapsedSec"
+# Progress of the current sweep, so that it can resume when interrupted
+SWEEP_STATE_FILE = os.path.expanduser("~/.cache/fabric-scripts/hadoop-sweep.json")
+
+# Name of the journal of the steps each host went through in bootstrap, in
+# ~/.cache/fabric-scripts/journals
+BOOTSTRAP_JOURNAL = "hadoop-bootstrap"
+
 # Need to do this in a function so that we can rewrite the values when any
 # of the hosts change in runtime (e.g. EC2 node discovery).
 def updateHadoopSiteValues():
@@ -200,12 +363,83 @@ def updateHadoopSiteValues():
 #####################################################################
 #  DON'T CHANGE ANYTHING BELOW (UNLESS YOU KNOW WHAT YOU'RE DOING)  #
 #####################################################################
+HOSTS_BLOCK_BEGIN = "# BEGIN hadoop cluster hosts (managed by fabric)"
+HOSTS_BLOCK_END = "# END hadoop cluster hosts (managed by fabric)"
+
+BENCHMARK_SUITES = ["terasort", "dfsio", "nnbench", "mrbench"]
+CONFIGURATION_FILES = ["core-site.xml", "hdfs-site.xml", "yarn-site.xml", "mapred-site.xml"]
+# Exit status of operationInHadoopEnvironment when executeInHadoopEnv.sh
+# has to be uploaded first, along with this marker (and a value only that
+# run knows) on stderr, so that a command exiting with the same status
+# isn't mistaken for it
+HELPER_OUTDATED_STATUS = 97
+HELPER_OUTDATED_MARKER = "__fab_helper_outdated__"
+HADOOP_DAEMONS = ["namenode", "datanode", "resourcemanager", "nodemanager", "historyserver"]
+# Role of the hosts each daemon runs on
+DAEMON_ROLES = {
+    "namenode": "namenode",
+    "datanode": "slave",
+    "resourcemanager": "resourcemanager",
+    "nodemanager": "slave",
+    "historyserver": "jobhistory",
+}
+DAEMON_SCRIPTS = {
+    "namenode": "hadoop-daemon.sh",
+    "datanode": "hadoop-daemon.sh",
+    "resourcemanager": "yarn-daemon.sh",
+    "nodemanager": "yarn-daemon.sh",
+    "historyserver": "mr-jobhistory-daemon.sh",
+}
+# Daemons started together, in order: masters (the JobHistory server needs
+# HDFS) and then every worker at once. Stopped in the reverse order.
+DAEMON_STAGES = [["namenode", "resourcemanager"], ["historyserver"], ["datanode", "nodemanager"]]
+# RPC and HTTP ports (Hadoop's defaults) that must be open before the next
+# stage starts
+DAEMON_PORTS = {
+    "namenode": [8020, 50070],
+    "resourcemanager": [8032, 8088],
+    "historyserver": [JOBHISTORY_PORT, 19888],
+}
+LIVE_DATANODES = re.compile(r"Datanodes available: (\d+)|Live datanodes \((\d+)\)")
+RUNNING_NODEMANAGERS = re.compile(r"Total Nodes:\s*(\d+)")
+# Daemons that read each configuration file when they start. The MapReduce
+# settings are read by the clients when submitting jobs.
+CONFIGURATION_FILE_DAEMONS = {
+    "core-site.xml": HADOOP_DAEMONS,
+    "hdfs-site.xml": ["namenode", "datanode"],
+    "yarn-site.xml": ["resourcemanager", "nodemanager"],
+    "mapred-site.xml": [],
+}
+COMPRESSION_CODECS = {
+    "snappy": "org.apache.hadoop.io.compress.SnappyCodec",
+    "lz4": "org.apache.hadoop.io.compress.Lz4Codec",
+}
+
+EC2_PRIVATE_IPS = {}
+# Package installed in this run, when distributePackage:url=... replaces
+# HADOOP_PACKAGE_URL (see packageUrl)
+PACKAGE_URL = None
+# Whether every slave can load COMPRESSION_CODEC natively, checked once per
+# run in COMPRESSION_MISSING_NATIVE = "warn" mode (see clusterCompression)
+CLUSTER_COMPRESSION = None
+# Per host overrides of the site values, {host: {fileName: {name: value}}}
+# (see YARN_AUTO_SIZING and DATA_DISKS)
+HOST_SITE_VALUES = {}
+# Data directories of each host (see DATA_DISKS)
+HOST_DATA_DIRS = {}
+
 CORE_SITE_VALUES = {}
 HDFS_SITE_VALUES = {}
 YARN_SITE_VALUES = {}
 MAPRED_SITE_VALUES = {}
 
 def bootstrapFabric():
+    hostFacts.ENGINE = EXECUTION_ENGINE
+    fanOut.FAILURE_BUDGET = FANOUT_FAILURE_BUDGET
+    fanOut.RETRIES = FANOUT_RETRIES
+    fanOut.RETRY_BACKOFF = FANOUT_RETRY_BACKOFF
+    fanOut.QUARANTINE_NAME = "hadoop-yarn"
+
     if EC2:
         readHostsFromEC2()
 
@@ -217,6 +451,13 @@ def bootstrapFabric():
     # Remove empty hosts and duplicates
     cleanedHosts = [host for host in hosts if host and host not in seen and not seen.add(host)]
     env.hosts = cleanedHosts
+    hostRoles.define({
+        "namenode": [NAMENODE_HOST],
+        "resourcemanager": [RESOURCEMANAGER_HOST],
+        "jobhistory": [JOBHISTORY_HOST],
+        "slave": SLAVE_HOSTS,
+    })
+    fanOut.excludeQuarantined()
 
     if JOBTRACKER_HOST:
         MAPRED_SITE_VALUES["mapreduce.jobtracker.address"] = "%s:%s" % \
@@ -228,8 +469,30 @@ def bootstrapFabric():
 
 
 # MAIN FUNCTIONS
-def forceStopEveryJava():
-    run("jps | grep -vi jps | cut -d ' ' -f 1 | xargs -L1 -r kill")
+@runs_once
+def forceStopEveryJava(timeout=STOP_TIMEOUT):
+    # Every Hadoop JVM (daemons and job tasks) on every host at once, without
+    # the daemon scripts or any ordering, e.g. to clean up before start
+    command = stopJavaCommand(int(timeout))
+
+    if EXECUTION_ENGINE == "async":
+        import asyncEngine
+        # The usual time to connect and run, on top of the stop deadline
+        with settings(hide("stdout")):
+            results = asyncEngine.runOnHosts(env.hosts, command,
+                                             timeout=int(timeout) + asyncEngine.ASYNC_TIMEOUT)
+    else:
+        with settings(hide("stdout"), pool_size=int(BOOTSTRAP_POOL_SIZE)):
+            results = execute(stopJavaOnHost, command)
+
+    printStopReport(dict((host, parseStopReport(result))
+                         for host, result in results.items()))
+
+
+@parallel
+def stopJavaOnHost(command):
+    with settings(warn_only=True):
+        return run(command)
 
 
 @runs_once
@@ -241,25 +504,170 @@ def debugHosts():
     print("Slaves: {}".format(SLAVE_HOSTS))
 
 
-def bootstrap():
+@runs_once
+def debugFacts():
+    hostFacts.printFacts(hostFacts.gatherFacts(env.hosts))
+
+
+@runs_once
+def clearFacts():
+    hostFacts.clearFacts()
+
+
+@runs_once
+def clearQuarantine():
+    fanOut.clearQuarantine()
+
+
+@runs_once
+def traceSummary(trace=None):
+    # Slowest hosts, tasks and commands of the given (or the last) fab run
+    remoteTiming.printSummary(remoteTiming.loadTrace(trace))
+
+
+@runs_once
+def bootstrap(poolSize=BOOTSTRAP_POOL_SIZE, resume="false"):
+    # Every host goes through its own phases independently. The only
+    # cluster-wide barrier is setupHosts, which needs every private IP.
+    # formatHdfs is the last phase on the NameNode, right after its config.
+    # With resume=true, only the phases that failed, never ran or whose
+    # inputs changed since the last bootstrap run, on the hosts that need
+    # them.
+    global CLUSTER_COMPRESSION
+    resume = stepJournal.isTrue(resume)
+    if not resume:
+        stepJournal.reset(BOOTSTRAP_JOURNAL)
+
+    phaseNames = []
+    phaseTimings = {}
+
+    stageDurations = []
+
+    with settings(pool_size=int(poolSize)):
+        if HADOOP_PACKAGE_FANOUT:
+            start = time.time()
+            execute(distributePackage)
+            stageDurations.append(("distribution", time.time() - start))
+
+        if DATA_DISKS:
+            start = time.time()
+            execute(prepareDataDisks)
+            execute(configureDataDirs)
+            stageDurations.append(("data disks", time.time() - start))
+
+        if YARN_AUTO_SIZING:
+            execute(sizeResources)
+
+        # Not every host has Hadoop to check the codec with until the host
+        # phases are done, so compression is turned on after them
+        deferCompression = COMPRESSION and COMPRESSION_MISSING_NATIVE == "warn"
+        if deferCompression:
+            CLUSTER_COMPRESSION = False
+
+        # Read once, every host skips the phases it already went through
+        hosts = env.hosts
+        journal = None
+        if resume:
+            journal = stepJournal.readJournal(BOOTSTRAP_JOURNAL)
+            hosts = [host for host in env.hosts if stepJournal.pendingSteps(
+                journal, host, bootstrapInputs(host))]
+            print("Resuming bootstrap on %d of %d hosts" % (len(hosts), len(env.hosts)))
+
+        start = time.time()
+        # Hosts that fail are dropped from the rest of the run, as long as the
+        # failure budget allows
+        hostResults = (fanOut.runTask(bootstrapHost, list(hosts), journal,
+                                      what="Bootstrapping the hosts") if hosts else {})
+        for host, hostTimings in hostResults.items():
+            for phaseName, duration in hostTimings:
+                if phaseName not in phaseTimings:
+                    phaseNames.append(phaseName)
+                    phaseTimings[phaseName] = {}
+                phaseTimings[phaseName][host] = duration
+        stageDurations.append(("host phases", time.time() - start))
+
+        start = time.time()
+        execute(setupHosts)
+        stageDurations.append(("setupHosts", time.time() - start))
+
+        if deferCompression:
+            CLUSTER_COMPRESSION = None
+            if clusterCompression():
+                execute(config)
+
+    printBootstrapTimings(phaseNames, phaseTimings, stageDurations)
+
+
+@parallel
+def bootstrapHost(journal=None):
+    phases = {
+        "storage": mountInstanceStorage,
+        "directories": ensureImportantDirectoriesExist,
+        "dependencies": installDependencies,
+        "install": install,
+        "environment": setupEnvironment,
+        "config": config,
+        "format": formatHdfs,
+    }
+    timings = []
+
+    for phaseName, inputs in bootstrapInputs(env.host):
+        duration = stepJournal.runStep(BOOTSTRAP_JOURNAL, phaseName, inputs,
+                                       phases[phaseName], journal)
+        if duration is not None:
+            timings.append((phaseName, duration))
+
+    return timings
+
+
+def bootstrapInputs(host):
+    # The bootstrap phases of host, in order, with the values each one
+    # depends on. A phase is repeated on resume when they change.
+    phases = [
+        ("storage", [EC2_INSTANCE_STORAGEDEV]),
+        ("directories", [IMPORTANT_DIRS, HOST_DATA_DIRS.get(host, []),
+                         SHORT_CIRCUIT_READS and SHORT_CIRCUIT_SOCKET_PATH]),
+        ("dependencies", [REQUIREMENTS_PRE_COMMANDS, REQUIREMENTS,
+                          COMPRESSION and COMPRESSION_REQUIREMENTS]),
+        ("install", [packageUrl(), packageChecksum(), HADOOP_PREFIX]),
+        ("environment", [ENVIRONMENT_FILE, ENVIRONMENT_VARIABLES, ENVIRONMENT_FILE_CLEAN]),
+        # Extracting the package overwrites the configuration files
+        ("config", [packageUrl(), HADOOP_PREFIX, hostSiteValues(host),
+                    COMPRESSION and [COMPRESSION_CODEC, COMPRESSION_JOB_OUTPUT]]),
+    ]
+
+    if hostRoles.hasRole(host, ["namenode"]):
+        phases.append(("format", [HADOOP_PREFIX, HDFS_NAME_DIR]))
+
+    return phases
+
+
+@runs_once
+def bootstrapStatus():
+    # Where each host stands in the last bootstrap, see bootstrap:resume=true
+    if YARN_AUTO_SIZING:
+        sizeResources()
+
+    if DATA_DISKS:
+        configureDataDirs()
+
+    stepJournal.printStatus(BOOTSTRAP_JOURNAL, dict((host, bootstrapInputs(host))
+                                                    for host in env.hosts))
+
+
+def mountInstanceStorage():
     with settings(warn_only=True):
         if EC2_INSTANCE_STORAGEDEV and run("mountpoint /mnt").failed:
             sudo("mkfs.ext4 %s" % EC2_INSTANCE_STORAGEDEV)
             sudo("mount %s /mnt" % EC2_INSTANCE_STORAGEDEV)
             sudo("chmod 0777 /mnt")
             sudo("rm -rf /tmp/hadoop-ubuntu")
-    ensureImportantDirectoriesExist()
-    installDependencies()
-    install()
-    setupEnvironment()
-    config()
-    setupHosts()
-    formatHdfs()
 
 
 def ensureImportantDirectoriesExist():
-    for importantDir in IMPORTANT_DIRS:
-        ensureDirectoryExists(importantDir)
+    run("mkdir -p %s" % " ".join(IMPORTANT_DIRS + HOST_DATA_DIRS.get(env.host, [])))
+    if SHORT_CIRCUIT_READS:
+        createDomainSocketDirectory()
 
 
 def installDependencies():
@@ -267,263 +675,1484 @@ def installDependencies():
         sudo(command)
     for requirement in REQUIREMENTS:
         sudo(PACKAGE_MANAGER_INSTALL % requirement)
+    if COMPRESSION:
+        for requirement in COMPRESSION_REQUIREMENTS:
+            sudo(PACKAGE_MANAGER_INSTALL % requirement)
 
 
 def install():
     installDirectory = os.path.dirname(HADOOP_PREFIX)
     run("mkdir -p %s" % installDirectory)
+    artifactCache.ensureRemoteArtifact(packageUrl(), remotePackagePath(), packageChecksum())
     with cd(installDirectory):
-        with settings(warn_only=True):
-            if run("test -f %s.tar.gz" % HADOOP_PACKAGE).failed:
-                run("wget -O %s.tar.gz %s" % (HADOOP_PACKAGE, HADOOP_PACKAGE_URL))
         run("tar --overwrite -xf %s.tar.gz" % HADOOP_PACKAGE)
 
 
+@runs_once
+def distributePackage(url=None):
+    # With url, that package is also the one install uses for the rest of
+    # the run, e.g. fab distributePackage:url=... bootstrap
+    global PACKAGE_URL
+    if url:
+        PACKAGE_URL = url
+
+    start = time.time()
+    localPath, checksum = artifactCache.fetchArtifact(packageUrl(), packageChecksum())
+    packageSize = os.path.getsize(localPath)
+
+    # The hosts only serve the package on their private IP. The ones whose
+    # private IP isn't known get it from install instead.
+    privateIps = retrievePrivateIps()
+    hosts = [host for host in env.hosts if host in privateIps]
+
+    packageStatus = execute(checkPackage, checksum, hosts=hosts)
+    holders = [host for host in hosts if packageStatus.get(host)]
+    pending = [host for host in hosts if not packageStatus.get(host)]
+
+    if not pending:
+        print("Package already present on every host")
+        return
+
+    receivedCount = len(pending)
+
+    if not holders:
+        seed = pending.pop(0)
+        execute(seedPackage, localPath, checksum, hosts=[seed])
+        holders.append(seed)
+
+    try:
+        execute(startPackageServer, privateIps, hosts=holders)
+
+        # Every round, each host holding the package serves one host that
+        # doesn't have it yet, so the number of holders doubles per round.
+        while pending:
+            receivers = pending[:len(holders)]
+            pending = pending[len(holders):]
+            sources = dict(zip(receivers, holders))
+            execute(fetchPackageFromPeer, sources, checksum, privateIps, hosts=receivers)
+            holders += receivers
+    finally:
+        execute(stopPackageServer, hosts=holders)
+
+    duration = time.time() - start
+    megabytes = packageSize * receivedCount / (1024.0 * 1024.0)
+    print("Distributed %.1f MB to %d hosts in %.1fs (%.1f MB/s aggregate)" %
+          (megabytes, receivedCount, duration, megabytes / duration))
+
+
 def config():
-    changeHadoopProperties("core-site.xml", CORE_SITE_VALUES)
-    changeHadoopProperties("hdfs-site.xml", HDFS_SITE_VALUES)
-    changeHadoopProperties("yarn-site.xml", YARN_SITE_VALUES)
-    changeHadoopProperties("mapred-site.xml", MAPRED_SITE_VALUES)
+    if YARN_AUTO_SIZING:
+        sizeResources()
+
+    if DATA_DISKS:
+        configureDataDirs()
+
+    siteValues = hostSiteValues(env.host)
+
+    if COMPRESSION:
+        siteValues["mapred-site.xml"].update(compressionSiteValues())
+
+    changeHadoopProperties(siteValues)
+
+
+def hostSiteValues(host):
+    # Configuration values of host, except the ones that depend on what the
+    # host itself supports (compression)
+    siteValues = {
+        "core-site.xml": dict(CORE_SITE_VALUES),
+        "hdfs-site.xml": dict(HDFS_SITE_VALUES),
+        "yarn-site.xml": dict(YARN_SITE_VALUES),
+        "mapred-site.xml": dict(MAPRED_SITE_VALUES),
+    }
+
+    for fileName, values in HOST_SITE_VALUES.get(host, {}).items():
+        siteValues[fileName].update(values)
+
+    if SHORT_CIRCUIT_READS:
+        siteValues["hdfs-site.xml"].update({
+            "dfs.client.read.shortcircuit": "true",
+            "dfs.domain.socket.path": SHORT_CIRCUIT_SOCKET_PATH,
+        })
+
+    return siteValues
+
+
+@runs_once
+def prepareDataDisks():
+    facts = hostFacts.gatherFacts(env.hosts, ["blockDevices", "mounts"])
+    newDisks = {}
+
+    for host in facts:
+        mountPoints = dataDiskMountPoints(facts[host])
+        # The instance storage device is mountInstanceStorage's
+        disks = hostFacts.dataDisks(facts[host], DATA_DISKS_REFORMAT,
+                                    [os.path.basename(EC2_INSTANCE_STORAGEDEV or "")])
+        firstIndex = 0
+        if mountPoints:
+            firstIndex = int(mountPoints[-1][len(DATA_DISKS_MOUNT_PREFIX):]) + 1
+        newDisks[host] = [("/dev/%s" % disk["name"],
+                           "%s%d" % (DATA_DISKS_MOUNT_PREFIX, firstIndex + i))
+                          for i, disk in enumerate(disks)]
+
+    hostsWithNewDisks = [host for host in facts if newDisks[host]]
+
+    if hostsWithNewDisks:
+        try:
+            execute(mountDataDisks, newDisks, hosts=hostsWithNewDisks)
+        finally:
+            hostFacts.clearFacts(hostsWithNewDisks)
+
+
+@parallel
+def mountDataDisks(newDisks):
+    # Format and mount all the disks of this host at the same time, waiting
+    # for each one so that any failure is noticed
+    commands = ["(%(mkfs)s %(dev)s && mkdir -p %(mnt)s && "
+                "mount -o noatime %(dev)s %(mnt)s && chown %(user)s %(mnt)s && "
+                "echo mounted %(dev)s %(mnt)s) & pids=\"$pids $!\";" %
+                {"mkfs": DATA_DISKS_MKFS, "dev": device, "mnt": mountPoint,
+                 "user": SSH_USER}
+                for device, mountPoint in newDisks[env.host]]
+    commands.append("status=0; for pid in $pids; do wait $pid || status=1; done; exit $status")
+
+    with settings(warn_only=True):
+        result = sudo("sh -c '%s'" % " ".join(commands))
+
+    mounted = [line.split()[1:3] for line in result.splitlines()
+               if line.startswith("mounted ")]
+    for device, mountPoint in mounted:
+        print("Mounted %s on %s" % (device, mountPoint))
+
+    if result.failed:
+        abort("Couldn't format and mount %s" % ", ".join(
+            device for device, mountPoint in newDisks[env.host]
+            if [device, mountPoint] not in mounted))
+
+
+@runs_once
+def configureDataDirs():
+    facts = hostFacts.gatherFacts(env.hosts, ["mounts"])
+
+    for host in facts:
+        mountPoints = dataDiskMountPoints(facts[host])
+
+        if not mountPoints:
+            continue
+
+        dataDirs = [os.path.join(mountPoint, "hdfs/datanode") for mountPoint in mountPoints]
+        localDirs = [os.path.join(mountPoint, "yarn/local") for mountPoint in mountPoints]
+        logDirs = [os.path.join(mountPoint, "yarn/logs") for mountPoint in mountPoints]
+        # hadoop.tmp.dir only takes a single directory
+        tempDir = os.path.join(mountPoints[0], "hadoop/tmp")
+
+        HOST_DATA_DIRS[host] = dataDirs + localDirs + logDirs + [tempDir]
+        setHostSiteValues(host, "core-site.xml", {"hadoop.tmp.dir": tempDir})
+        setHostSiteValues(host, "hdfs-site.xml", {
+            "dfs.datanode.data.dir": ",".join("file://%s" % d for d in dataDirs),
+        })
+        setHostSiteValues(host, "yarn-site.xml", {
+            "yarn.nodemanager.local-dirs": ",".join(localDirs),
+            "yarn.nodemanager.log-dirs": ",".join(logDirs),
+        })
+
+
+@runs_once
+def sizeResources():
+    facts = hostFacts.gatherFacts(slaveHosts(), ["cpuCount", "memoryMb", "blockDevices"])
+    hostSizing = dict((host, computeHostSizing(facts[host])) for host in facts)
+
+    # Containers must fit on every slave, so they're sized for the smallest
+    containerMb = min(sizing["containerMb"] for sizing in hostSizing.values())
+    maxContainerMb = max(sizing["memoryMb"] for sizing in hostSizing.values())
+    maxContainerVcores = max(sizing["vcores"] for sizing in hostSizing.values())
+    # Reduce and AM containers get twice as much memory, as long as that
+    # fits on the smallest NodeManager. The scheduler hands out memory in
+    # multiples of the minimum allocation, so this is one as well.
+    minNodeManagerMb = min(sizing["memoryMb"] for sizing in hostSizing.values())
+    largeContainerMb = min(2 * containerMb, minNodeManagerMb) // containerMb * containerMb
+
+    fittingHosts = [host for host, sizing in hostSizing.items()
+                    if sizing["memoryMb"] >= largeContainerMb]
+    if not fittingHosts:
+        abort("No slave has room for a %dMB reduce container" % largeContainerMb)
+    if largeContainerMb < 2 * containerMb:
+        warn("The smallest slave only has %dMB for containers, reduce and AM "
+             "containers get %dMB instead of %dMB" %
+             (minNodeManagerMb, largeContainerMb, 2 * containerMb))
+
+    for host, sizing in hostSizing.items():
+        setHostSiteValues(host, "yarn-site.xml", {
+            "yarn.nodemanager.resource.memory-mb": sizing["memoryMb"],
+            "yarn.nodemanager.resource.cpu-vcores": sizing["vcores"],
+        })
+
+    YARN_SITE_VALUES.update({
+        "yarn.scheduler.minimum-allocation-mb": containerMb,
+        "yarn.scheduler.maximum-allocation-mb": maxContainerMb,
+        "yarn.scheduler.minimum-allocation-vcores": 1,
+        "yarn.scheduler.maximum-allocation-vcores": maxContainerVcores,
+    })
+
+    MAPRED_SITE_VALUES.update({
+        "yarn.app.mapreduce.am.resource.mb": largeContainerMb,
+        "yarn.app.mapreduce.am.command-opts": heapOpts(largeContainerMb),
+        "mapreduce.map.memory.mb": containerMb,
+        "mapreduce.map.java.opts": heapOpts(containerMb),
+        "mapreduce.reduce.memory.mb": largeContainerMb,
+        "mapreduce.reduce.java.opts": heapOpts(largeContainerMb),
+    })
+
+    printPackingReport(facts, hostSizing, containerMb, largeContainerMb)
 
 
 def configRevertPrevious():
-    revertHadoopPropertiesChange("core-site.xml")
-    revertHadoopPropertiesChange("hdfs-site.xml")
-    revertHadoopPropertiesChange("yarn-site.xml")
-    revertHadoopPropertiesChange("mapred-site.xml")
+    remotePipeline.runPipelined([restoreBackupCommand(os.path.join(HADOOP_CONF, fileName))
+                                 for fileName in CONFIGURATION_FILES])
 
 
 def setupEnvironment():
-    with settings(warn_only=True):
-        if not run("test -f %s" % ENVIRONMENT_FILE).failed:
-            op = "cp"
+    currentContents = readRemoteFile(ENVIRONMENT_FILE)
+    backupOp = None
 
-            if ENVIRONMENT_FILE_CLEAN:
-                op = "mv"
+    if currentContents is not None:
+        backupOp = "cp"
 
-            currentBakNumber = getLastBackupNumber(ENVIRONMENT_FILE) + 1
-            run("%(op)s %(file)s %(file)s.bak%(bakNumber)d" %
-                {"op": op, "file": ENVIRONMENT_FILE, "bakNumber": currentBakNumber})
+        if ENVIRONMENT_FILE_CLEAN:
+            backupOp = "mv"
+            currentContents = ""
 
-    run("touch %s" % ENVIRONMENT_FILE)
+    newContents, changedVariables = mergeEnvironmentVariables(
+            currentContents or "", ENVIRONMENT_VARIABLES)
+    replaceRemoteFile(ENVIRONMENT_FILE, newContents, backupOp)
 
-    for variable, value in ENVIRONMENT_VARIABLES:
-        lineNumber = run("grep -n 'export\s\+%(var)s\=' '%(file)s' | cut -d : -f 1" %
-                {"var": variable, "file": ENVIRONMENT_FILE})
-        try:
-            lineNumber = int(lineNumber)
-            run("sed -i \"" + str(lineNumber) + "s@.*@export %(var)s\=%(val)s@\" '%(file)s'" %
-                {"var": variable, "val": value, "file": ENVIRONMENT_FILE})
-        except ValueError:
-            run("echo \"export %(var)s=%(val)s\" >> \"%(file)s\"" %
-                {"var": variable, "val": value, "file": ENVIRONMENT_FILE})
+    if changedVariables:
+        print("Changed environment variables: {}".format(", ".join(changedVariables)))
+    else:
+        print("No environment variables changed")
 
 
 def environmentRevertPrevious():
     revertBackup(ENVIRONMENT_FILE)
 
 
+@hostRoles.targets("namenode")
 def formatHdfs():
-    if env.host == NAMENODE_HOST:
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hdfs namenode -format")
+    operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hdfs namenode -format")
 
 
 @runs_once
 def setupHosts():
-    privateIps = execute(getPrivateIp)
-    execute(updateHosts, privateIps)
+    privateIps = retrievePrivateIps()
+    if EXECUTION_ENGINE == "async":
+        updateHostsAsync(privateIps)
+    else:
+        fanOut.runTask(updateHosts, env.hosts, privateIps)
 
     if env.host == RESOURCEMANAGER_HOST:
-        run("rm -f privateIps")
-        run("touch privateIps")
-
-        for host, privateIp in privateIps.items():
-            run("echo '%s' >> privateIps" % privateIp)
+        privateIpList = "".join("%s\n" % privateIp for privateIp in privateIps.values())
+        put(BytesIO(privateIpList.encode("utf-8")), "privateIps")
 
 
+@runs_once
 def start():
-    operationOnHadoopDaemons("start")
+    # Masters first, each one gated on its ports, then every worker at once,
+    # until all DataNodes and NodeManagers have registered
+    startDaemons()
 
 
+@runs_once
 def stop():
-    operationOnHadoopDaemons("stop")
+    stopDaemons()
 
 
+@hostRoles.targets("resourcemanager")
 def test():
-    if env.host == RESOURCEMANAGER_HOST:
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hadoop jar \\$HADOOP_PREFIX/share/hadoop/yarn/hadoop-yarn-applications-distributedshell-%(version)s.jar org.apache.hadoop.yarn.applications.distributedshell.Client --jar \\$HADOOP_PREFIX/share/hadoop/yarn/hadoop-yarn-applications-distributedshell-%(version)s.jar --shell_command date --num_containers %(numContainers)d --master_memory 1024" %
-            {"version": HADOOP_VERSION, "numContainers": len(SLAVE_HOSTS)})
+    operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hadoop jar \\$HADOOP_PREFIX/share/hadoop/yarn/hadoop-yarn-applications-distributedshell-%(version)s.jar org.apache.hadoop.yarn.applications.distributedshell.Client --jar \\$HADOOP_PREFIX/share/hadoop/yarn/hadoop-yarn-applications-distributedshell-%(version)s.jar --shell_command date --num_containers %(numContainers)d --master_memory 1024" %
+        {"version": HADOOP_VERSION, "numContainers": len(slaveHosts())})
 
 
+@hostRoles.targets("resourcemanager")
 def testMapReduce():
-    if env.host == RESOURCEMANAGER_HOST:
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hadoop dfs -rm -f -r out")
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hadoop jar \\$HADOOP_PREFIX/share/hadoop/mapreduce/hadoop-mapreduce-examples-%s.jar randomwriter out" % HADOOP_VERSION)
+    operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hadoop dfs -rm -f -r out")
+    operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hadoop jar \\$HADOOP_PREFIX/share/hadoop/mapreduce/hadoop-mapreduce-examples-%s.jar randomwriter out" % HADOOP_VERSION)
+
+
+@runs_once
+def benchmark(*suites):
+    # Run the given benchmark suites (all of them by default) on the
+    # ResourceManager, e.g. fab benchmark:terasort,dfsio. The results are
+    # stored locally and compared with the previous run of each benchmark.
+    suites = list(suites) or BENCHMARK_SUITES
+    unknownSuites = [suite for suite in suites if suite not in BENCHMARK_SUITES]
+    if unknownSuites:
+        print("Unknown benchmark suites %s (available: %s)" %
+              (", ".join(unknownSuites), ", ".join(BENCHMARK_SUITES)))
+        return
+
+    regressions = runAndRecordBenchmarks(suites)[1]
+
+    if regressions:
+        print("%d metrics regressed by more than %d%%" %
+              (regressions, BENCHMARK_REGRESSION_THRESHOLD * 100))
+
+
+@runs_once
+def benchmarkHistory(name=None):
+    benchmarkResults.printHistory(
+        benchmarkResults.readHistory(BENCHMARK_HISTORY_FILE), name)
+
+
+@runs_once
+def sweep(restart="false", apply="false"):
+    # Try every point of SWEEP_PARAMETERS, resuming the previous sweep unless
+    # it was for another search (or restart=true). At the end the best point
+    # is applied with apply=true, otherwise the original values are restored.
+    if YARN_AUTO_SIZING:
+        sizeResources()
+
+    if DATA_DISKS:
+        configureDataDirs()
+
+    points = parameterSweep.sweepPoints(SWEEP_PARAMETERS, SWEEP_MODE,
+                                        SWEEP_SAMPLES, SWEEP_SEED)
+    spaceHash = parameterSweep.spaceHash(SWEEP_PARAMETERS, SWEEP_MODE, SWEEP_SAMPLES,
+        SWEEP_SEED, SWEEP_BENCHMARK, SWEEP_METRIC, benchmarkParameters())
+
+    state = parameterSweep.readState(SWEEP_STATE_FILE)
+    if stepJournal.isTrue(restart) or state.get("spaceHash") != spaceHash:
+        state = {"spaceHash": spaceHash, "scores": {}}
+    elif state["scores"]:
+        print("Resuming sweep, %d of %d points already done" %
+              (len(state["scores"]), len(points)))
+
+    benchmarkName, metricName = SWEEP_METRIC.split(".", 1)
+    higherIsBetter = benchmarkResults.higherIsBetter(metricName)
+    originalValues = dict((fileName, dict((name, siteValues(fileName).get(name))
+                                          for name in names))
+                          for fileName, names in SWEEP_PARAMETERS.items())
+    # Swept values win over the per host ones, which are put back at the end
+    originalHostValues = copy.deepcopy(HOST_SITE_VALUES)
+    # Values currently deployed, those of the interrupted point on resume
+    appliedValues = state.get("applied", originalValues)
+
+    for index, point in enumerate(points):
+        if str(index) in state["scores"]:
+            continue
+
+        print("Sweep point %d/%d: %s" % (index + 1, len(points),
+                                         parameterSweep.formatPoint(point)))
+        applySweepPoint(appliedValues, point)
+        appliedValues = state["applied"] = point
+        parameterSweep.writeState(SWEEP_STATE_FILE, state)
+
+        benchmarkRun = runAndRecordBenchmarks([SWEEP_BENCHMARK])[0]
+        state["scores"][str(index)] = \
+            benchmarkRun["results"][benchmarkName]["metrics"].get(metricName)
+        parameterSweep.writeState(SWEEP_STATE_FILE, state)
+
+    bestIndex = parameterSweep.printReport(points, state["scores"], SWEEP_METRIC,
+                                           higherIsBetter)
+
+    if bestIndex is not None and stepJournal.isTrue(apply):
+        print("Applying best point: %s" % parameterSweep.formatPoint(points[bestIndex]))
+        applySweepPoint(appliedValues, points[bestIndex])
+    else:
+        # Properties that weren't set before (None) are removed again
+        applySweepPoint(appliedValues, originalValues, originalHostValues)
+
+
+def benchmarkPipelining(commandCount=20):
+    # Per command latency of this host, one by one vs pipelined
+    sequential, pipelined = remotePipeline.measurePipelining(int(commandCount))
+    print("%s: %.1fms per command, %.1fms pipelined" %
+          (env.host, sequential * 1000, pipelined * 1000))
+
+
+@runs_once
+def checkNative():
+    # Native libraries (libhadoop, zlib, snappy, lz4...) each host can load
+    printNativeLibraries(execute(readNativeLibraries))
+
+
+@runs_once
+def benchmarkCompression():
+    # TeraSort of the same data without and with COMPRESSION_CODEC on the
+    # map output (and job output if COMPRESSION_JOB_OUTPUT), whatever the
+    # deployed configuration says
+    hostLibraries = execute(readNativeLibraries)
+    missingHosts = [host for host in slaveHosts()
+                    if not nativeCodecLoads(hostLibraries[host])]
+    if missingHosts:
+        abort("%s can't be loaded natively on %s (see checkNative)" %
+              (COMPRESSION_CODEC, ", ".join(missingHosts)))
+
+    results = execute(runCompressionBenchmark, hosts=[RESOURCEMANAGER_HOST])
+    benchmarkResults.printVariants("terasort", ["uncompressed", COMPRESSION_CODEC],
+                                   results[RESOURCEMANAGER_HOST])
+
+
+@runs_once
+def shortCircuitReads(benchmark="true"):
+    # Provision short-circuit local reads on a running cluster: check that
+    # every DataNode loads libhadoop, create the socket directories, push the
+    # HDFS settings and restart the DataNodes. With benchmark=true, TestDFSIO
+    # read throughput is measured before and after.
+    global SHORT_CIRCUIT_READS
+
+    missingHosts = sorted(host for host, libraries in
+                          execute(readNativeLibraries, hosts=slaveHosts()).items()
+                          if not libraries.get("hadoop"))
+    if missingHosts:
+        abort("Short-circuit reads need libhadoop, which can't be loaded on %s "
+              "(see checkNative)" % ", ".join(missingHosts))
+
+    before = None
+    if stepJournal.isTrue(benchmark):
+        before = execute(runDFSIO, hosts=[RESOURCEMANAGER_HOST])[RESOURCEMANAGER_HOST]
+
+    SHORT_CIRCUIT_READS = True
+    execute(createDomainSocketDirectory, hosts=slaveHosts())
+    execute(config)
+    restartDaemons(["datanode"])
+
+    # The DataNodes only create the socket when short-circuit reads work
+    inactiveHosts = sorted(host for host, active in
+                           execute(domainSocketExists, hosts=slaveHosts()).items()
+                           if not active)
+    if inactiveHosts:
+        warn("No DataNode socket at %s on %s, short-circuit reads are inactive there" %
+             (SHORT_CIRCUIT_SOCKET_PATH, ", ".join(inactiveHosts)))
+    else:
+        print("Short-circuit reads active on all %d DataNodes" % len(slaveHosts()))
+
+    if before is not None:
+        after = execute(runDFSIO, hosts=[RESOURCEMANAGER_HOST])[RESOURCEMANAGER_HOST]
+        benchmarkResults.printVariants("dfsioRead", ["TCP", "short-circuit"],
+            [before["dfsioRead"]["metrics"], after["dfsioRead"]["metrics"]])
+
+    print("Set SHORT_CIRCUIT_READS = True so that bootstrap and config keep them")
 
 
 # HELPER FUNCTIONS
 def ensureDirectoryExists(directory):
+    run("mkdir -p %s" % directory)
+
+
+def createDomainSocketDirectory():
+    sudo("mkdir -p %(dir)s && chown %(user)s %(dir)s && chmod 0755 %(dir)s" %
+         {"dir": os.path.dirname(SHORT_CIRCUIT_SOCKET_PATH), "user": SSH_USER})
+
+
+@parallel
+def domainSocketExists():
     with settings(warn_only=True):
-        if run("test -d %s" % directory).failed:
-            run("mkdir -p %s" % directory)
+        return run("test -S %s" % SHORT_CIRCUIT_SOCKET_PATH).succeeded
+
+
+def retrievePrivateIps():
+    # On EC2, the inventory already knows every private IP
+    if EC2 and all(host in EC2_PRIVATE_IPS for host in env.hosts):
+        return dict((host, EC2_PRIVATE_IPS[host]) for host in env.hosts)
+
+    # Only the hosts that answered with an address, within the failure budget
+    if EC2 and EXECUTION_ENGINE == "async":
+        results = fanOut.runCommand(env.hosts,
+            "wget -qO- http://instance-data/latest/meta-data/local-ipv4",
+            "Retrieving the private IPs",
+            failed=lambda result: result.failed or not result.strip())
+        return dict((host, result.strip()) for host, result in results.items())
+
+    if EC2:
+        return fanOut.runTask(getPrivateIp, env.hosts)
+
+    facts = hostFacts.gatherFacts(env.hosts, ["interfaces"])
+    return hostFacts.privateIps(facts, NET_INTERFACE)
 
 
 @parallel
 def getPrivateIp():
     if not EC2:
-        return run("ifconfig %s | grep 'inet\s\+' | awk '{print $2}' | cut -d':' -f2" % NET_INTERFACE).strip()
+        privateIp = run(r"ifconfig %s | grep 'inet\s\+' | awk '{print $2}' | cut -d':' -f2" % NET_INTERFACE).strip()
+    elif env.host in EC2_PRIVATE_IPS:
+        privateIp = EC2_PRIVATE_IPS[env.host]
     else:
-        return run("wget -qO- http://instance-data/latest/meta-data/local-ipv4")
+        privateIp = run("wget -qO- http://instance-data/latest/meta-data/local-ipv4").strip()
+
+    if not privateIp:
+        abort("No private IP for %s" % env.host)
+    return privateIp
 
 
 @parallel
 def updateHosts(privateIps):
-    with settings(warn_only=True):
-        if not run("test -f %s" % HOSTS_FILE).failed:
-            currentBakNumber = getLastBackupNumber(HOSTS_FILE) + 1
-            sudo("cp %(file)s %(file)s.bak%(bakNumber)d" %
-                {"file": HOSTS_FILE, "bakNumber": currentBakNumber})
+    currentContents = readRemoteFile(HOSTS_FILE)
+    backupOp = None
 
-    sudo("touch %s" % HOSTS_FILE)
+    if currentContents is not None:
+        backupOp = "cp"
 
-    for host, privateIp in privateIps.items():
-        lineNumber = run("grep -n -F -w -m 1 '%(ip)s' '%(file)s' | cut -d : -f 1" %
-                {"ip": privateIp, "file": HOSTS_FILE})
-        try:
-            lineNumber = int(lineNumber)
-            sudo("sed -i \"" + str(lineNumber) + "s@.*@%(ip)s %(host)s@\" '%(file)s'" %
-                {"host": host, "ip": privateIp, "file": HOSTS_FILE})
-        except ValueError:
-            sudo("echo \"%(ip)s %(host)s\" >> \"%(file)s\"" %
-                {"host": host, "ip": privateIp, "file": HOSTS_FILE})
+    newContents = renderHostsFile(currentContents or "", privateIps)
+    replaceRemoteFile(HOSTS_FILE, newContents, backupOp, useSudo=True)
+
+
+def updateHostsAsync(privateIps):
+    # Same as updateHosts, for every host at once with the async engine
+    with settings(hide("stdout")):
+        currentFiles = fanOut.runCommand(env.hosts, "cat %s 2>/dev/null; true" % HOSTS_FILE,
+                                         "Reading %s" % HOSTS_FILE)
 
+    newFiles = dict((host, renderHostsFile(currentFiles[host], privateIps))
+                    for host in currentFiles)
+    fanOut.runCommand(list(newFiles),
+        "staged=$(mktemp %(file)s.fabric.XXXXXXXXXX) && cat > $staged && %(keepMode)s && "
+        "%(backup)s && mv $staged %(file)s" %
+        {"keepMode": keepModeCommand(HOSTS_FILE, "$staged", True),
+         "backup": backupCommand(HOSTS_FILE, "cp"), "file": HOSTS_FILE},
+        "Updating %s" % HOSTS_FILE, useSudo=True, stdin=lambda host: newFiles[host])
 
-def getLastBackupNumber(filePath):
-    dirName = os.path.dirname(filePath)
+
+def readRemoteFile(filePath):
+    contents = BytesIO()
+
+    with settings(warn_only=True):
+        if get(filePath, contents).failed:
+            return None
+
+    return contents.getvalue().decode("utf-8")
+
+
+def replaceRemoteFile(filePath, contents, backupOp=None, useSudo=False):
+    # Upload to a temporary file of this run, copy it next to the target and
+    # swap it in with a single mv so readers never see a partially written
+    # file. It keeps the mode (and with sudo, the owner) of the file it
+    # replaces. If backupOp is given, the previous version is first
+    # copied/moved to the next .bakN.
+    runner = sudo if useSudo else run
+    with hide("stdout"):
+        tempPath = run("mktemp /tmp/%s.fabric.XXXXXXXXXX" % os.path.basename(filePath)).strip()
+    put(BytesIO(contents.encode("utf-8")), tempPath)
+
+    # Not named like the .bakN backups, which backupCommand looks for
+    commands = ["staged=$(mktemp %s.fabric.XXXXXXXXXX)" % filePath,
+                "cp %s $staged" % tempPath,
+                keepModeCommand(filePath, "$staged", useSudo)]
+    if backupOp:
+        commands.append(backupCommand(filePath, backupOp))
+    commands.append("mv $staged %s" % filePath)
+    commands.append("rm -f %s" % tempPath)
+    runner(" && ".join(commands))
+
+
+def keepModeCommand(filePath, newPath, keepOwner=False):
+    # Gives newPath the mode of filePath (and with keepOwner, which needs
+    # root, its owner), or 644 when there is no filePath yet
+    command = "chmod --reference=%(file)s %(new)s"
+    if keepOwner:
+        command += " && chown --reference=%(file)s %(new)s"
+
+    return ("if [ -e %(file)s ]; then " + command + "; else chmod 644 %(new)s; fi") % \
+        {"file": filePath, "new": newPath}
+
+
+def mergeEnvironmentVariables(contents, variables):
+    """Return the environment file contents with every variable exported to
+    its new value, along with the names of the variables that changed.
+    """
+    lines = contents.splitlines()
+    changedVariables = []
+
+    for variable, value in variables:
+        # Values are written to be shell-escaped twice (fabric + echo), so
+        # undo that to get what would actually end up in the file.
+        newLine = "export %s=%s" % (variable, value.replace(r"\\$", "$"))
+        exportRegex = re.compile(r"export\s+%s=" % re.escape(variable))
+
+        for i, line in enumerate(lines):
+            if exportRegex.search(line):
+                if line != newLine:
+                    lines[i] = newLine
+                    changedVariables.append(variable)
+                break
+        else:
+            lines.append(newLine)
+            changedVariables.append(variable)
+
+    return "\n".join(lines) + "\n", changedVariables
+
+
+def renderHostsFile(contents, privateIps):
+    """Return the hosts file contents with a single managed block mapping each
+    cluster host to its private IP. Lines outside the block are kept, except
+    for stale entries of IPs that the block now takes care of.
+    """
+    managedIps = set(privateIps.values())
+    lines = []
+    inManagedBlock = False
+
+    for line in contents.splitlines():
+        if line == HOSTS_BLOCK_BEGIN:
+            inManagedBlock = True
+        elif line == HOSTS_BLOCK_END:
+            inManagedBlock = False
+        elif not inManagedBlock:
+            fields = line.split()
+            if not fields or fields[0] not in managedIps:
+                lines.append(line)
+
+    lines.append(HOSTS_BLOCK_BEGIN)
+    for host, privateIp in sorted(privateIps.items()):
+        lines.append("%s %s" % (privateIp, host))
+    lines.append(HOSTS_BLOCK_END)
+
+    return "\n".join(lines) + "\n"
+
+
+def backupCommand(filePath, op="cp"):
+    # Op's the file to the next .bakN (after the lexically last one), as a
+    # shell command so that backups can be chained with other commands
+    # instead of costing extra round trips. Does nothing if the file is
+    # missing.
+    dirName = os.path.dirname(filePath) or "."
     fileName = os.path.basename(filePath)
 
-    with cd(dirName):
-        latestBak = run("ls -1 | grep %s.bak | tail -n 1" % fileName)
-        latestBakNumber = -1
-        if latestBak:
-            latestBakNumber = int(latestBak[len(fileName) + 4:])
-        return latestBakNumber
+    return ("if [ -f %(file)s ]; then "
+            "n=$(cd %(dir)s && ls -1 | grep %(name)s.bak | tail -n 1 | cut -c %(cut)d-); "
+            "%(op)s %(file)s %(file)s.bak$((${n:--1} + 1)); fi" %
+            {"file": filePath, "dir": dirName, "name": fileName,
+             "cut": len(fileName) + 5, "op": op})
 
 
-def changeHadoopProperties(fileName, propertyDict):
-    if not fileName or not propertyDict:
+def restoreBackupCommand(filePath):
+    # Moves the last .bakN back in place, does nothing if there is none left
+    dirName = os.path.dirname(filePath) or "."
+    fileName = os.path.basename(filePath)
+
+    return ("n=$(cd %(dir)s && ls -1 | grep %(name)s.bak | tail -n 1 | cut -c %(cut)d-); "
+            "if [ -n \"$n\" ]; then mv %(file)s.bak$n %(file)s; fi" %
+            {"file": filePath, "dir": dirName, "name": fileName,
+             "cut": len(fileName) + 5})
+
+
+def changeHadoopProperties(fileProperties):
+    # Only keep files which actually have properties to change
+    fileProperties = dict((fileName, propertyDict)
+        for fileName, propertyDict in fileProperties.items()
+        if fileName and propertyDict)
+
+    if not fileProperties:
         return
 
-    with cd(HADOOP_CONF):
-        with settings(warn_only=True):
+    fileNames = sorted(fileProperties)
+    currentFiles = readRemoteConfigurationFiles(fileNames)
+    newFiles = {}
+
+    for fileName in fileNames:
+        currentContents = currentFiles.get(fileName)
+
+        if CONFIGURATION_FILES_CLEAN or currentContents is None:
+            currentContents = ""
+
+        newContents, counts = replaceHadoopProperty.renderConfiguration(
+                currentContents, fileProperties[fileName])
+        newFiles[fileName] = newContents.encode("utf-8")
+        print("%s: %d added, %d updated, %d unchanged" % ((fileName,) + counts))
+
+    if all(currentFiles.get(fileName) == newFiles[fileName] for fileName in fileNames):
+        print("Configuration already up to date, skipping")
+        return
+
+    pushHadoopConfiguration(newFiles)
+
+
+def readRemoteConfigurationFiles(fileNames):
+    # Fetch all configuration files in one go as a base64-encoded tarball.
+    # Missing files are simply left out of the result.
+    with hide("stdout"):
+        output = run("cd %s && tar czf - --ignore-failed-read %s 2>/dev/null | base64" %
+                     (HADOOP_CONF, " ".join(fileNames)), pty=False)
+
+    currentFiles = {}
+    if not output.strip():
+        return currentFiles
+
+    with tarfile.open(fileobj=BytesIO(base64.b64decode(output)), mode="r:gz") as bundle:
+        for member in bundle.getmembers():
+            if member.isfile():
+                currentFiles[member.name] = bundle.extractfile(member).read()
+
+    return currentFiles
+
+
+def pushHadoopConfiguration(files):
+    # Send every file as a single compressed bundle, base64-encoded along
+    # with the one remote command that unpacks it into a staging directory
+    # of its own, backs up the previous versions and swaps the new ones in
+    # with their mode.
+    bundleBuffer = BytesIO()
+
+    with tarfile.open(fileobj=bundleBuffer, mode="w:gz") as bundle:
+        for fileName, contents in sorted(files.items()):
+            fileInfo = tarfile.TarInfo(fileName)
+            fileInfo.size = len(contents)
+            fileInfo.mode = 0o644
+            fileInfo.mtime = time.time()
+            bundle.addfile(fileInfo, BytesIO(contents))
+
+    bundleData = base64.b64encode(bundleBuffer.getvalue()).decode("ascii")
+
+    op = "cp"
+
+    if CONFIGURATION_FILES_CLEAN:
+        op = "mv"
+
+    commands = ["staging=$(mktemp -d .fabric-staging.XXXXXXXXXX)",
+                "echo %s | base64 -d | tar xzf - -C $staging" % bundleData]
+    for fileName in sorted(files):
+        commands.append(keepModeCommand(fileName, "$staging/" + fileName))
+        commands.append(backupCommand(fileName, op))
+        commands.append("mv $staging/%s %s" % (fileName, fileName))
+    commands.append("rmdir $staging")
+
+    # The bundle makes the command too long to be worth printing
+    with cd(HADOOP_CONF), hide("running"):
+        run(" && ".join(commands))
+
+
+def revertBackup(fileName):
+    run(restoreBackupCommand(fileName))
+
+
+def operationInHadoopEnvironment(operation):
+    with cd(HADOOP_PREFIX):
+        # Operations are escaped for the extra eval of executeInHadoopEnv.sh,
+        # the login shell alone must expand the variables itself
+        command = operation.replace(r"\\$", "$")
+        if ENVIRONMENT_FILE_NOTAUTOLOADED:
+            command = operation
             import hashlib
-            replaceHadoopPropertyHash = \
+            executeInHadoopEnvHash = \
                 hashlib.md5(
-                    open("replaceHadoopProperty.py", 'rb').read()
+                    open("executeInHadoopEnv.sh", 'rb').read()
                 ).hexdigest()
-            if run("test %s = `md5sum replaceHadoopProperty.py | cut -d ' ' -f 1`"
-                   % replaceHadoopPropertyHash).failed:
-                put("replaceHadoopProperty.py", HADOOP_CONF + "/")
-                run("chmod +x replaceHadoopProperty.py")
+            command = ("./executeInHadoopEnv.sh %s " % ENVIRONMENT_FILE) + command
+
+            # Check the helper script and run the command in the same round
+            # trip, the script is only uploaded when missing or outdated.
+            # Only the marker tells an outdated script apart from a command
+            # that exits with the same status, which mustn't run twice
+            # (e.g. namenode -format).
+            outdatedMarker = "%s%s" % (HELPER_OUTDATED_MARKER, uuid.uuid4().hex)
+            with settings(warn_only=True):
+                result = run("test %s = `md5sum executeInHadoopEnv.sh | cut -d ' ' -f 1` || "
+                             "{ echo %s >&2; exit %d; }; %s"
+                    % (executeInHadoopEnvHash, outdatedMarker, HELPER_OUTDATED_STATUS, command))
+            helperOutdated = result.return_code == HELPER_OUTDATED_STATUS and \
+                (outdatedMarker in result or outdatedMarker in result.stderr)
+            if not helperOutdated:
+                if result.failed and not env.warn_only:
+                    abort("Command failed with status %d: %s" % (result.return_code, command))
+                return result
+
+            put("executeInHadoopEnv.sh", HADOOP_PREFIX + "/")
+            run("chmod +x executeInHadoopEnv.sh")
+        return run(command)
+
+
+@hostRoles.targets("namenode", "resourcemanager", "jobhistory", "slave")
+def operationOnHadoopDaemons(operation, daemons=HADOOP_DAEMONS):
+    # Start/Stop the given daemons that run on the current host
+    for daemon in HADOOP_DAEMONS:
+        if daemon in daemons and env.host in daemonHosts(daemon):
+            operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/%s %s %s" %
+                                         (DAEMON_SCRIPTS[daemon], operation, daemon))
+
+
+def daemonHosts(daemon):
+    return hostRoles.hostsWithRole(DAEMON_ROLES[daemon])
+
 
+def slaveHosts():
+    # Without the hosts that a fan-out dropped, unlike SLAVE_HOSTS
+    return hostRoles.hostsWithRole("slave")
+
+
+def stageHosts(daemons):
+    hosts = []
+    for daemon in daemons:
+        hosts += [host for host in daemonHosts(daemon) if host not in hosts]
+    return hosts
+
+
+def startDaemons(daemons=HADOOP_DAEMONS):
+    begin = time.time()
+    readyTimes = []
+
+    with settings(pool_size=int(BOOTSTRAP_POOL_SIZE)):
+        for stage in DAEMON_STAGES:
+            stageDaemons = [daemon for daemon in stage if daemon in daemons]
+            hosts = stageHosts(stageDaemons)
+            if not hosts:
+                continue
+
+            execute(startDaemonsOnHost, stageDaemons, hosts=hosts)
+            for daemon in stageDaemons:
+                readyTimes.append((daemon, "%d hosts" % len(daemonHosts(daemon)),
+                                   time.time() - begin))
+
+    for daemon, command, pattern in [
+            ("datanode", r"\\$HADOOP_PREFIX/bin/hdfs dfsadmin -report", LIVE_DATANODES),
+            ("nodemanager", r"\\$HADOOP_PREFIX/bin/yarn node -list", RUNNING_NODEMANAGERS)]:
+        slaveCount = len(slaveHosts())
+        if daemon in daemons and slaveCount:
+            master = NAMENODE_HOST if daemon == "datanode" else RESOURCEMANAGER_HOST
+            registered = awaitRegistration(master, command, pattern, slaveCount)
+            readyTimes.append((daemon, "%d/%d registered" % (registered, slaveCount),
+                               time.time() - begin))
+            if registered < slaveCount:
+                warn("Only %d of %d %ss registered within %ds" %
+                     (registered, slaveCount, daemon, DAEMON_READY_TIMEOUT))
+
+    printDaemonTimings("Ready", readyTimes)
+
+
+def stopDaemons(daemons=HADOOP_DAEMONS):
+    begin = time.time()
+    stopTimes = []
+
+    with settings(pool_size=int(BOOTSTRAP_POOL_SIZE)):
+        for stage in reversed(DAEMON_STAGES):
+            stageDaemons = [daemon for daemon in stage if daemon in daemons]
+            hosts = stageHosts(stageDaemons)
+            if not hosts:
+                continue
+
+            execute(stopDaemonsOnHost, stageDaemons, hosts=hosts)
+            for daemon in stageDaemons:
+                stopTimes.append((daemon, "%d hosts" % len(daemonHosts(daemon)),
+                                  time.time() - begin))
+
+    printDaemonTimings("Stopped", stopTimes)
+
+
+@parallel
+def startDaemonsOnHost(daemons):
+    operationOnHadoopDaemons("start", daemons)
+
+    ports = [port for daemon in daemons if env.host in daemonHosts(daemon)
+             for port in DAEMON_PORTS.get(daemon, [])]
+    if ports:
         with settings(warn_only=True):
-            if not run("test -f %s" % fileName).failed:
-                op = "cp"
+            opened = run(waitForPortsCommand(env.host, ports, DAEMON_READY_TIMEOUT))
+        if opened.failed:
+            abort("%s didn't open ports %s within %ds" %
+                  (env.host, ", ".join(str(port) for port in ports), DAEMON_READY_TIMEOUT))
 
-                if CONFIGURATION_FILES_CLEAN:
-                    op = "mv"
 
-                currentBakNumber = getLastBackupNumber(fileName) + 1
-                run("%(op)s %(file)s %(file)s.bak%(bakNumber)d" %
-                    {"op": op, "file": fileName, "bakNumber": currentBakNumber})
+@parallel
+def stopDaemonsOnHost(daemons):
+    operationOnHadoopDaemons("stop", daemons)
+
+
+def stopJavaCommand(timeout):
+    # SIGTERM to every Hadoop JVM, a shared deadline for all of them to exit
+    # and then SIGKILL per remaining PID. Reports the PIDs found, the ones
+    # that were killed and the elapsed milliseconds.
+    return ("pids=$(jps -l | awk '$2 ~ /^org.apache.hadoop/ {print $1}'); "
+            "begin=$(date +%%s%%N); deadline=$((SECONDS + %d)); killed=; "
+            "[ -z \"$pids\" ] || kill $pids 2> /dev/null; "
+            "for pid in $pids; do "
+            "while kill -0 $pid 2> /dev/null && [ $SECONDS -lt $deadline ]; do sleep 0.2; done; "
+            "kill -0 $pid 2> /dev/null && kill -9 $pid 2> /dev/null && killed=\"$killed $pid\"; "
+            "done; "
+            "echo pids $pids; echo killed $killed; "
+            "echo elapsed $((($(date +%%s%%N) - begin) / 1000000))" % timeout)
+
+
+def parseStopReport(result):
+    # {"pids": [...], "killed": [...], "seconds": float}, None when the host
+    # couldn't be reached or the command failed
+    fields = {}
+    for line in result.splitlines():
+        words = line.split()
+        if words:
+            fields[words[0]] = words[1:]
+
+    if result.failed or not fields.get("elapsed"):
+        return None
+    return {"pids": fields.get("pids", []), "killed": fields.get("killed", []),
+            "seconds": int(fields["elapsed"][0]) / 1000.0}
+
+
+def waitForPortsCommand(host, ports, timeout):
+    # A single remote loop (bash) instead of a round trip per attempt
+    return ("deadline=$((SECONDS + %(timeout)d)); for port in %(ports)s; do "
+            "until (echo > /dev/tcp/%(host)s/$port) 2> /dev/null; do "
+            "[ $SECONDS -lt $deadline ] || exit 1; sleep 1; done; done" %
+            {"timeout": timeout, "host": host,
+             "ports": " ".join(str(port) for port in ports)})
+
+
+def awaitRegistration(master, command, pattern, expected):
+    # Number of workers registered with the master, polled until all of
+    # them are or DAEMON_READY_TIMEOUT expires
+    deadline = time.time() + DAEMON_READY_TIMEOUT
+
+    while True:
+        with settings(hide("running", "stdout"), host_string=master, warn_only=True):
+            match = pattern.search(operationInHadoopEnvironment(command))
+        registered = int([group for group in match.groups() if group][0]) if match else 0
+
+        if registered >= expected or time.time() > deadline:
+            return registered
+        time.sleep(2)
+
+
+def runAndRecordBenchmarks(suites):
+    # Returns the run as stored in the history and the number of regressions
+    configurationFiles, results = execute(runBenchmarks, suites,
+        hosts=[RESOURCEMANAGER_HOST])[RESOURCEMANAGER_HOST]
+
+    now = time.time()
+    benchmarkRun = {
+        "time": now,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)),
+        "configHash": benchmarkResults.configHash(configurationFiles),
+        "hadoopVersion": HADOOP_VERSION,
+        "slaves": len(slaveHosts()),
+        "parameters": benchmarkParameters(),
+        "results": results,
+    }
 
-        run("touch %s" % fileName)
+    history = benchmarkResults.readHistory(BENCHMARK_HISTORY_FILE)
+    regressions = benchmarkResults.printComparison(history, benchmarkRun,
+        BENCHMARK_REGRESSION_THRESHOLD)
+    benchmarkResults.appendHistory(BENCHMARK_HISTORY_FILE, benchmarkRun)
 
-        command = "./replaceHadoopProperty.py '%s' %s" % (fileName,
-            " ".join(["'%s' '%s'" % (str(key), str(value)) for key, value in propertyDict.items()]))
-        run(command)
+    return benchmarkRun, regressions
 
 
-def revertBackup(fileName):
-    dirName = os.path.dirname(fileName)
+def benchmarkParameters():
+    return {
+        "terasortRows": BENCHMARK_TERASORT_ROWS,
+        "dfsioFiles": BENCHMARK_DFSIO_FILES,
+        "dfsioFileSizeMb": BENCHMARK_DFSIO_FILE_SIZE_MB,
+        "nnbenchMaps": BENCHMARK_NNBENCH_MAPS,
+        "nnbenchFiles": BENCHMARK_NNBENCH_FILES,
+        "mrbenchRuns": BENCHMARK_MRBENCH_RUNS,
+        "mrbenchMaps": BENCHMARK_MRBENCH_MAPS,
+    }
+
+
+def runBenchmarks(suites):
+    runners = {
+        "terasort": runTeraSort,
+        "dfsio": runDFSIO,
+        "nnbench": runNNBench,
+        "mrbench": runMRBench,
+    }
+
+    results = {}
+    for suite in suites:
+        results.update(runners[suite]())
+
+    return readRemoteConfigurationFiles(CONFIGURATION_FILES), results
+
+
+def runHadoopBenchmark(jar, arguments):
+    print("Running %s" % arguments)
+    with hide("stdout"):
+        return operationInHadoopEnvironment(
+            r"\\$HADOOP_PREFIX/bin/hadoop jar %s %s" % (jar, arguments))
+
+
+def removeBenchmarkDirectory(directory):
+    with hide("stdout"):
+        operationInHadoopEnvironment(
+            r"\\$HADOOP_PREFIX/bin/hadoop fs -rm -r -f %s" % directory)
+
+
+def examplesJar():
+    return r"\\$HADOOP_PREFIX/share/hadoop/mapreduce/hadoop-mapreduce-examples-%s.jar" % HADOOP_VERSION
+
+
+def jobclientTestsJar():
+    return r"\\$HADOOP_PREFIX/share/hadoop/mapreduce/hadoop-mapreduce-client-jobclient-%s-tests.jar" % HADOOP_VERSION
+
+
+def runTeraSort():
+    baseDir = BENCHMARK_HDFS_DIR + "/terasort"
+    removeBenchmarkDirectory(baseDir)
+
+    results = {}
+    steps = [
+        ("teragen", "teragen %d %s/input" % (BENCHMARK_TERASORT_ROWS, baseDir)),
+        ("terasort", "terasort %s/input %s/output" % (baseDir, baseDir)),
+        ("teravalidate", "teravalidate %s/output %s/report" % (baseDir, baseDir)),
+    ]
+    for name, arguments in steps:
+        start = time.time()
+        output = runHadoopBenchmark(examplesJar(), arguments)
+        results[name] = benchmarkResults.teraMetrics(output, time.time() - start,
+                                                     BENCHMARK_TERASORT_ROWS * 100)
+
+    # TeraValidate only writes error records when the output isn't sorted
+    with hide("stdout"):
+        report = operationInHadoopEnvironment(
+            r"\\$HADOOP_PREFIX/bin/hadoop fs -cat %s/report/part-*" % baseDir)
+    results["teravalidate"]["metrics"]["valid"] = "error" not in report and \
+        "misorder" not in report
+
+    removeBenchmarkDirectory(baseDir)
+    return results
+
+
+def runDFSIO():
+    arguments = "TestDFSIO -Dtest.build.data=%s/dfsio -resFile /tmp/TestDFSIO_results.log" % \
+        BENCHMARK_HDFS_DIR
+    sizes = "-nrFiles %d -fileSize %d" % (BENCHMARK_DFSIO_FILES, BENCHMARK_DFSIO_FILE_SIZE_MB)
+
+    results = {}
+    for name, operation in [("dfsioWrite", "-write"), ("dfsioRead", "-read")]:
+        output = runHadoopBenchmark(jobclientTestsJar(),
+                                    "%s %s %s" % (arguments, operation, sizes))
+        results[name] = benchmarkResults.dfsioMetrics(output)
+
+    runHadoopBenchmark(jobclientTestsJar(), "%s -clean" % arguments)
+    return results
+
+
+def runNNBench():
+    baseDir = BENCHMARK_HDFS_DIR + "/nnbench"
+    removeBenchmarkDirectory(baseDir)
+
+    results = {}
+    for name, operation in [("nnbenchCreateWrite", "create_write"),
+                            ("nnbenchOpenRead", "open_read")]:
+        startTime = int(time.time()) + BENCHMARK_NNBENCH_START_DELAY
+        output = runHadoopBenchmark(jobclientTestsJar(),
+            "nnbench -operation %s -maps %d -reduces 1 -numberOfFiles %d "
+            "-blockSize 1 -bytesToWrite 0 -baseDir %s -startTime %d" %
+            (operation, BENCHMARK_NNBENCH_MAPS, BENCHMARK_NNBENCH_FILES,
+             baseDir, startTime))
+        results[name] = benchmarkResults.nnbenchMetrics(output, operation)
+
+    removeBenchmarkDirectory(baseDir)
+    return results
+
+
+def runMRBench():
+    baseDir = BENCHMARK_HDFS_DIR + "/mrbench"
+    output = runHadoopBenchmark(jobclientTestsJar(),
+        "mrbench -numRuns %d -maps %d -reduces 1 -baseDir %s" %
+        (BENCHMARK_MRBENCH_RUNS, BENCHMARK_MRBENCH_MAPS, baseDir))
+
+    removeBenchmarkDirectory(baseDir)
+    return {"mrbench": benchmarkResults.mrbenchMetrics(output)}
+
+
+def runCompressionBenchmark():
+    baseDir = BENCHMARK_HDFS_DIR + "/compression"
+    removeBenchmarkDirectory(baseDir)
+    runHadoopBenchmark(examplesJar(), "teragen %d %s/input" %
+                       (BENCHMARK_TERASORT_ROWS, baseDir))
+
+    results = []
+    for enabled in [False, True]:
+        options = " ".join("-D%s=%s" % item
+                           for item in sorted(compressionProperties(enabled).items()))
+        start = time.time()
+        output = runHadoopBenchmark(examplesJar(), "terasort %s %s/input %s/output-%s" %
+                                    (options, baseDir, baseDir, str(enabled).lower()))
+        results.append(benchmarkResults.teraMetrics(output, time.time() - start,
+                                                    BENCHMARK_TERASORT_ROWS * 100)["metrics"])
+
+    removeBenchmarkDirectory(baseDir)
+    return results
+
+
+@parallel
+def readNativeLibraries():
+    return nativeLibraries()
+
+
+def nativeLibraries():
+    # {library: loaded} as reported by hadoop checknative on the current host
+    with settings(hide("stdout"), warn_only=True):
+        output = operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hadoop checknative")
+    return parseCheckNative(output)
+
+
+def parseCheckNative(output):
+    # e.g. "snappy:  true /usr/lib/libsnappy.so.1" or "bzip2:   false"
+    libraries = {}
+
+    for line in output.splitlines():
+        match = re.match(r"\s*(\w+):\s+(true|false)\b", line)
+        if match:
+            libraries[match.group(1)] = match.group(2) == "true"
 
-    with cd(dirName):
-        latestBakNumber = getLastBackupNumber(fileName)
+    return libraries
 
-        # We have already reverted all backups
-        if latestBakNumber == -1:
-            return
-        # Otherwise, perform reversion
+
+def nativeCodecLoads(libraries):
+    return bool(libraries.get("hadoop") and libraries.get(COMPRESSION_CODEC))
+
+
+def compressionProperties(enabled):
+    codec = COMPRESSION_CODECS[COMPRESSION_CODEC]
+    properties = {"mapreduce.map.output.compress": str(enabled).lower()}
+    if enabled:
+        properties["mapreduce.map.output.compress.codec"] = codec
+
+    if COMPRESSION_JOB_OUTPUT:
+        properties["mapreduce.output.fileoutputformat.compress"] = str(enabled).lower()
+        if enabled:
+            properties["mapreduce.output.fileoutputformat.compress.codec"] = codec
+            properties["mapreduce.output.fileoutputformat.compress.type"] = "BLOCK"
+
+    return properties
+
+
+def compressionSiteValues():
+    # Compression properties of the current host, which must be able to
+    # load the codec natively (Hadoop's Java fallback only exists for zlib)
+    if COMPRESSION_MISSING_NATIVE == "warn":
+        return compressionProperties(clusterCompression())
+
+    libraries = nativeLibraries()
+    if nativeCodecLoads(libraries):
+        return compressionProperties(True)
+
+    abort("%s can't load %s natively (libhadoop: %s, %s: %s), refusing to enable "
+          "compression" % (env.host, COMPRESSION_CODEC, libraries.get("hadoop", "not found"),
+                           COMPRESSION_CODEC, libraries.get(COMPRESSION_CODEC, "not found")))
+
+
+def clusterCompression():
+    # Compression is on everywhere or nowhere: a job compresses its map
+    # output on whichever hosts its tasks run
+    global CLUSTER_COMPRESSION
+
+    if CLUSTER_COMPRESSION is None:
+        missingHosts = sorted(host for host, libraries in
+                              execute(readNativeLibraries, hosts=slaveHosts()).items()
+                              if not nativeCodecLoads(libraries))
+        if missingHosts:
+            warn("%s can't be loaded natively on %s (see checkNative), leaving "
+                 "compression off on every host" %
+                 (COMPRESSION_CODEC, ", ".join(missingHosts[:10])))
+        CLUSTER_COMPRESSION = not missingHosts
+
+    return CLUSTER_COMPRESSION
+
+
+def siteValues(fileName):
+    return {
+        "core-site.xml": CORE_SITE_VALUES,
+        "hdfs-site.xml": HDFS_SITE_VALUES,
+        "yarn-site.xml": YARN_SITE_VALUES,
+        "mapred-site.xml": MAPRED_SITE_VALUES,
+    }[fileName]
+
+
+def applySweepPoint(previous, point, originalHostValues=None):
+    # Push the values of point and restart the daemons whose configuration
+    # files changed since previous was applied. A value of None removes the
+    # property. originalHostValues replaces the per host values if given.
+    for fileName, values in point.items():
+        siteValues(fileName).update(values)
+        # The swept values win over the per host ones (e.g. YARN_AUTO_SIZING)
+        for hostValues in HOST_SITE_VALUES.values():
+            for name in values:
+                hostValues.get(fileName, {}).pop(name, None)
+
+    if originalHostValues is not None:
+        HOST_SITE_VALUES.clear()
+        HOST_SITE_VALUES.update(originalHostValues)
+
+    execute(config)
+
+    daemons = set()
+    for fileName in parameterSweep.changedFiles(previous, point):
+        daemons.update(CONFIGURATION_FILE_DAEMONS[fileName])
+
+    if daemons:
+        restartDaemons(sorted(daemons))
+
+
+def restartDaemons(daemons):
+    print("Restarting %s" % ", ".join(daemons))
+    stopDaemons(daemons)
+    startDaemons(daemons)
+
+    if "namenode" in daemons or "datanode" in daemons:
+        execute(operationInHadoopEnvironment,
+                r"\\$HADOOP_PREFIX/bin/hdfs dfsadmin -safemode wait",
+                hosts=[NAMENODE_HOST])
+
+
+def packageUrl():
+    return PACKAGE_URL or HADOOP_PACKAGE_URL
+
+
+def packageChecksum():
+    # HADOOP_PACKAGE_SHA256 is only the checksum of HADOOP_PACKAGE_URL
+    return HADOOP_PACKAGE_SHA256 if packageUrl() == HADOOP_PACKAGE_URL else None
+
+
+def remotePackagePath():
+    return os.path.join(os.path.dirname(HADOOP_PREFIX), "%s.tar.gz" % HADOOP_PACKAGE)
+
+
+@parallel
+def checkPackage(checksum):
+    return artifactCache.remoteArtifactMatches(remotePackagePath(), checksum)
+
+
+def seedPackage(localPath, checksum):
+    packagePath = remotePackagePath()
+    run("mkdir -p %s" % os.path.dirname(packagePath))
+    artifactCache.pushArtifact(localPath, packagePath, checksum)
+
+
+@parallel
+def fetchPackageFromPeer(sources, checksum, privateIps):
+    packagePath = remotePackagePath()
+    run("mkdir -p %s && wget -q --tries=5 --retry-connrefused --waitretry=1 -O %s.part http://%s:%d/%s && %s" %
+        (os.path.dirname(packagePath), packagePath, privateIps[sources[env.host]],
+         HADOOP_PACKAGE_FANOUT_PORT, os.path.basename(packagePath),
+         artifactCache.verifyArtifactCommand(packagePath + ".part", packagePath, checksum)))
+    startPackageServer(privateIps)
+
+
+@parallel
+def startPackageServer(privateIps):
+    # Serve only a directory holding a link to the package, not the whole
+    # install directory, and only on the private IP of the host.
+    # SimpleHTTPServer (Python 2) can't be told where to bind from the
+    # command line.
+    packagePath = remotePackagePath()
+    serveDir = packagePath + ".serve"
+    run("rm -rf %(dir)s && mkdir %(dir)s && ln %(file)s %(dir)s/ && cd %(dir)s && "
+        "((if command -v python3 > /dev/null; then "
+        "exec nohup python3 -m http.server --bind %(ip)s %(port)d; else "
+        "exec nohup python -c \"import BaseHTTPServer, SimpleHTTPServer; "
+        "BaseHTTPServer.HTTPServer(('%(ip)s', %(port)d), "
+        "SimpleHTTPServer.SimpleHTTPRequestHandler).serve_forever()\"; fi) "
+        "< /dev/null > /dev/null 2>&1 & echo $! > %(dir)s.pid)" %
+        {"dir": serveDir, "file": packagePath, "ip": privateIps[env.host],
+         "port": HADOOP_PACKAGE_FANOUT_PORT},
+        pty=False)
+
+
+@parallel
+def stopPackageServer():
+    serveDir = remotePackagePath() + ".serve"
+    with settings(warn_only=True):
+        run("kill `cat %(dir)s.pid`; rm -rf %(dir)s %(dir)s.pid" % {"dir": serveDir})
+
+
+def setHostSiteValues(host, fileName, values):
+    HOST_SITE_VALUES.setdefault(host, {}).setdefault(fileName, {}).update(values)
+
+
+def dataDiskMountPoints(hostFacts):
+    prefixLength = len(DATA_DISKS_MOUNT_PREFIX)
+    mountPoints = [mountPoint for mountPoint in hostFacts["mounts"]
+                   if mountPoint.startswith(DATA_DISKS_MOUNT_PREFIX) and
+                   mountPoint[prefixLength:].isdigit()]
+    return sorted(mountPoints, key=lambda mountPoint: int(mountPoint[prefixLength:]))
+
+
+def computeHostSizing(hostFacts):
+    # Based on the Hortonworks YARN memory sizing guidelines: as many
+    # containers as the cores, disks and memory allow, with a minimum
+    # container size that grows with the memory of the host. Unlike the
+    # guidelines, a host with few disks still gets one container per core.
+    disks = max(1, len([device for device in hostFacts["blockDevices"]
+                        if device["type"] == "disk" and device["sizeBytes"] > 0]))
+    reservedMb = max(YARN_RESERVED_MEMORY_MIN_MB,
+                     int(hostFacts["memoryMb"] * YARN_RESERVED_MEMORY_RATIO))
+    availableMb = max(256, hostFacts["memoryMb"] - reservedMb)
+    vcores = max(1, hostFacts["cpuCount"] - YARN_RESERVED_CORES)
+
+    if hostFacts["memoryMb"] <= 4096:
+        minContainerMb = 256
+    elif hostFacts["memoryMb"] <= 8192:
+        minContainerMb = 512
+    elif hostFacts["memoryMb"] <= 24576:
+        minContainerMb = 1024
+    else:
+        minContainerMb = 2048
+
+    containers = max(1, min(2 * vcores, max(vcores, int(1.8 * disks)),
+                            availableMb // minContainerMb))
+    containerMb = max(minContainerMb, availableMb // containers)
+    # Round down to a multiple of 128MB
+    containerMb = max(128, containerMb // 128 * 128)
+
+    return {
+        "disks": disks,
+        "vcores": vcores,
+        "containerMb": containerMb,
+        "memoryMb": containers * containerMb,
+    }
+
+
+def heapOpts(containerMb):
+    return "-Xmx%dm" % int(containerMb * YARN_HEAP_RATIO)
+
+
+def printPackingReport(facts, hostSizing, containerMb, largeContainerMb):
+    print("YARN sizing: %dMB map containers, %dMB reduce/AM containers" %
+          (containerMb, largeContainerMb))
+    print("%-30s %5s %9s %5s %10s %7s %5s %7s" % ("host", "cores", "memory",
+        "disks", "NM memory", "vcores", "maps", "reduces"))
+
+    for host in sorted(hostSizing):
+        sizing = hostSizing[host]
+        print("%-30s %5d %7dMB %5d %8dMB %7d %5d %7d" % (host,
+            facts[host]["cpuCount"], facts[host]["memoryMb"], sizing["disks"],
+            sizing["memoryMb"], sizing["vcores"],
+            min(sizing["memoryMb"] // containerMb, sizing["vcores"]),
+            min(sizing["memoryMb"] // largeContainerMb, sizing["vcores"])))
+
+
+def printNativeLibraries(hostLibraries):
+    libraries = sorted(set(library for loaded in hostLibraries.values() for library in loaded))
+    print("%-30s %s %s" % ("host", " ".join("%7s" % library for library in libraries),
+                           "compression"))
+
+    for host in sorted(hostLibraries):
+        loaded = hostLibraries[host]
+        print("%-30s %s %s" % (host, " ".join("%7s" % {True: "yes", False: "NO"}.get(
+            loaded.get(library), "-") for library in libraries),
+            COMPRESSION_CODEC if nativeCodecLoads(loaded) else "off"))
+
+
+def printStopReport(reports):
+    print("%-40s %6s %8s %10s" % ("host", "jvms", "killed", "stop time"))
+    for host in sorted(reports):
+        report = reports[host]
+        if report is None:
+            print("%-40s %6s %8s %10s" % (host, "-", "-", "failed"))
         else:
-            run("mv %(file)s.bak%(bakNumber)d %(file)s" %
-                {"file": fileName, "bakNumber": latestBakNumber})
+            print("%-40s %6d %8d %9.1fs" % (host, len(report["pids"]),
+                                            len(report["killed"]), report["seconds"]))
 
+    escalated = sorted(host for host, report in reports.items()
+                       if report and report["killed"])
+    failed = sorted(host for host, report in reports.items() if report is None)
+    if escalated:
+        warn("Escalated to SIGKILL on %d hosts: %s" % (len(escalated), ", ".join(escalated)))
+    if failed:
+        warn("Couldn't stop the JVMs of %d hosts: %s" % (len(failed), ", ".join(failed)))
 
-def revertHadoopPropertiesChange(fileName):
-    revertBackup(os.path.join(HADOOP_CONF, fileName))
 
+def printDaemonTimings(title, timings):
+    print("%-16s %-20s %10s" % ("daemon", "", title.lower() + " after"))
+    for daemon, detail, seconds in timings:
+        print("%-16s %-20s %9.1fs" % (daemon, detail, seconds))
 
-def operationInHadoopEnvironment(operation):
-    with cd(HADOOP_PREFIX):
-        command = operation
-        if ENVIRONMENT_FILE_NOTAUTOLOADED:
-            with settings(warn_only=True):
-                import hashlib
-                executeInHadoopEnvHash = \
-                    hashlib.md5(
-                        open("executeInHadoopEnv.sh", 'rb').read()
-                    ).hexdigest()
-                if run("test %s = `md5sum executeInHadoopEnv.sh | cut -d ' ' -f 1`"
-                    % executeInHadoopEnvHash).failed:
-                    put("executeInHadoopEnv.sh", HADOOP_PREFIX + "/")
-                    run("chmod +x executeInHadoopEnv.sh")
-            command = ("./executeInHadoopEnv.sh %s " % ENVIRONMENT_FILE) + command
-        run(command)
 
+def printBootstrapTimings(phaseNames, phaseTimings, stageDurations):
+    print("Bootstrap timings (seconds):")
+    print("%-14s %10s %10s  %s" % ("phase", "mean", "max", "slowest host"))
 
-def operationOnHadoopDaemons(operation):
-    # Start/Stop NameNode
-    if (env.host == NAMENODE_HOST):
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/hadoop-daemon.sh %s namenode" % operation)
+    for phaseName in phaseNames:
+        hostDurations = phaseTimings[phaseName]
+        slowestHost = max(hostDurations, key=hostDurations.get)
+        print("%-14s %10.1f %10.1f  %s" % (phaseName,
+            sum(hostDurations.values()) / len(hostDurations),
+            hostDurations[slowestHost], slowestHost))
 
-    # Start/Stop DataNode on all slave hosts
-    if env.host in SLAVE_HOSTS:
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/hadoop-daemon.sh %s datanode" % operation)
+    for stageName, duration in stageDurations:
+        print("%-14s %10.1f (wall clock)" % (stageName, duration))
 
-    # Start/Stop ResourceManager
-    if (env.host == RESOURCEMANAGER_HOST):
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/yarn-daemon.sh %s resourcemanager" % operation)
 
-    # Start/Stop NodeManager on all container hosts
-    if env.host in SLAVE_HOSTS:
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/yarn-daemon.sh %s nodemanager" % operation)
+@runs_once
+def refreshInventory():
+    instances = fetchEC2Inventory()
+    writeEC2Inventory(instances)
+    print("Cached %d instances in %s" % (len(instances), EC2_INVENTORY_FILE))
+    bootstrapFabric()
 
-    # Start/Stop JobHistory daemon
-    if (env.host == JOBHISTORY_HOST):
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/mr-jobhistory-daemon.sh %s historyserver" % operation)
-    run("jps")
 
+def readEC2Inventory():
+    # Returns None if there's no cached inventory or if it has expired
+    try:
+        if time.time() - os.path.getmtime(EC2_INVENTORY_FILE) > EC2_INVENTORY_TTL:
+            return None
 
-def readHostsFromEC2():
+        with open(EC2_INVENTORY_FILE) as f:
+            return json.load(f)
+    except (OSError, IOError, ValueError):
+        return None
+
+
+def writeEC2Inventory(instances):
+    inventoryDir = os.path.dirname(EC2_INVENTORY_FILE)
+    if not os.path.isdir(inventoryDir):
+        os.makedirs(inventoryDir)
+
+    with open(EC2_INVENTORY_FILE + ".tmp", "w") as f:
+        json.dump(instances, f, indent=1)
+    os.rename(EC2_INVENTORY_FILE + ".tmp", EC2_INVENTORY_FILE)
+
+
+def fetchEC2Inventory():
     import boto.ec2
 
+    if EC2_ENDPOINT:
+        from boto.ec2.regioninfo import RegionInfo
+        # Imported here so that fab -l doesn't list it as a task
+        try:
+            from urlparse import urlparse
+        except ImportError:
+            from urllib.parse import urlparse
+        endpoint = urlparse(EC2_ENDPOINT)
+        conn = boto.ec2.connection.EC2Connection(
+                aws_access_key_id=AWS_ACCESSKEY_ID,
+                aws_secret_access_key=AWS_ACCESSKEY_SECRET,
+                region=RegionInfo(name=EC2_REGION, endpoint=endpoint.hostname),
+                port=endpoint.port, is_secure=endpoint.scheme == "https")
+    else:
+        conn = boto.ec2.connect_to_region(EC2_REGION,
+                aws_access_key_id=AWS_ACCESSKEY_ID,
+                aws_secret_access_key=AWS_ACCESSKEY_SECRET)
+
+    instances = conn.get_only_instances(filters={'tag:Cluster': EC2_CLUSTER_NAME})
+
+    return [{
+            "host": instance.public_dns_name,
+            "privateIp": instance.private_ip_address,
+            "tags": sorted(instance.tags),
+        } for instance in instances]
+
+
+def readHostsFromEC2():
     global RESOURCEMANAGER_HOST, NAMENODE_HOST, JOBTRACKER_HOST, \
-        JOBHISTORY_HOST, SLAVE_HOSTS
+        JOBHISTORY_HOST, SLAVE_HOSTS, EC2_PRIVATE_IPS
+
+    instances = readEC2Inventory()
+
+    if instances is None:
+        instances = fetchEC2Inventory()
+        writeEC2Inventory(instances)
 
     RESOURCEMANAGER_HOST = None
     NAMENODE_HOST = None
     JOBTRACKER_HOST = None
     JOBHISTORY_HOST = None
     SLAVE_HOSTS = []
-
-    conn = boto.ec2.connect_to_region(EC2_REGION,
-            aws_access_key_id=AWS_ACCESSKEY_ID,
-            aws_secret_access_key=AWS_ACCESSKEY_SECRET)
-    instances = conn.get_only_instances(filters={'tag:Cluster': EC2_CLUSTER_NAME})
+    EC2_PRIVATE_IPS = {}
 
     for instance in instances:
-        instanceTags = instance.tags
-        instanceHost = instance.public_dns_name
+        instanceTags = instance["tags"]
+        instanceHost = instance["host"]
+
+        if instance["privateIp"]:
+            EC2_PRIVATE_IPS[instanceHost] = instance["privateIp"]
 
         if "resourcemanager" in instanceTags:
             RESOURCEMANAGER_HOST = instanceHost
@@ -9,10 +9,25 @@
 #   http://www.alexjf.net/blog/distributed-systems/hadoop-yarn-installation-definitive-guide
 
 import os
-from fabric.api import run, cd, env, settings, put, sudo
+import re
+import sys
+import time
+import base64
+import tarfile
+from io import BytesIO
+from fabric.api import run, cd, env, settings, put, get, sudo, hide
 from fabric.decorators import runs_once, parallel
 from fabric.tasks import execute
 
+import replaceHadoopProperty
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import artifactCache
+import remoteTiming
+import remotePipeline
+
+remoteTiming.install()
+
 ###############################################################
 #  START OF YOUR CONFIGURATION (CHANGE FROM HERE, IF NEEDED)  #
 ###############################################################
@@ -44,6 +59,8 @@ HADOOP_PACKAGE = "hadoop-%s" % HADOOP_VERSION
 HADOOP_PACKAGE_URL = "http://apache.crihan.fr/dist/hadoop/common/stable1/%s.tar.gz" % HADOOP_PACKAGE
 HADOOP_PREFIX = "/home/ubuntu/Programs/%s" % HADOOP_PACKAGE
 HADOOP_CONF = os.path.join(HADOOP_PREFIX, "conf")
+# If set, the downloaded package must match this SHA-256 checksum
+HADOOP_PACKAGE_SHA256 = None
 
 
 #### Installation information ####
@@ -167,6 +184,9 @@ def updateHadoopSiteValues():
 #####################################################################
 #  DON'T CHANGE ANYTHING BELOW (UNLESS YOU KNOW WHAT YOU'RE DOING)  #
 #####################################################################
+HOSTS_BLOCK_BEGIN = "# BEGIN hadoop cluster hosts (managed by fabric)"
+HOSTS_BLOCK_END = "# END hadoop cluster hosts (managed by fabric)"
+
 CORE_SITE_VALUES = {}
 HDFS_SITE_VALUES = {}
 MAPRED_SITE_VALUES = {}
@@ -218,8 +238,7 @@ def bootstrap():
 
 
 def ensureImportantDirectoriesExist():
-    for importantDir in IMPORTANT_DIRS:
-        ensureDirectoryExists(importantDir)
+    run("mkdir -p %s" % " ".join(IMPORTANT_DIRS))
 
 
 def installDependencies():
@@ -232,49 +251,45 @@ def installDependencies():
 def install():
     installDirectory = os.path.dirname(HADOOP_PREFIX)
     run("mkdir -p %s" % installDirectory)
+    artifactCache.ensureRemoteArtifact(HADOOP_PACKAGE_URL,
+        os.path.join(installDirectory, "%s.tar.gz" % HADOOP_PACKAGE),
+        HADOOP_PACKAGE_SHA256)
     with cd(installDirectory):
-        with settings(warn_only=True):
-            if run("test -f %s.tar.gz" % HADOOP_PACKAGE).failed:
-                run("wget -O %s.tar.gz %s" % (HADOOP_PACKAGE, HADOOP_PACKAGE_URL))
         run("tar --overwrite -xf %s.tar.gz" % HADOOP_PACKAGE)
 
 
 def config():
-    changeHadoopProperties("core-site.xml", CORE_SITE_VALUES)
-    changeHadoopProperties("hdfs-site.xml", HDFS_SITE_VALUES)
-    changeHadoopProperties("mapred-site.xml", MAPRED_SITE_VALUES)
+    changeHadoopProperties({
+        "core-site.xml": CORE_SITE_VALUES,
+        "hdfs-site.xml": HDFS_SITE_VALUES,
+        "mapred-site.xml": MAPRED_SITE_VALUES,
+    })
 
 
 def configRevertPrevious():
-    revertHadoopPropertiesChange("core-site.xml")
-    revertHadoopPropertiesChange("hdfs-site.xml")
-    revertHadoopPropertiesChange("mapred-site.xml")
+    remotePipeline.runPipelined([restoreBackupCommand(os.path.join(HADOOP_CONF, fileName))
+                                 for fileName in ["core-site.xml", "hdfs-site.xml", "mapred-site.xml"]])
 
 
 def setupEnvironment():
-    with settings(warn_only=True):
-        if not run("test -f %s" % ENVIRONMENT_FILE).failed:
-            op = "cp"
+    currentContents = readRemoteFile(ENVIRONMENT_FILE)
+    backupOp = None
 
-            if ENVIRONMENT_FILE_CLEAN:
-                op = "mv"
+    if currentContents is not None:
+        backupOp = "cp"
 
-            currentBakNumber = getLastBackupNumber(ENVIRONMENT_FILE) + 1
-            run("%(op)s %(file)s %(file)s.bak%(bakNumber)d" %
-                {"op": op, "file": ENVIRONMENT_FILE, "bakNumber": currentBakNumber})
+        if ENVIRONMENT_FILE_CLEAN:
+            backupOp = "mv"
+            currentContents = ""
 
-    run("touch %s" % ENVIRONMENT_FILE)
+    newContents, changedVariables = mergeEnvironmentVariables(
+            currentContents or "", ENVIRONMENT_VARIABLES)
+    replaceRemoteFile(ENVIRONMENT_FILE, newContents, backupOp)
 
-    for variable, value in ENVIRONMENT_VARIABLES:
-        lineNumber = run("grep -n 'export\s\+%(var)s\=' '%(file)s' | cut -d : -f 1" %
-                {"var": variable, "file": ENVIRONMENT_FILE})
-        try:
-            lineNumber = int(lineNumber)
-            run("sed -i \"" + str(lineNumber) + "s@.*@export %(var)s\=%(val)s@\" '%(file)s'" %
-                {"var": variable, "val": value, "file": ENVIRONMENT_FILE})
-        except ValueError:
-            run("echo \"export %(var)s=%(val)s\" >> \"%(file)s\"" %
-                {"var": variable, "val": value, "file": ENVIRONMENT_FILE})
+    if changedVariables:
+        print("Changed environment variables: {}".format(", ".join(changedVariables)))
+    else:
+        print("No environment variables changed")
 
 
 def environmentRevertPrevious():
@@ -286,17 +301,20 @@ def formatHdfs():
         operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hadoop namenode -format")
 
 
+@runs_once
+def traceSummary(trace=None):
+    # Slowest hosts, tasks and commands of the given (or the last) fab run
+    remoteTiming.printSummary(remoteTiming.loadTrace(trace))
+
+
 @runs_once
 def setupHosts():
     privateIps = execute(getPrivateIp)
     execute(updateHosts, privateIps)
 
     if env.host == JOBTRACKER_HOST:
-        run("rm -f privateIps")
-        run("touch privateIps")
-
-        for host, privateIp in privateIps.items():
-            run("echo '%s' >> privateIps" % privateIp)
+        privateIpList = "".join("%s\n" % privateIp for privateIp in privateIps.values())
+        put(BytesIO(privateIpList.encode("utf-8")), "privateIps")
 
 
 def start():
@@ -314,9 +332,7 @@ def test():
 
 # HELPER FUNCTIONS
 def ensureDirectoryExists(directory):
-    with settings(warn_only=True):
-        if run("test -d %s" % directory).failed:
-            run("mkdir -p %s" % directory)
+    run("mkdir -p %s" % directory)
 
 
 @parallel
@@ -329,89 +345,207 @@ def getPrivateIp():
 
 @parallel
 def updateHosts(privateIps):
+    currentContents = readRemoteFile(HOSTS_FILE)
+    backupOp = None
+
+    if currentContents is not None:
+        backupOp = "cp"
+
+    newContents = renderHostsFile(currentContents or "", privateIps)
+    replaceRemoteFile(HOSTS_FILE, newContents, backupOp, useSudo=True)
+
+
+def readRemoteFile(filePath):
+    contents = BytesIO()
+
     with settings(warn_only=True):
-        if not run("test -f %s" % HOSTS_FILE).failed:
-            currentBakNumber = getLastBackupNumber(HOSTS_FILE) + 1
-            sudo("cp %(file)s %(file)s.bak%(bakNumber)d" %
-                {"file": HOSTS_FILE, "bakNumber": currentBakNumber})
-
-    sudo("touch %s" % HOSTS_FILE)
-
-    for host, privateIp in privateIps.items():
-        lineNumber = run("grep -n '^%(ip)s' '%(file)s' | cut -d : -f 1" %
-                {"ip": privateIp, "file": HOSTS_FILE})
-        try:
-            lineNumber = int(lineNumber)
-            sudo("sed -i \"" + str(lineNumber) + "s@.*@%(ip)s %(host)s@\" '%(file)s'" %
-                {"host": host, "ip": privateIp, "file": HOSTS_FILE})
-        except ValueError:
-            sudo("echo \"%(ip)s %(host)s\" >> \"%(file)s\"" %
-                {"host": host, "ip": privateIp, "file": HOSTS_FILE})
-
-
-def getLastBackupNumber(filePath):
-    dirName = os.path.dirname(filePath)
+        if get(filePath, contents).failed:
+            return None
+
+    return contents.getvalue().decode("utf-8")
+
+
+def replaceRemoteFile(filePath, contents, backupOp=None, useSudo=False):
+    # Upload next to the target and swap it in with a single mv so readers
+    # never see a partially written file. If backupOp is given, the previous
+    # version is first copied/moved to the next .bakN.
+    runner = sudo if useSudo else run
+    tempPath = "/tmp/%s.fabric" % os.path.basename(filePath)
+    put(BytesIO(contents.encode("utf-8")), tempPath)
+
+    commands = []
+    if backupOp:
+        commands.append(backupCommand(filePath, backupOp))
+    commands.append("cp %(temp)s %(file)s.fabric && mv %(file)s.fabric %(file)s" %
+        {"temp": tempPath, "file": filePath})
+    commands.append("rm -f %s" % tempPath)
+    runner(" && ".join(commands))
+
+
+def mergeEnvironmentVariables(contents, variables):
+    """Return the environment file contents with every variable exported to
+    its new value, along with the names of the variables that changed.
+    """
+    lines = contents.splitlines()
+    changedVariables = []
+
+    for variable, value in variables:
+        # Values are written to be shell-escaped twice (fabric + echo), so
+        # undo that to get what would actually end up in the file.
+        newLine = "export %s=%s" % (variable, value.replace(r"\\$", "$"))
+        exportRegex = re.compile(r"export\s+%s=" % re.escape(variable))
+
+        for i, line in enumerate(lines):
+            if exportRegex.search(line):
+                if line != newLine:
+                    lines[i] = newLine
+                    changedVariables.append(variable)
+                break
+        else:
+            lines.append(newLine)
+            changedVariables.append(variable)
+
+    return "\n".join(lines) + "\n", changedVariables
+
+
+def renderHostsFile(contents, privateIps):
+    """Return the hosts file contents with a single managed block mapping each
+    cluster host to its private IP. Lines outside the block are kept, except
+    for stale entries of IPs that the block now takes care of.
+    """
+    managedIps = set(privateIps.values())
+    lines = []
+    inManagedBlock = False
+
+    for line in contents.splitlines():
+        if line == HOSTS_BLOCK_BEGIN:
+            inManagedBlock = True
+        elif line == HOSTS_BLOCK_END:
+            inManagedBlock = False
+        elif not inManagedBlock:
+            fields = line.split()
+            if not fields or fields[0] not in managedIps:
+                lines.append(line)
+
+    lines.append(HOSTS_BLOCK_BEGIN)
+    for host, privateIp in sorted(privateIps.items()):
+        lines.append("%s %s" % (privateIp, host))
+    lines.append(HOSTS_BLOCK_END)
+
+    return "\n".join(lines) + "\n"
+
+
+def backupCommand(filePath, op="cp"):
+    # Op's the file to the next .bakN (after the lexically last one), as a
+    # shell command so that backups can be chained with other commands
+    # instead of costing extra round trips. Does nothing if the file is
+    # missing.
+    dirName = os.path.dirname(filePath) or "."
     fileName = os.path.basename(filePath)
 
-    with cd(dirName):
-        latestBak = run("ls -1 | grep %s.bak | tail -n 1" % fileName)
-        latestBakNumber = -1
-        if latestBak:
-            latestBakNumber = int(latestBak[len(fileName) + 4:])
-        return latestBakNumber
+    return ("if [ -f %(file)s ]; then "
+            "n=$(cd %(dir)s && ls -1 | grep %(name)s.bak | tail -n 1 | cut -c %(cut)d-); "
+            "%(op)s %(file)s %(file)s.bak$((${n:--1} + 1)); fi" %
+            {"file": filePath, "dir": dirName, "name": fileName,
+             "cut": len(fileName) + 5, "op": op})
+
+
+def restoreBackupCommand(filePath):
+    # Moves the last .bakN back in place, does nothing if there is none left
+    dirName = os.path.dirname(filePath) or "."
+    fileName = os.path.basename(filePath)
+
+    return ("n=$(cd %(dir)s && ls -1 | grep %(name)s.bak | tail -n 1 | cut -c %(cut)d-); "
+            "if [ -n \"$n\" ]; then mv %(file)s.bak$n %(file)s; fi" %
+            {"file": filePath, "dir": dirName, "name": fileName,
+             "cut": len(fileName) + 5})
+
 
+def changeHadoopProperties(fileProperties):
+    # Only keep files which actually have properties to change
+    fileProperties = dict((fileName, propertyDict)
+        for fileName, propertyDict in fileProperties.items()
+        if fileName and propertyDict)
 
-def changeHadoopProperties(fileName, propertyDict):
-    if not fileName or not propertyDict:
+    if not fileProperties:
         return
 
-    with cd(HADOOP_CONF):
-        with settings(warn_only=True):
-            import hashlib
-            replaceHadoopPropertyHash = \
-                hashlib.md5(
-                    open("replaceHadoopProperty.py", 'rb').read()
-                ).hexdigest()
-            if run("test %s = `md5sum replaceHadoopProperty.py | cut -d ' ' -f 1`"
-                   % replaceHadoopPropertyHash).failed:
-                put("replaceHadoopProperty.py", HADOOP_CONF + "/")
-                run("chmod +x replaceHadoopProperty.py")
-
-        with settings(warn_only=True):
-            if not run("test -f %s" % fileName).failed:
-                op = "cp"
-
-                if CONFIGURATION_FILES_CLEAN:
-                    op = "mv"
-
-                currentBakNumber = getLastBackupNumber(fileName) + 1
-                run("%(op)s %(file)s %(file)s.bak%(bakNumber)d" %
-                    {"op": op, "file": fileName, "bakNumber": currentBakNumber})
-
-        run("touch %s" % fileName)
-
-        command = "./replaceHadoopProperty.py '%s' %s" % (fileName,
-            " ".join(["%s %s" % (str(key), str(value)) for key, value in propertyDict.items()]))
-        run(command)
+    fileNames = sorted(fileProperties)
+    currentFiles = readRemoteConfigurationFiles(fileNames)
+    newFiles = {}
 
+    for fileName in fileNames:
+        currentContents = currentFiles.get(fileName)
 
-def revertBackup(fileName):
-    dirName = os.path.dirname(fileName)
+        if CONFIGURATION_FILES_CLEAN or currentContents is None:
+            currentContents = ""
 
-    with cd(dirName):
-        latestBakNumber = getLastBackupNumber(fileName)
+        newContents, counts = replaceHadoopProperty.renderConfiguration(
+                currentContents, fileProperties[fileName])
+        newFiles[fileName] = newContents.encode("utf-8")
+        print("%s: %d added, %d updated, %d unchanged" % ((fileName,) + counts))
 
-        # We have already reverted all backups
-        if latestBakNumber == -1:
-            return
-        # Otherwise, perform reversion
-        else:
-            run("mv %(file)s.bak%(bakNumber)d %(file)s" %
-                {"file": fileName, "bakNumber": latestBakNumber})
+    if all(currentFiles.get(fileName) == newFiles[fileName] for fileName in fileNames):
+        print("Configuration already up to date, skipping")
+        return
+
+    pushHadoopConfiguration(newFiles)
+
+
+def readRemoteConfigurationFiles(fileNames):
+    # Fetch all configuration files in one go as a base64-encoded tarball.
+    # Missing files are simply left out of the result.
+    with hide("stdout"):
+        output = run("cd %s && tar czf - --ignore-failed-read %s 2>/dev/null | base64" %
+                     (HADOOP_CONF, " ".join(fileNames)), pty=False)
+
+    currentFiles = {}
+    if not output.strip():
+        return currentFiles
+
+    with tarfile.open(fileobj=BytesIO(base64.b64decode(output)), mode="r:gz") as bundle:
+        for member in bundle.getmembers():
+            if member.isfile():
+                currentFiles[member.name] = bundle.extractfile(member).read()
+
+    return currentFiles
 
 
-def revertHadoopPropertiesChange(fileName):
-    revertBackup(os.path.join(HADOOP_CONF, fileName))
+def pushHadoopConfiguration(files):
+    # Send every file as a single compressed bundle, then back up the previous
+    # versions and swap the new ones in with one remote command.
+    bundleBuffer = BytesIO()
+
+    with tarfile.open(fileobj=bundleBuffer, mode="w:gz") as bundle:
+        for fileName, contents in sorted(files.items()):
+            fileInfo = tarfile.TarInfo(fileName)
+            fileInfo.size = len(contents)
+            fileInfo.mode = 0o644
+            fileInfo.mtime = time.time()
+            bundle.addfile(fileInfo, BytesIO(contents))
+
+    bundleBuffer.seek(0)
+    put(bundleBuffer, "/tmp/hadoop-conf-bundle.tgz")
+
+    op = "cp"
+
+    if CONFIGURATION_FILES_CLEAN:
+        op = "mv"
+
+    stagingDir = ".fabric-staging"
+    commands = ["rm -rf %s" % stagingDir, "mkdir %s" % stagingDir,
+                "tar xzf /tmp/hadoop-conf-bundle.tgz -C %s" % stagingDir]
+    for fileName in sorted(files):
+        commands.append(backupCommand(fileName, op))
+        commands.append("mv %s/%s %s" % (stagingDir, fileName, fileName))
+    commands += ["rmdir %s" % stagingDir, "rm -f /tmp/hadoop-conf-bundle.tgz"]
+
+    with cd(HADOOP_CONF):
+        run(" && ".join(commands))
+
+
+def revertBackup(fileName):
+    run(restoreBackupCommand(fileName))
 
 
 def operationInHadoopEnvironment(operation):
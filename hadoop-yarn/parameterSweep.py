@@ -0,0 +1,97 @@
+# encoding: utf-8
+
+# Description:
+#   Search space and bookkeeping of the configuration parameter sweep. The
+#   points of the search are generated deterministically, so that an
+#   interrupted sweep can pick up where it stopped from its state file.
+
+import os
+import json
+import random
+import hashlib
+import itertools
+
+
+def sweepPoints(parameters, mode="grid", samples=10, seed=0):
+    """Return the list of points to try, each one a {fileName: {name: value}}
+    dict. In grid mode every combination of the values is tried, in random
+    mode only a random sample of them.
+    """
+    names = [(fileName, name) for fileName in sorted(parameters)
+             for name in sorted(parameters[fileName])]
+    combinations = list(itertools.product(
+        *[parameters[fileName][name] for fileName, name in names]))
+
+    if mode == "random":
+        combinations = random.Random(seed).sample(combinations,
+                                                  min(samples, len(combinations)))
+    elif mode != "grid":
+        raise ValueError("Unknown sweep mode %s" % mode)
+
+    points = []
+    for values in combinations:
+        point = {}
+        for (fileName, name), value in zip(names, values):
+            point.setdefault(fileName, {})[name] = value
+        points.append(point)
+
+    return points
+
+
+def spaceHash(*settings):
+    # Identifies the search, a new one starts over instead of resuming
+    encoded = json.dumps(settings, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:12]
+
+
+def readState(stateFile):
+    try:
+        with open(stateFile) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def writeState(stateFile, state):
+    stateDir = os.path.dirname(stateFile)
+    if not os.path.isdir(stateDir):
+        os.makedirs(stateDir)
+
+    with open(stateFile + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.rename(stateFile + ".tmp", stateFile)
+
+
+def changedFiles(previous, point):
+    # Configuration files in which point sets a value different from previous
+    return sorted(fileName for fileName, values in point.items()
+                  if any(previous.get(fileName, {}).get(name) != value
+                         for name, value in values.items()))
+
+
+def formatPoint(point):
+    return ", ".join("%s=%s" % (name, point[fileName][name])
+                     for fileName in sorted(point) for name in sorted(point[fileName]))
+
+
+def rankPoints(points, scores, higherIsBetter):
+    """Return the indexes of the points that have a score, best first."""
+    scored = [index for index in range(len(points))
+              if scores.get(str(index)) is not None]
+    return sorted(scored, key=lambda index: scores[str(index)],
+                  reverse=higherIsBetter)
+
+
+def printReport(points, scores, metric, higherIsBetter):
+    ranking = rankPoints(points, scores, higherIsBetter)
+
+    print("%4s %12s  %s" % ("rank", metric, "parameters"))
+    for rank, index in enumerate(ranking):
+        print("%4d %12.2f  %s" % (rank + 1, scores[str(index)],
+                                  formatPoint(points[index])))
+
+    missing = len(points) - len(ranking)
+    if missing:
+        print("%d points without a result" % missing)
+
+    return ranking[0] if ranking else None
@@ -3,50 +3,75 @@
 
 import sys
 import re
+import json
 import xml.etree.ElementTree as ElementTree
 import xml.dom.minidom as minidom
 
-if len(sys.argv) < 2 or len(sys.argv) % 2 != 0:
-    print("./replaceHadoopProperty <file> <name1> <value1> <name2> <value2> ...")
+USAGE = """./replaceHadoopProperty <file> <name1> <value1> <name2> <value2> ...
+./replaceHadoopProperty --batch <manifest.json|->
 
-fileName = sys.argv[1]
-propertyNames = sys.argv[2::2]
-propertyValues = sys.argv[3::2]
-replaced = [False] * len(propertyNames)
+In batch mode, the manifest maps each configuration file to the properties
+to set on it, e.g. {"core-site.xml": {"fs.defaultFS": "hdfs://nn/"}}. A null
+value removes the property."""
 
-print(propertyNames)
-print(propertyValues)
 
-root = None
+def replaceProperties(root, properties):
+    """Set every property in the properties dict on the configuration root,
+    adding the ones that don't exist yet. A value of None removes the
+    property (counted as updated). Returns the (added, updated, unchanged)
+    counts.
+    """
+    pending = dict((str(name), None if value is None else str(value))
+                   for name, value in properties.items())
+    updated = 0
+    unchanged = 0
+    removed = []
 
-try:
-    tree = ElementTree.parse(fileName)
-    root = tree.getroot()
-except Exception:
-    configurationElement = ElementTree.Element("configuration")
-    tree = ElementTree.ElementTree(configurationElement)
-    root = tree.getroot()
+    for prop in root.iter('property'):
+        children = dict((child.tag, child) for child in prop)
 
-for prop in root.getiterator('property'):
-    children = dict((child.tag, child) for child in prop)
+        if 'name' not in children or children['name'].text is None:
+            continue
 
-    propertyName = children['name'].text.strip()
+        propertyName = children['name'].text.strip()
 
-    try:
-        index = propertyNames.index(propertyName)
-        children['value'].text = propertyValues[index]
-        replaced[index] = True
-    except Exception as e:
-        print(str(e))
-        pass
+        if propertyName not in pending:
+            continue
+
+        propertyValue = pending.pop(propertyName)
+
+        if propertyValue is None:
+            removed.append(prop)
+            continue
+
+        if 'value' not in children:
+            children['value'] = ElementTree.SubElement(prop, "value")
+
+        if children['value'].text == propertyValue:
+            unchanged += 1
+        else:
+            children['value'].text = propertyValue
+            updated += 1
+
+    for prop in removed:
+        root.remove(prop)
+        updated += 1
 
-for i, propertyReplaced in enumerate(replaced):
-    if not propertyReplaced:
+    # Properties to remove that weren't there
+    for propertyName in [name for name, value in pending.items() if value is None]:
+        pending.pop(propertyName)
+        unchanged += 1
+
+    # Keep the order stable so that rerunning yields byte-identical files
+    for propertyName in sorted(pending):
         newProperty = ElementTree.SubElement(root, "property")
         newPropertyName = ElementTree.SubElement(newProperty, "name")
-        newPropertyName.text = propertyNames[i]
+        newPropertyName.text = propertyName
         newPropertyValue = ElementTree.SubElement(newProperty, "value")
-        newPropertyValue.text = propertyValues[i]
+        newPropertyValue.text = pending[propertyName]
+
+    return len(pending), updated, unchanged
+
 
 def prettify(elem):
     """Return a pretty-printed XML string for the Element.
@@ -59,5 +84,62 @@ def prettify(elem):
     fixedPrettyStr = re.sub(fix, '', prettyStr)
     return fixedPrettyStr
 
-with open(fileName, "w") as f:
-    f.write(prettify(root))
+
+def renderConfiguration(contents, properties):
+    """Return the pretty-printed configuration that results from setting
+    properties on the given configuration file contents, along with the
+    (added, updated, unchanged) counts.
+    """
+    try:
+        root = ElementTree.fromstring(contents)
+    except Exception:
+        root = ElementTree.Element("configuration")
+
+    counts = replaceProperties(root, properties)
+    return prettify(root), counts
+
+
+def replaceFileProperties(fileName, properties):
+    contents = ""
+
+    try:
+        with open(fileName) as f:
+            contents = f.read()
+    except IOError:
+        pass
+
+    newContents, counts = renderConfiguration(contents, properties)
+
+    with open(fileName, "w") as f:
+        f.write(newContents)
+
+    return counts
+
+
+def readManifest(manifestPath):
+    if manifestPath == "-":
+        return json.load(sys.stdin)
+
+    with open(manifestPath) as f:
+        return json.load(f)
+
+
+def main(args):
+    if len(args) == 2 and args[0] == "--batch":
+        manifest = readManifest(args[1])
+    elif len(args) >= 1 and len(args) % 2 == 1 and args[0] != "--batch":
+        manifest = {args[0]: dict(zip(args[1::2], args[2::2]))}
+    else:
+        print(USAGE)
+        return 1
+
+    for fileName in sorted(manifest):
+        added, updated, unchanged = replaceFileProperties(fileName, manifest[fileName])
+        print("%s: %d added, %d updated, %d unchanged" %
+              (fileName, added, updated, unchanged))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
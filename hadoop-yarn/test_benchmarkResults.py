@@ -0,0 +1,104 @@
+# encoding: utf-8
+
+import pytest
+
+import benchmarkResults
+
+TERASORT_OUTPUT = """14/05/01 10:00:00 INFO mapreduce.Job: Job job_1 completed successfully
+14/05/01 10:00:00 INFO mapreduce.Job: Counters: 49
+\tFile System Counters
+\t\tHDFS: Number of bytes read=1000
+\tMap-Reduce Framework
+\t\tSpilled Records=2000
+\t\tReduce shuffle bytes=3000
+\t\tCPU time spent (ms)=4500
+\t\tGC time elapsed (ms)=500
+\tFile Output Format Counters
+\t\tBytes Written=1000
+"""
+
+DFSIO_OUTPUT = """14/05/01 10:00:00 INFO fs.TestDFSIO: ----- TestDFSIO ----- : read
+14/05/01 10:00:00 INFO fs.TestDFSIO:            Date & time: Thu May 01 10:00:00 UTC 2014
+14/05/01 10:00:00 INFO fs.TestDFSIO:        Number of files: 10
+14/05/01 10:00:00 INFO fs.TestDFSIO:  Total MBytes processed: 1000.0
+14/05/01 10:00:00 INFO fs.TestDFSIO:      Throughput mb/sec: 45.5
+14/05/01 10:00:00 INFO fs.TestDFSIO: Average IO rate mb/sec: 47.25
+14/05/01 10:00:00 INFO fs.TestDFSIO:  IO rate std deviation: 3.5
+14/05/01 10:00:00 INFO fs.TestDFSIO:     Test exec time sec: 32.1
+"""
+
+NNBENCH_OUTPUT = """14/05/01 10:00:00 INFO hdfs.NNBench:                   Test Operation: create_write
+14/05/01 10:00:00 INFO hdfs.NNBench:       Successful file operations: 1000
+14/05/01 10:00:00 INFO hdfs.NNBench:                     # exceptions: 0
+14/05/01 10:00:00 INFO hdfs.NNBench:          TPS: Create/Write/Close: 125
+14/05/01 10:00:00 INFO hdfs.NNBench: Avg exec time (ms): Create/Write/Close: 16.5
+"""
+
+MRBENCH_OUTPUT = """14/05/01 10:00:00 INFO mapred.MRBench: Running job 0
+DataLines\tMaps\tReduces\tAvgTime (milliseconds)
+1\t\t2\t1\t15734
+"""
+
+
+@pytest.mark.parametrize("output, expected", [
+    ("", {}),
+    (TERASORT_OUTPUT, {
+        "File System Counters": {"HDFS: Number of bytes read": 1000},
+        "Map-Reduce Framework": {"Spilled Records": 2000, "Reduce shuffle bytes": 3000,
+                                 "CPU time spent (ms)": 4500, "GC time elapsed (ms)": 500},
+        "File Output Format Counters": {"Bytes Written": 1000},
+    }),
+    # Only the counters of the last job
+    ("Counters: 1\n\tOld\n\t\tA=1\nCounters: 1\n\tNew\n\t\tB=2\n", {"New": {"B": 2}}),
+    # Values that aren't numbers are skipped
+    ("Counters: 1\n\tGroup\n\t\tA=x\n\t\tB=3\n", {"Group": {"B": 3}}),
+])
+def test_parseCounters(output, expected):
+    assert benchmarkResults.parseCounters(output) == expected
+
+
+@pytest.mark.parametrize("output, expected", [
+    ("", {}),
+    ("no numbers here\nkey: value\n", {}),
+    ("14/05/01 10:00:00 INFO fs.TestDFSIO: Throughput mb/sec: 45.5\n",
+     {"Throughput mb/sec": 45.5}),
+    ("TPS: Create/Write/Close: 125\n", {"TPS: Create/Write/Close": 125.0}),
+])
+def test_parseKeyValues(output, expected):
+    assert benchmarkResults.parseKeyValues(output) == expected
+
+
+def test_teraMetrics():
+    metrics = benchmarkResults.teraMetrics(TERASORT_OUTPUT, 10.0, 100e6)["metrics"]
+
+    assert metrics == {"elapsedSec": 10.0, "throughputMBps": 10.0, "cpuTimeSec": 4.5,
+                       "gcTimeSec": 0.5, "spilledRecords": 2000, "shuffleBytes": 3000,
+                       "outputBytes": 1000}
+
+
+@pytest.mark.parametrize("parse, output, expected", [
+    (benchmarkResults.dfsioMetrics, DFSIO_OUTPUT,
+     {"throughputMBps": 45.5, "avgIoRateMBps": 47.25, "ioRateStdDev": 3.5,
+      "execTimeSec": 32.1}),
+    (benchmarkResults.dfsioMetrics, "",
+     {"throughputMBps": None, "avgIoRateMBps": None, "ioRateStdDev": None,
+      "execTimeSec": None}),
+    (lambda output: benchmarkResults.nnbenchMetrics(output, "create_write"), NNBENCH_OUTPUT,
+     {"tps": 125.0, "avgExecMs": 16.5, "successfulOperations": 1000.0, "mapExceptions": 0.0}),
+    (benchmarkResults.mrbenchMetrics, MRBENCH_OUTPUT, {"avgJobMs": 15734}),
+    (benchmarkResults.mrbenchMetrics, "", {"avgJobMs": None}),
+])
+def test_benchmarkMetrics(parse, output, expected):
+    assert parse(output)["metrics"] == expected
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("throughputMBps", True),
+    ("tps", True),
+    ("elapsedSec", False),
+    ("avgExecMs", False),
+    ("spilledRecords", False),
+    ("shuffleBytes", False),
+])
+def test_higherIsBetter(name, expected):
+    assert benchmarkResults.higherIsBetter(name) == expected
@@ -0,0 +1,220 @@
+# encoding: utf-8
+
+import pytest
+
+import fabfile
+
+
+@pytest.mark.parametrize("contents, variables, expectedContents, expectedChanged", [
+    ("", [("A", "1")], "export A=1\n", ["A"]),
+    ("export A=1\n", [("A", "1")], "export A=1\n", []),
+    ("export A=1\nexport B=2\n", [("A", "3")], "export A=3\nexport B=2\n", ["A"]),
+    # Other lines are kept, new variables go at the end
+    ("# comment\nexport A=1\n", [("B", "2"), ("A", "1")],
+     "# comment\nexport A=1\nexport B=2\n", ["B"]),
+    # A variable isn't mistaken for another one it is a prefix of
+    ("export AB=1\n", [("A", "2")], "export AB=1\nexport A=2\n", ["A"]),
+    # Values escaped for fabric end up unescaped in the file
+    ("", [("PATH", r"\\$PATH:/opt/bin")], "export PATH=$PATH:/opt/bin\n", ["PATH"]),
+    ("export PATH=$PATH:/opt/bin\n", [("PATH", r"\\$PATH:/opt/bin")],
+     "export PATH=$PATH:/opt/bin\n", []),
+])
+def test_mergeEnvironmentVariables(contents, variables, expectedContents, expectedChanged):
+    assert fabfile.mergeEnvironmentVariables(contents, variables) == \
+        (expectedContents, expectedChanged)
+
+
+BEGIN = fabfile.HOSTS_BLOCK_BEGIN
+END = fabfile.HOSTS_BLOCK_END
+
+
+@pytest.mark.parametrize("contents, privateIps, expected", [
+    ("", {}, [BEGIN, END]),
+    ("127.0.0.1 localhost\n", {"b": "10.0.0.2", "a": "10.0.0.1"},
+     ["127.0.0.1 localhost", BEGIN, "10.0.0.1 a", "10.0.0.2 b", END]),
+    # The previous block is replaced, not added to
+    ("127.0.0.1 localhost\n%s\n10.0.0.9 old\n%s\n" % (BEGIN, END), {"a": "10.0.0.1"},
+     ["127.0.0.1 localhost", BEGIN, "10.0.0.1 a", END]),
+    # Stale entries of the managed IPs outside the block are dropped
+    ("10.0.0.1 stale\n10.0.0.5 other\n\n", {"a": "10.0.0.1"},
+     ["10.0.0.5 other", "", BEGIN, "10.0.0.1 a", END]),
+])
+def test_renderHostsFile(contents, privateIps, expected):
+    rendered = fabfile.renderHostsFile(contents, privateIps)
+
+    assert rendered == "\n".join(expected) + "\n"
+    # Rendering again changes nothing
+    assert fabfile.renderHostsFile(rendered, privateIps) == rendered
+
+
+def sizingFacts(cpuCount, memoryMb, disks):
+    return {"cpuCount": cpuCount, "memoryMb": memoryMb,
+            "blockDevices": [{"type": "disk", "sizeBytes": 1 << 40}] * disks +
+                            [{"type": "rom", "sizeBytes": 1 << 30}]}
+
+
+@pytest.mark.parametrize("cpuCount, memoryMb, disks, expected", [
+    # One container per core left after the reserved one
+    (2, 8192, 1, {"disks": 1, "vcores": 1, "containerMb": 6528, "memoryMb": 6528}),
+    (8, 32768, 4, {"disks": 4, "vcores": 7, "containerMb": 3712, "memoryMb": 25984}),
+    # Enough disks for more containers than cores
+    (16, 65536, 12, {"disks": 12, "vcores": 15, "containerMb": 2432, "memoryMb": 51072}),
+    # Tiny hosts still get a container, and a disk is assumed
+    (1, 2048, 0, {"disks": 1, "vcores": 1, "containerMb": 1024, "memoryMb": 1024}),
+    # Memory bound: no container smaller than the minimum for the host
+    (32, 16384, 8, {"disks": 8, "vcores": 31, "containerMb": 1024, "memoryMb": 12288}),
+])
+def test_computeHostSizing(cpuCount, memoryMb, disks, expected):
+    assert fabfile.computeHostSizing(sizingFacts(cpuCount, memoryMb, disks)) == expected
+
+
+CHECKNATIVE_OUTPUT = """14/05/01 10:00:00 INFO bzip2.Bzip2Factory: Successfully loaded & initialized native-bzip2 library system-native
+Native library checking:
+hadoop:  true /opt/hadoop/lib/native/libhadoop.so.1.0.0
+zlib:    true /lib/x86_64-linux-gnu/libz.so.1
+snappy:  true /usr/lib/libsnappy.so.1
+lz4:     true revision:99
+bzip2:   false
+openssl: false Cannot load libcrypto.so (libcrypto.so: cannot open shared object file)!
+"""
+
+
+@pytest.mark.parametrize("output, expected", [
+    ("", {}),
+    (CHECKNATIVE_OUTPUT, {"hadoop": True, "zlib": True, "snappy": True, "lz4": True,
+                          "bzip2": False, "openssl": False}),
+    # Without libhadoop, checknative only reports that
+    ("Native library checking:\nhadoop:  false\n", {"hadoop": False}),
+    # Log lines and other colons aren't libraries
+    ("WARN util.NativeCodeLoader: Unable to load native-hadoop library\n"
+     "snappy: maybe\n", {}),
+])
+def test_parseCheckNative(output, expected):
+    assert fabfile.parseCheckNative(output) == expected
+
+
+@pytest.mark.parametrize("libraries, expected", [
+    ({"hadoop": True, "snappy": True}, True),
+    ({"hadoop": True, "snappy": False}, False),
+    ({"hadoop": False, "snappy": True}, False),
+    ({}, False),
+])
+def test_nativeCodecLoads(libraries, expected):
+    assert fabfile.COMPRESSION_CODEC == "snappy"
+    assert fabfile.nativeCodecLoads(libraries) == expected
+
+
+class LocalResult(str):
+    pass
+
+
+@pytest.fixture
+def localHadoopPrefix(tmp_path, monkeypatch):
+    # run and put act on a local directory standing in for HADOOP_PREFIX
+    import os
+    import shutil
+    import subprocess
+
+    def run(command, **kwargs):
+        process = subprocess.Popen(["/bin/bash", "-c", command], cwd=str(tmp_path),
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        result = LocalResult(stdout.decode("utf-8").strip())
+        result.stderr = stderr.decode("utf-8").strip()
+        result.return_code = process.returncode
+        result.failed = process.returncode != 0
+        return result
+
+    def put(localPath, remotePath):
+        if hasattr(localPath, "read"):
+            with open(remotePath, "wb") as f:
+                f.write(localPath.read())
+        else:
+            shutil.copy(localPath, remotePath)
+
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(fabfile.__file__)))
+    monkeypatch.setattr(fabfile, "run", run)
+    monkeypatch.setattr(fabfile, "put", put)
+    monkeypatch.setattr(fabfile, "HADOOP_PREFIX", str(tmp_path))
+    monkeypatch.setattr(fabfile, "HADOOP_CONF", str(tmp_path))
+    monkeypatch.setattr(fabfile, "ENVIRONMENT_FILE", str(tmp_path / "environment"))
+    monkeypatch.setattr(fabfile, "ENVIRONMENT_FILE_NOTAUTOLOADED", True)
+    (tmp_path / "environment").write_text(u"")
+    return tmp_path
+
+
+@pytest.mark.parametrize("helperContents, exitStatus, expectedFailed", [
+    (None, 0, False),
+    (u"#!/bin/sh\nexit 1\n", 0, False),
+    (None, 3, True),
+    # The command itself exits with the status of an outdated helper
+    (None, fabfile.HELPER_OUTDATED_STATUS, True),
+])
+def test_operationInHadoopEnvironmentRunsOnce(localHadoopPrefix, helperContents, exitStatus,
+                                              expectedFailed):
+    helperPath = localHadoopPrefix / "executeInHadoopEnv.sh"
+    if helperContents is None:
+        # Up to date
+        with open("executeInHadoopEnv.sh") as f:
+            helperContents = f.read()
+    helperPath.write_text(helperContents)
+    helperPath.chmod(0o755)
+
+    with fabfile.settings(warn_only=True):
+        result = fabfile.operationInHadoopEnvironment("echo ran >> runs; exit %d" % exitStatus)
+
+    assert (localHadoopPrefix / "runs").read_text().split() == ["ran"]
+    assert result.failed == expectedFailed
+    assert result.return_code == exitStatus
+
+
+def fileMode(path):
+    import stat
+    return stat.S_IMODE(path.stat().st_mode)
+
+
+@pytest.mark.parametrize("mode, backupOp, expectedMode, expectedFiles", [
+    (0o600, "cp", 0o600, ["environment", "environment.bak0"]),
+    (0o640, "mv", 0o640, ["environment", "environment.bak0"]),
+    (0o644, None, 0o644, ["environment"]),
+    # A new file gets the usual mode, not the one of a temporary file
+    (None, None, 0o644, ["environment"]),
+])
+def test_replaceRemoteFile(localHadoopPrefix, mode, backupOp, expectedMode, expectedFiles):
+    import glob
+    uploads = set(glob.glob("/tmp/environment.*"))
+    targetPath = localHadoopPrefix / "environment"
+    if mode is None:
+        targetPath.unlink()
+    else:
+        targetPath.write_text(u"old\n")
+        targetPath.chmod(mode)
+
+    fabfile.replaceRemoteFile(str(targetPath), u"new\n", backupOp)
+
+    assert targetPath.read_text() == u"new\n"
+    assert fileMode(targetPath) == expectedMode
+    # Neither the staged file nor anything else left behind
+    assert sorted(path.name for path in localHadoopPrefix.iterdir()) == expectedFiles
+    assert set(glob.glob("/tmp/environment.*")) == uploads
+
+
+@pytest.mark.parametrize("clean, expectedFiles", [
+    (False, ["core-site.xml", "core-site.xml.bak0", "yarn-site.xml"]),
+    (True, ["core-site.xml", "core-site.xml.bak0", "yarn-site.xml"]),
+])
+def test_pushHadoopConfiguration(localHadoopPrefix, monkeypatch, clean, expectedFiles):
+    monkeypatch.setattr(fabfile, "CONFIGURATION_FILES_CLEAN", clean)
+    (localHadoopPrefix / "environment").unlink()
+    corePath = localHadoopPrefix / "core-site.xml"
+    corePath.write_text(u"old")
+    corePath.chmod(0o640)
+
+    fabfile.pushHadoopConfiguration({"core-site.xml": b"core", "yarn-site.xml": b"yarn"})
+
+    assert corePath.read_text() == u"core"
+    assert fileMode(corePath) == 0o640
+    assert (localHadoopPrefix / "core-site.xml.bak0").read_text() == u"old"
+    assert (localHadoopPrefix / "yarn-site.xml").read_text() == u"yarn"
+    assert fileMode(localHadoopPrefix / "yarn-site.xml") == 0o644
+    assert sorted(path.name for path in localHadoopPrefix.iterdir()) == expectedFiles
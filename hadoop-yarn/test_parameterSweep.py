@@ -0,0 +1,71 @@
+# encoding: utf-8
+
+import pytest
+
+import parameterSweep
+
+PARAMETERS = {
+    "mapred-site.xml": {"mapreduce.task.io.sort.mb": [100, 200],
+                        "mapreduce.job.reduces": [4, 8]},
+    "yarn-site.xml": {"yarn.nodemanager.vmem-pmem-ratio": [2.1]},
+}
+
+
+@pytest.mark.parametrize("parameters, expected", [
+    ({}, [{}]),
+    ({"core-site.xml": {"io.file.buffer.size": [4096, 65536]}},
+     [{"core-site.xml": {"io.file.buffer.size": 4096}},
+      {"core-site.xml": {"io.file.buffer.size": 65536}}]),
+    # Every combination, in the order of the sorted files and names
+    (PARAMETERS,
+     [{"mapred-site.xml": {"mapreduce.job.reduces": reduces, "mapreduce.task.io.sort.mb": sortMb},
+       "yarn-site.xml": {"yarn.nodemanager.vmem-pmem-ratio": 2.1}}
+      for reduces in [4, 8] for sortMb in [100, 200]]),
+])
+def test_sweepPointsGrid(parameters, expected):
+    assert parameterSweep.sweepPoints(parameters) == expected
+
+
+@pytest.mark.parametrize("samples, expectedCount", [
+    (2, 2),
+    (4, 4),
+    # No more than the whole grid
+    (10, 4),
+])
+def test_sweepPointsRandom(samples, expectedCount):
+    grid = parameterSweep.sweepPoints(PARAMETERS)
+    points = parameterSweep.sweepPoints(PARAMETERS, "random", samples, seed=3)
+
+    assert len(points) == expectedCount
+    assert all(point in grid for point in points)
+    assert len(set(parameterSweep.formatPoint(point) for point in points)) == expectedCount
+    # Same seed, same points, so that a sweep can resume
+    assert parameterSweep.sweepPoints(PARAMETERS, "random", samples, seed=3) == points
+
+
+def test_sweepPointsUnknownMode():
+    with pytest.raises(ValueError):
+        parameterSweep.sweepPoints(PARAMETERS, "exhaustive")
+
+
+@pytest.mark.parametrize("previous, point, expected", [
+    ({}, {"mapred-site.xml": {"a": 1}}, ["mapred-site.xml"]),
+    ({"mapred-site.xml": {"a": 1}}, {"mapred-site.xml": {"a": 1}}, []),
+    ({"mapred-site.xml": {"a": 1}, "yarn-site.xml": {"b": 2}},
+     {"mapred-site.xml": {"a": 1}, "yarn-site.xml": {"b": 3}}, ["yarn-site.xml"]),
+    # Restoring a property that wasn't set before
+    ({"mapred-site.xml": {"a": 1}}, {"mapred-site.xml": {"a": None}}, ["mapred-site.xml"]),
+])
+def test_changedFiles(previous, point, expected):
+    assert parameterSweep.changedFiles(previous, point) == expected
+
+
+@pytest.mark.parametrize("scores, higherIsBetter, expected", [
+    ({}, True, []),
+    ({"0": 1.0, "1": 3.0, "2": 2.0}, True, [1, 2, 0]),
+    ({"0": 1.0, "1": 3.0, "2": 2.0}, False, [0, 2, 1]),
+    # Points without a result are left out
+    ({"0": None, "2": 5.0}, True, [2]),
+])
+def test_rankPoints(scores, higherIsBetter, expected):
+    assert parameterSweep.rankPoints([{}, {}, {}], scores, higherIsBetter) == expected
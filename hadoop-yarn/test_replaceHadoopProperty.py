@@ -0,0 +1,41 @@
+# encoding: utf-8
+
+import pytest
+
+import replaceHadoopProperty
+
+CONFIGURATION = """<?xml version="1.0"?>
+<configuration>
+  <property><name>a</name><value>1</value></property>
+  <property><name>b</name><value>2</value></property>
+</configuration>
+"""
+
+
+def properties(contents):
+    root = replaceHadoopProperty.ElementTree.fromstring(contents)
+    return dict((prop.find("name").text, prop.find("value").text)
+                for prop in root.iter("property"))
+
+
+@pytest.mark.parametrize("changes, expectedProperties, expectedCounts", [
+    ({}, {"a": "1", "b": "2"}, (0, 0, 0)),
+    ({"a": 1}, {"a": "1", "b": "2"}, (0, 0, 1)),
+    ({"a": 3, "c": "x"}, {"a": "3", "b": "2", "c": "x"}, (1, 1, 0)),
+    # None removes the property, and does nothing if it isn't there
+    ({"a": None}, {"b": "2"}, (0, 1, 0)),
+    ({"c": None}, {"a": "1", "b": "2"}, (0, 0, 1)),
+])
+def test_renderConfiguration(changes, expectedProperties, expectedCounts):
+    contents, counts = replaceHadoopProperty.renderConfiguration(CONFIGURATION, changes)
+
+    assert properties(contents) == expectedProperties
+    assert counts == expectedCounts
+
+
+def test_renderConfigurationIsStable():
+    once, counts = replaceHadoopProperty.renderConfiguration("", {"b": 2, "a": 1})
+    twice, counts = replaceHadoopProperty.renderConfiguration(once, {"b": 2, "a": 1})
+
+    assert once == twice
+    assert counts == (0, 0, 2)
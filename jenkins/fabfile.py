@@ -21,7 +21,19 @@
 #   have to dive into the DON'T CHANGE section but it shouldn't
 #   be too hard.
 
+import os
+import sys
 from fabric.api import run, cd, env, settings, put, sudo
+from fabric.decorators import runs_once
+from fabric.tasks import execute
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import fanOut
+import hostFacts
+import hostRoles
+import remoteTiming
+
+remoteTiming.install()
 
 ###############################################################
 #  START OF YOUR CONFIGURATION (CHANGE FROM HERE, IF NEEDED)  #
@@ -53,6 +65,12 @@ MASTER_REQUIREMENTS = ["openjdk-7-jre-headless", "git"] + DEBIAN_32_COMPAT
 # Packages that should be installed on the slave hosts
 SLAVE_REQUIREMENTS = ["openjdk-7-jre-headless", "git", "php5", "php5-json", 
     "ant"] + DEBIAN_32_COMPAT
+
+# "fabric" runs the tasks that fan out a single command to every host (host
+# facts) with @parallel, one process per host. "async"
+# runs them from a single process with asyncio, which scales to thousands
+# of hosts (needs Python 3 and asyncssh, see common/asyncEngine.py).
+EXECUTION_ENGINE = "fabric"
 ##############################################################
 #  END OF YOUR CONFIGURATION (CHANGE UNTIL HERE, IF NEEDED)  #
 ##############################################################
@@ -63,40 +81,63 @@ SLAVE_REQUIREMENTS = ["openjdk-7-jre-headless", "git", "php5", "php5-json",
 PACKAGE_MANAGER_INSTALL = "apt-get install %s"
 PACKAGE_MANAGER_UPDATE = "apt-get update"
 
-# Debian/Ubuntu
-# If no hosts provided via the argument, try using
-# hardcoded ones
-if not env.hosts:
-    env.hosts = [JENKINS_MASTER_HOST] + JENKINS_SLAVE_HOSTS
+def bootstrapFabric():
+    global JENKINS_MASTER_HOST, JENKINS_SLAVE_HOSTS
+
+    # Debian/Ubuntu
+    # If no hosts provided via the argument, try using
+    # hardcoded ones
+    if not env.hosts:
+        env.hosts = [JENKINS_MASTER_HOST] + JENKINS_SLAVE_HOSTS
 
-# If no hardcoded hosts, quit
-if not env.hosts:
-    raise Exception("No hosts specified")
+    # If no hardcoded hosts, quit
+    if not env.hosts:
+        raise Exception("No hosts specified")
 
-JENKINS_MASTER_HOST = env.hosts[0]
+    JENKINS_MASTER_HOST = env.hosts[0]
+    # With fab -H<master host>,<slave1 host>,..., the rest are the slaves
+    JENKINS_SLAVE_HOSTS = JENKINS_SLAVE_HOSTS or env.hosts[1:]
+
+    hostRoles.define({
+        "jenkins-master": [JENKINS_MASTER_HOST],
+        "jenkins-slave": JENKINS_SLAVE_HOSTS,
+    })
+
+    hostFacts.ENGINE = EXECUTION_ENGINE
+    fanOut.QUARANTINE_NAME = "jenkins"
 
 # Main functions
+@runs_once
 def setup():
-    setupMaster()
-    setupSlave()
+    execute(setupMaster)
+    execute(setupSlave)
 
+@hostRoles.targets("jenkins-master")
 def setupMaster():
-    if env.host == JENKINS_MASTER_HOST:
-        print("+ Setting up Master")
-        installMasterDependencies()
-        installJenkins()
-        installJenkinsPlugins(JENKINS_EXTRA_PLUGINS)
-        installJenkinsMasterSSHKeys()
-        print("+ Master setup")
-
+    print("+ Setting up Master")
+    installMasterDependencies()
+    installJenkins()
+    installJenkinsPlugins(JENKINS_EXTRA_PLUGINS)
+    installJenkinsMasterSSHKeys()
+    print("+ Master setup")
+
+@hostRoles.targets("jenkins-slave")
 def setupSlave():
-    if env.host in JENKINS_SLAVE_HOSTS:
-        print("+ Setting up Slave")
-        addJenkinsUser()
-        installSlaveDependencies()
-        allowJenkinsMasterSSHKeys()
-        disableSSHStrictKeyChecking()
-        print("+ Slave setup")
+    print("+ Setting up Slave")
+    addJenkinsUser()
+    installSlaveDependencies()
+    allowJenkinsMasterSSHKeys()
+    disableSSHStrictKeyChecking()
+    print("+ Slave setup")
+
+@runs_once
+def debugFacts():
+    hostFacts.printFacts(hostFacts.gatherFacts(env.hosts))
+
+@runs_once
+def traceSummary(trace=None):
+    # Slowest hosts, tasks and commands of the given (or the last) fab run
+    remoteTiming.printSummary(remoteTiming.loadTrace(trace))
 
 # HELPER FUNCTIONS
 def installJenkins():
@@ -173,3 +214,5 @@ def addJenkinsUser():
         elif run("test -d /home/jenkins").failed:
             sudo("mkdir -p /home/jenkins")
             sudo("chown -R jenkins /home/jenkins")
+
+bootstrapFabric()
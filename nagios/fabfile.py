@@ -7,30 +7,46 @@
 #   in a cluster.
 
 import os
+import sys
 import tempfile
 import textwrap
-from fabric.api import run, cd, env, settings, put, sudo
-from fabric.decorators import runs_once, parallel
+from fabric.api import run, cd, env, settings, put, sudo, abort
+from fabric.decorators import runs_once
 from fabric.tasks import execute
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+import artifactCache
+import fanOut
+import hostFacts
+import hostRoles
+import remoteTiming
+import remotePipeline
+import stepJournal
+
+remoteTiming.install()
+
 env.password = "password"
 
 # Packages info
 NAGIOS_CORE_VERSION = "4.0.8"
 NAGIOS_CORE_PACKAGE = "nagios-{}".format(NAGIOS_CORE_VERSION)
 NAGIOS_CORE_URL = "http://liquidtelecom.dl.sourceforge.net/project/nagios/nagios-4.x/{package}/{package}.tar.gz".format(package=NAGIOS_CORE_PACKAGE)
+NAGIOS_CORE_SHA256 = None
 
 NAGIOS_PLUGINS_VERSION = "2.0.3"
 NAGIOS_PLUGINS_PACKAGE = "nagios-plugins-{}".format(NAGIOS_PLUGINS_VERSION)
 NAGIOS_PLUGINS_URL = "http://nagios-plugins.org/download/{}.tar.gz".format(NAGIOS_PLUGINS_PACKAGE)
+NAGIOS_PLUGINS_SHA256 = None
 
 NRPE_VERSION = "2.15"
 NRPE_PACKAGE = "nrpe-{}".format(NRPE_VERSION)
 NRPE_URL = "http://liquidtelecom.dl.sourceforge.net/project/nagios/nrpe-2.x/{package}/{package}.tar.gz".format(package=NRPE_PACKAGE)
+NRPE_SHA256 = None
 
 PNP4NAGIOS_VERSION = "0.6.25"
 PNP4NAGIOS_PACKAGE = "pnp4nagios-{}".format(PNP4NAGIOS_VERSION)
 PNP4NAGIOS_URL = "http://liquidtelecom.dl.sourceforge.net/project/pnp4nagios/PNP-0.6/{package}.tar.gz".format(package=PNP4NAGIOS_PACKAGE)
+PNP4NAGIOS_SHA256 = None
 
 # Cluster info
 CLUSTER_MASTER = "grafos01"
@@ -56,6 +72,22 @@ NRPE_SERVICES = [
 
 # System info
 NET_INTERFACE = "eth0"
+
+# "fabric" runs the tasks that fan out a single command to every host (host
+# facts, private IPs) with @parallel, one process per host. "async"
+# runs them from a single process with asyncio, which scales to thousands
+# of hosts (needs Python 3 and asyncssh, see common/asyncEngine.py).
+EXECUTION_ENGINE = "fabric"
+# Hosts that may fail (unreachable, or still failing after the retries) when
+# collecting the private IPs or in an install step before the run aborts: a
+# number of hosts ("3") or a percentage ("5%"). The failed hosts are left
+# out of the rest of the run and of the Nagios configuration, and
+# quarantined for an hour (fab clearQuarantine releases them).
+FANOUT_FAILURE_BUDGET = "0"
+# Retries of the hosts that failed with a connection error, the first one
+# after FANOUT_RETRY_BACKOFF seconds and each next one after twice as long
+FANOUT_RETRIES = 2
+FANOUT_RETRY_BACKOFF = 2.0
 SENDMAIL_BIN = "/usr/bin/sendmail"
 
 APACHE2_CONFD = "/etc/apache2/conf.d"
@@ -89,28 +121,95 @@ POSTINSTALL_COMMANDS = [
     "service {0} restart".format(APACHE2_DAEMON)
 ]
 
+# Name of the journal of the steps each host went through in install, in
+# ~/.cache/fabric-scripts/journals
+INSTALL_JOURNAL = "nagios-install"
+
 def bootstrapFabric():
+    hostFacts.ENGINE = EXECUTION_ENGINE
+    fanOut.FAILURE_BUDGET = FANOUT_FAILURE_BUDGET
+    fanOut.RETRIES = FANOUT_RETRIES
+    fanOut.RETRY_BACKOFF = FANOUT_RETRY_BACKOFF
+    fanOut.QUARANTINE_NAME = "nagios"
+
     hosts = [CLUSTER_MASTER] + CLUSTER_WORKERS
     seen = set()
     # Remove empty hosts and duplicates
     cleanedHosts = [host for host in hosts if host and host not in seen and not seen.add(host)]
     env.hosts = cleanedHosts
+    hostRoles.define({
+        "nagios-master": [CLUSTER_MASTER],
+        "nagios-worker": CLUSTER_WORKERS,
+    })
+    fanOut.excludeQuarantined()
+
 
+# MAIN FUNCTIONS
+@runs_once
+def install(resume="false"):
+    # Step by step, each one only on the hosts it has work on. With
+    # resume=true, only the steps that failed, never ran or whose inputs
+    # changed since the last install, on the hosts that need them.
+    resume = stepJournal.isTrue(resume)
+    if not resume:
+        stepJournal.reset(INSTALL_JOURNAL)
+
+    journal = stepJournal.readJournal(INSTALL_JOURNAL)
+    # installNRPE needs the private IPs, collected once for every host
     retrieveClusterInformation()
+    for step, inputs in installInputs():
+        hosts = stepHosts(step)
+        if resume:
+            hosts = [host for host in hosts if stepJournal.pendingSteps(
+                journal, host, [(step.__name__, inputs)])]
+        # Hosts that fail a step are dropped from the next ones, as long as
+        # the failure budget allows
+        if hosts:
+            fanOut.runTask(installStep, list(hosts), step, inputs, what=step.__name__)
+
+
+def installStep(step, inputs):
+    stepJournal.runStep(INSTALL_JOURNAL, step.__name__, inputs, step)
+
+
+def installInputs():
+    # The install steps, in order, with the values each one depends on. A
+    # step is repeated on resume when they change.
+    steps = [
+        (installDependencies, [PREINSTALL_COMMANDS, INSTALL_COMMAND, DEPENDENCIES,
+                               POSTINSTALL_COMMANDS]),
+        (addUserAndGroup, [NAGIOS_USER, NAGIOS_GROUP]),
+        (installCore, [NAGIOS_CORE_URL, NAGIOS_CORE_SHA256, NAGIOS_USER, NAGIOS_GROUP,
+                       SENDMAIL_BIN, APACHE2_CONFD, NAGIOS_HTTP_USER, NAGIOS_HTTP_PASSWORD]),
+        (installPlugins, [NAGIOS_PLUGINS_URL, NAGIOS_PLUGINS_SHA256, NAGIOS_USER]),
+        (installNRPE, [NRPE_URL, NRPE_SHA256, NRPE_SERVICES, CLUSTER_MASTER, CLUSTER_WORKERS,
+                       stepJournal.fileHashes(["xinetd_nrpe", "slave_nrpe_config",
+                                               "master_nrpe_hosts", "commands.cfg",
+                                               "check_iostat", "check_netint.pl",
+                                               "check_linux_stats.pl"])]),
+        (installPNP4Nagios, [PNP4NAGIOS_URL, PNP4NAGIOS_SHA256]),
+    ]
+    # Restarted whenever anything else changed
+    steps.append((restartNagios, [inputs for step, inputs in steps]))
+    return steps
+
+
+def stepHosts(step):
+    # The hosts of the roles the step declares, every host otherwise
+    if hasattr(step, "roles"):
+        return [host for role in step.roles for host in hostRoles.hostsWithRole(role)]
+    return env.hosts
 
-    print("Hosts to IPS:")
-    print(CLUSTER_PRIVATE_IPS)
 
+@runs_once
+def installStatus():
+    # Where each host stands in the last install, see install:resume=true
+    hostSteps = dict((host, []) for host in env.hosts)
+    for step, inputs in installInputs():
+        for host in stepHosts(step):
+            hostSteps[host].append((step.__name__, inputs))
 
-# MAIN FUNCTIONS
-def install():
-    installDependencies()
-    addUserAndGroup()
-    installCore()
-    installPlugins()
-    installNRPE()
-    installPNP4Nagios()
-    restartNagios()
+    stepJournal.printStatus(INSTALL_JOURNAL, hostSteps)
 
 def installDependencies():
     for command in PREINSTALL_COMMANDS:
@@ -129,18 +228,15 @@ def addUserAndGroup():
             sudo_with_settings("usermod -a -G {NAGIOS_GROUP} {NAGIOS_USER}")
 
 
+@hostRoles.targets("nagios-master")
 def installCore():
-    if not env.host == CLUSTER_MASTER:
-        return
-
     with settings(warn_only=True):
         if not run("test -d {}".format("/usr/local/nagios")).failed:
             print("Core already installed.")
             return
 
-    with settings(warn_only=True):
-        if run("test -f %s.tar.gz" % NAGIOS_CORE_PACKAGE).failed:
-            run("wget -O %s.tar.gz %s" % (NAGIOS_CORE_PACKAGE, NAGIOS_CORE_URL))
+    artifactCache.ensureRemoteArtifact(NAGIOS_CORE_URL,
+        "{}.tar.gz".format(NAGIOS_CORE_PACKAGE), NAGIOS_CORE_SHA256)
     run("tar --overwrite -xf %s.tar.gz" % NAGIOS_CORE_PACKAGE)
 
     with cd(NAGIOS_CORE_PACKAGE):
@@ -160,9 +256,8 @@ def installCore():
 
 
 def installPlugins():
-    with settings(warn_only=True):
-        if run("test -f {}.tar.gz".format(NAGIOS_PLUGINS_PACKAGE)).failed:
-            run("wget -O {}.tar.gz {}".format(NAGIOS_PLUGINS_PACKAGE, NAGIOS_PLUGINS_URL))
+    artifactCache.ensureRemoteArtifact(NAGIOS_PLUGINS_URL,
+        "{}.tar.gz".format(NAGIOS_PLUGINS_PACKAGE), NAGIOS_PLUGINS_SHA256)
     run("tar --overwrite -xf {}.tar.gz".format(NAGIOS_PLUGINS_PACKAGE))
 
     with cd(NAGIOS_PLUGINS_PACKAGE):
@@ -172,9 +267,8 @@ def installPlugins():
 
 
 def installNRPE():
-    with settings(warn_only=True):
-        if run("test -f %s.tar.gz" % NRPE_PACKAGE).failed:
-            run("wget -O %s.tar.gz %s" % (NRPE_PACKAGE, NRPE_URL))
+    artifactCache.ensureRemoteArtifact(NRPE_URL,
+        "{}.tar.gz".format(NRPE_PACKAGE), NRPE_SHA256)
     run("tar --overwrite -xf %s.tar.gz" % NRPE_PACKAGE)
 
     with cd(NRPE_PACKAGE):
@@ -191,13 +285,10 @@ def installNRPE():
     updateNPREConfig()
 
 
+@hostRoles.targets("nagios-master")
 def installPNP4Nagios():
-    if not env.host == CLUSTER_MASTER:
-        return
-
-    with settings(warn_only=True):
-        if run("test -f %s.tar.gz" % PNP4NAGIOS_PACKAGE).failed:
-            run("wget -O %s.tar.gz %s" % (PNP4NAGIOS_PACKAGE, PNP4NAGIOS_URL))
+    artifactCache.ensureRemoteArtifact(PNP4NAGIOS_URL,
+        "{}.tar.gz".format(PNP4NAGIOS_PACKAGE), PNP4NAGIOS_SHA256)
     run("tar --overwrite -xf %s.tar.gz" % PNP4NAGIOS_PACKAGE)
 
     with cd(PNP4NAGIOS_PACKAGE):
@@ -209,10 +300,8 @@ def installPNP4Nagios():
     configurePNP4Nagios()
 
 
+@hostRoles.targets("nagios-master")
 def configurePNP4Nagios():
-    if not env.host == CLUSTER_MASTER:
-        return
-
     addLinesToFile("/usr/local/nagios/etc/nagios.cfg", [
             r"process_performance_data=1",
             r"service_perfdata_file=/usr/local/pnp4nagios/var/service-perfdata",
@@ -233,11 +322,21 @@ def configurePNP4Nagios():
         ])
 
 
+@runs_once
 def updateConfig():
+    # The private IPs are collected once, before the hosts are configured
+    retrieveClusterInformation()
+    execute(updateHostConfig)
+
+def updateHostConfig():
     updateNPREConfig()
     configurePNP4Nagios()
 
 def updateNPREConfig():
+    # xinetd_nrpe needs CLUSTER_MASTER_IP
+    retrieveClusterInformation()
+    if CLUSTER_MASTER_IP is None:
+        abort("No private IP on %s for the Nagios master %s" % (NET_INTERFACE, CLUSTER_MASTER))
     put_with_settings("xinetd_nrpe", "/etc/xinetd.d/nrpe", use_sudo=True)
 
     if env.host in CLUSTER_WORKERS:
@@ -254,10 +353,10 @@ def startNagios():
         sudo_with_settings("service nagios start")
         sudo_with_settings("service npcd start")
 
+@hostRoles.targets("nagios-master")
 def stopNagios():
-    if env.host == CLUSTER_MASTER:
-        sudo_with_settings("service nagios stop")
-        sudo_with_settings("service npcd stop")
+    sudo_with_settings("service nagios stop")
+    sudo_with_settings("service npcd stop")
 
 def restartNagios():
     if env.host in CLUSTER_WORKERS:
@@ -295,6 +394,7 @@ def configureNRPEMaster():
 
 
 def addHostsToConfig():
+    retrieveClusterInformation()
     put("master_nrpe_hosts", "/usr/local/nagios/etc/hosts.cfg", use_sudo=True)
 
     host_config_base = textwrap.dedent("""\
@@ -307,7 +407,7 @@ def addHostsToConfig():
 
     config_parts = []
 
-    for worker in CLUSTER_WORKERS:
+    for worker in reachableWorkers():
         config_parts.append(host_config_base.format(hostname=worker, address=CLUSTER_PRIVATE_IPS[worker]))
 
     sudo("echo \"{hosts}\" >> \"{file}\"".format(hosts="\n".join(config_parts), file="/usr/local/nagios/etc/hosts.cfg"))
@@ -324,7 +424,7 @@ def addServicesToConfig():
 
     config_parts = []
 
-    for worker in CLUSTER_WORKERS:
+    for worker in reachableWorkers():
         for service_name, service_command in NRPE_SERVICES:
             config_parts.append(service_config_base.format(hostname=worker, description=service_name, command=service_command))
 
@@ -337,50 +437,72 @@ def addCommandsToConfig():
 
 
 def addLinesToFile(cfg_file, lines):
-    with settings(warn_only=True):
-        if not sudo("test -f {}".format(cfg_file)).failed:
-            currentBakNumber = getLastBackupNumber(cfg_file) + 1
-            sudo("cp {file} {file}.bak{bakNumber}".format(file=cfg_file, bakNumber=currentBakNumber))
-
-    sudo("touch %s" % cfg_file)
+    # Back up, create and append the missing lines with a single sudo
+    commands = [backupCommand(cfg_file), "touch %s" % cfg_file]
 
     for line in lines:
-        lineNumber = sudo("grep -n -F -x '{line}' '{file}' | cut -d : -f 1".format(line=line, file=cfg_file))
-        try:
-            lineNumber = int(lineNumber)
-            # Line already exists
-            pass
-        except ValueError:
-            sudo("echo '{line}' >> \"{file}\"".format(line=line, file=cfg_file))
+        commands.append("grep -q -F -x '{line}' '{file}' || echo '{line}' >> \"{file}\"".format(line=line, file=cfg_file))
+
+    remotePipeline.runPipelined(commands, useSudo=True)
 
 
-def getLastBackupNumber(filePath):
-    dirName = os.path.dirname(filePath)
+def backupCommand(filePath):
+    # Copies the file to the next .bakN (after the lexically last one), does
+    # nothing if the file is missing
+    dirName = os.path.dirname(filePath) or "."
     fileName = os.path.basename(filePath)
 
-    with cd(dirName):
-        latestBak = sudo("ls -1 | grep %s.bak | tail -n 1" % fileName)
-        latestBakNumber = -1
-        if latestBak:
-            latestBakNumber = int(latestBak[len(fileName) + 4:])
-        return latestBakNumber
+    return ("if [ -f {file} ]; then "
+            "n=$(cd {dir} && ls -1 | grep {name}.bak | tail -n 1 | cut -c {cut}-); "
+            "cp {file} {file}.bak$((${{n:--1}} + 1)); fi".format(
+                file=filePath, dir=dirName, name=fileName, cut=len(fileName) + 5))
 
-CLUSTER_PRIVATE_IPS = {}
+CLUSTER_PRIVATE_IPS = None
 CLUSTER_MASTER_IP = None
 
-@runs_once
 def retrieveClusterInformation():
+    # Host facts are only collected by the tasks that need them, once per
+    # run, and are cached locally. Run clearFacts to have them collected
+    # again. Call it before the hosts are forked by @parallel or fanOut so
+    # that they all share it.
     global CLUSTER_PRIVATE_IPS
     global CLUSTER_MASTER_IP
 
-    private_ips = execute(getPrivateIp)
+    if CLUSTER_PRIVATE_IPS is not None:
+        return
+
+    facts = hostFacts.gatherFacts(env.hosts, ["interfaces"])
 
-    CLUSTER_PRIVATE_IPS = private_ips
-    CLUSTER_MASTER_IP = CLUSTER_PRIVATE_IPS[CLUSTER_MASTER]
+    # Hosts that couldn't be reached or have no address on NET_INTERFACE
+    # (within the failure budget) are left out
+    CLUSTER_PRIVATE_IPS = hostFacts.privateIps(facts, NET_INTERFACE)
+    CLUSTER_MASTER_IP = CLUSTER_PRIVATE_IPS.get(CLUSTER_MASTER)
+
+
+def reachableWorkers():
+    retrieveClusterInformation()
+    return [worker for worker in CLUSTER_WORKERS if worker in CLUSTER_PRIVATE_IPS]
 
-@parallel
-def getPrivateIp():
-    return run("ifconfig %s | grep 'inet\s\+' | awk '{print $2}' | cut -d':' -f2" % NET_INTERFACE).strip()
+
+@runs_once
+def clearFacts():
+    hostFacts.clearFacts()
+
+
+@runs_once
+def clearQuarantine():
+    fanOut.clearQuarantine()
+
+
+@runs_once
+def debugFacts():
+    hostFacts.printFacts(hostFacts.gatherFacts(env.hosts))
+
+
+@runs_once
+def traceSummary(trace=None):
+    # Slowest hosts, tasks and commands of the given (or the last) fab run
+    remoteTiming.printSummary(remoteTiming.loadTrace(trace))
 
 
 def run_with_settings(command):